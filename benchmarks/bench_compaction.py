@@ -0,0 +1,112 @@
+# Сжатие коллекции ml-service: размер коллекции, recall@k и задержка поиска до и после
+# объединения перефразировок (/compact_collection).
+#
+# ml-service запускается в процессе с хэширующей функцией эмбеддингов. Корпус содержит
+# --paraphrases перефразировок каждого вопроса с одним ответом; набор для оценки - другие
+# перефразировки тех же вопросов (или свой CSV с колонками query и answer, тогда корпус
+# загружается из --corpus-csv с колонками question и answer).
+#
+# Примеры:
+#   python benchmarks/bench_compaction.py --corpus-size 5000 --paraphrases 4
+#   python benchmarks/bench_compaction.py --corpus-csv qa.csv --eval-csv eval.csv --threshold 0.85
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import pandas as pd
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+from bench_retrieval import evaluate, load_eval_set, print_table  # noqa: E402
+from bench_suite import start_ml_service  # noqa: E402
+from corpus import generate_corpus, perturb  # noqa: E402
+
+
+def paraphrased_corpus(size, paraphrases, eval_size, seed):
+    base_questions, base_answers = generate_corpus(size, seed)
+    rng = random.Random(seed)
+    questions, answers = [], []
+    for question, answer in zip(base_questions, base_answers):
+        variants = {question}
+        while len(variants) < paraphrases + 1:
+            variants.add(perturb(question, rng))
+        questions.extend(variants)
+        answers.extend([answer] * len(variants))
+    sample = rng.sample(range(size), min(eval_size, size))
+    eval_set = [(perturb(base_questions[i], rng), base_answers[i]) for i in sample]
+    return questions, answers, eval_set
+
+
+def measure(url, eval_set, modes, ks):
+    with requests.Session() as session:
+        count = session.get(f"{url}/count_items").json()["item_count"]
+        return count, [evaluate(session, url, eval_set, mode, ks) for mode in modes]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recall и задержка поиска до и после сжатия коллекции")
+    parser.add_argument("--corpus-size", type=int, default=5000, help="число исходных вопросов")
+    parser.add_argument("--paraphrases", type=int, default=4, help="перефразировок на вопрос")
+    parser.add_argument("--eval-size", type=int, default=500)
+    parser.add_argument("--corpus-csv", help="корпус с колонками question и answer вместо синтетического")
+    parser.add_argument("--eval-csv", help="набор для оценки с колонками query и answer")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--modes", nargs="+", default=["dense", "hybrid"])
+    parser.add_argument("--threshold", type=float, help="порог косинусной близости (по умолчанию из ml-service)")
+    parser.add_argument("--representatives", type=int, help="записей на кластер (по умолчанию из ml-service)")
+    parser.add_argument("--embedding-dim", type=int, default=312)
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    if args.corpus_csv:
+        df = pd.read_csv(args.corpus_csv)
+        questions, answers = df["question"].astype(str).tolist(), df["answer"].astype(str).tolist()
+        eval_set = []
+    else:
+        questions, answers, eval_set = paraphrased_corpus(args.corpus_size, args.paraphrases, args.eval_size,
+                                                          args.seed)
+    if args.eval_csv:
+        eval_set = load_eval_set(args.eval_csv)
+    if not eval_set:
+        parser.error("--eval-csv is required with --corpus-csv")
+
+    ml_app, server = start_ml_service(SimpleNamespace(retrieval_mode="hybrid", embedding_dim=args.embedding_dim),
+                                      tempfile.mkdtemp(prefix="bench-compaction-"))
+    try:
+        started = time.perf_counter()
+        ml_app.batch_addition(questions, answers)
+        print(f"Seeded {len(questions)} QA pairs in {time.perf_counter() - started:.1f} s")
+
+        count_before, before = measure(server.url, eval_set, args.modes, args.k)
+        print(f"Before compaction: {count_before} records")
+        print_table(before, args.k)
+
+        payload = {key: value for key, value in (("threshold", args.threshold),
+                                                 ("representatives", args.representatives)) if value is not None}
+        report = requests.post(f"{server.url}/compact_collection", json=payload).json()
+        print(f"Compaction: removed {report['records_removed']} records "
+              f"({report['size_reduction']:.1%}) in {report['seconds']} s")
+
+        count_after, after = measure(server.url, eval_set, args.modes, args.k)
+        print(f"After compaction: {count_after} records")
+        print_table(after, args.k)
+    finally:
+        server.stop()
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "compaction": report,
+                       "before": {"records": count_before, "results": before},
+                       "after": {"records": count_after, "results": after}}, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+# Сравнение бэкендов эмбеддингов ml-service (EMBEDDING_BACKEND): скорость, память и
+# качество поиска относительно эталонного fp32 torch-бэкенда.
+#
+# Каждый бэкенд запускается в отдельном процессе, чтобы пиковая память (RSS) не
+# смешивалась. Процесс считает эмбеддинги корпуса вопросов и отложенного набора
+# запросов, а также пропускную способность при разных размерах батча. Затем для
+# каждого запроса ищутся top-k ближайших вопросов корпуса. Совпадение top-k с эталоном
+# (overlap@k) показывает, изменилось ли качество поиска.
+#
+# Примеры:
+#   python benchmarks/bench_embeddings.py --backends torch onnx onnx-int8 --threads 4
+#   python benchmarks/bench_embeddings.py --corpus qa.csv --queries eval.csv --output embeddings.json
+import argparse
+import json
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load_texts(args):
+    from corpus import generate_corpus, perturb
+    import random
+
+    if args.corpus:
+        corpus = pd.read_csv(args.corpus)[args.column].dropna().astype(str).tolist()
+    else:
+        corpus, _ = generate_corpus(args.corpus_size, args.seed)
+    if args.queries:
+        queries = pd.read_csv(args.queries)[args.query_column].dropna().astype(str).tolist()
+    else:
+        # Отложенный набор: перефразированные вопросы корпуса, не совпадающие с ним дословно
+        rng = random.Random(args.seed + 1)
+        queries = [perturb(corpus[rng.randrange(len(corpus))], rng) for _ in range(args.query_count)]
+    return corpus, queries
+
+
+def run_child(backend, workdir):
+    with open(os.path.join(workdir, "args.json")) as f:
+        args = argparse.Namespace(**json.load(f))
+    os.environ["EMBEDDING_BACKEND"] = backend
+    if args.threads:
+        os.environ["EMBEDDING_THREADS"] = str(args.threads)
+    os.environ.setdefault("LOG_LEVEL", "WARNING")
+    sys.path.insert(0, os.path.join(ROOT_DIR, "ml-service"))
+    import app as ml_app
+    if args.model:
+        ml_app.EMBEDDING_MODEL_NAME = args.model
+
+    with open(os.path.join(workdir, "texts.json")) as f:
+        texts = json.load(f)
+    rss_before = rss_mb()
+    started = time.perf_counter()
+    emb_fn = ml_app.create_embedding_function(backend)
+    emb_fn(texts["queries"][:8])
+    load_seconds = time.perf_counter() - started
+
+    started = time.perf_counter()
+    corpus_embeddings = np.asarray(emb_fn(texts["corpus"]), dtype=np.float32)
+    corpus_seconds = time.perf_counter() - started
+    query_embeddings = np.asarray(emb_fn(texts["queries"]), dtype=np.float32)
+
+    throughput = {}
+    sample = texts["queries"][:args.throughput_texts]
+    for batch_size in args.batch_sizes:
+        started = time.perf_counter()
+        for start in range(0, len(sample), batch_size):
+            emb_fn(sample[start:start + batch_size])
+        throughput[str(batch_size)] = round(len(sample) / (time.perf_counter() - started), 1)
+
+    np.save(os.path.join(workdir, f"{backend}.corpus.npy"), corpus_embeddings)
+    np.save(os.path.join(workdir, f"{backend}.queries.npy"), query_embeddings)
+    with open(os.path.join(workdir, f"{backend}.json"), "w") as f:
+        json.dump({
+            "load_s": round(load_seconds, 2),
+            "corpus_embeddings_per_s": round(len(texts["corpus"]) / corpus_seconds, 1),
+            "throughput_per_s": throughput,
+            "rss_model_mb": round(rss_mb() - rss_before, 1),
+            "rss_peak_mb": round(rss_mb(), 1)
+        }, f)
+
+
+def normalize(embeddings):
+    return embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+
+
+def top_k(corpus_embeddings, query_embeddings, k):
+    scores = normalize(query_embeddings) @ normalize(corpus_embeddings).T
+    top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение бэкендов эмбеддингов ml-service")
+    parser.add_argument("--backends", nargs="+", default=["torch", "onnx", "onnx-int8"])
+    parser.add_argument("--reference", default="torch", help="эталонный бэкенд для сравнения качества")
+    parser.add_argument("--model", help="модель или локальный путь вместо EMBEDDING_MODEL_NAME")
+    parser.add_argument("--threads", type=int, default=0, help="EMBEDDING_THREADS, 0 - по умолчанию")
+    parser.add_argument("--corpus", help="CSV с вопросами базы знаний")
+    parser.add_argument("--column", default="question")
+    parser.add_argument("--queries", help="CSV с отложенными запросами")
+    parser.add_argument("--query-column", default="query")
+    parser.add_argument("--corpus-size", type=int, default=5000, help="размер синтетического корпуса")
+    parser.add_argument("--query-count", type=int, default=500, help="число синтетических запросов")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 8, 32, 64])
+    parser.add_argument("--throughput-texts", type=int, default=256)
+    parser.add_argument("--min-overlap", type=float, default=0.95,
+                        help="минимальное overlap@k; если ниже, скрипт завершается с кодом 1")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--workdir", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        run_child(args.child, args.workdir)
+        return
+
+    backends = [args.reference] + [b for b in args.backends if b != args.reference]
+    corpus, queries = load_texts(args)
+    workdir = tempfile.mkdtemp(prefix="bench-embeddings-")
+    with open(os.path.join(workdir, "texts.json"), "w") as f:
+        json.dump({"corpus": corpus, "queries": queries}, f, ensure_ascii=False)
+    with open(os.path.join(workdir, "args.json"), "w") as f:
+        json.dump(vars(args), f)
+    print(f"Corpus: {len(corpus)} questions, held-out queries: {len(queries)}")
+
+    results = {}
+    for backend in backends:
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--child", backend, "--workdir", workdir],
+                       check=True)
+        with open(os.path.join(workdir, f"{backend}.json")) as f:
+            results[backend] = json.load(f)
+
+    reference_corpus = np.load(os.path.join(workdir, f"{args.reference}.corpus.npy"))
+    reference_queries = np.load(os.path.join(workdir, f"{args.reference}.queries.npy"))
+    reference_top = {k: top_k(reference_corpus, reference_queries, k) for k in args.k}
+    failed = False
+    for backend in backends:
+        corpus_embeddings = np.load(os.path.join(workdir, f"{backend}.corpus.npy"))
+        query_embeddings = np.load(os.path.join(workdir, f"{backend}.queries.npy"))
+        cosine = np.sum(normalize(query_embeddings) * normalize(reference_queries), axis=1)
+        results[backend]["cosine_to_reference"] = round(float(cosine.mean()), 5)
+        results[backend]["overlap"] = {}
+        for k in args.k:
+            top = top_k(corpus_embeddings, query_embeddings, k)
+            overlap = np.mean([len(set(a) & set(b)) / k for a, b in zip(top, reference_top[k])])
+            results[backend]["overlap"][str(k)] = round(float(overlap), 4)
+            failed = failed or overlap < args.min_overlap
+
+    reference_speed = results[args.reference]["corpus_embeddings_per_s"]
+    header = f"{'backend':>10} {'load s':>7} {'emb/s':>8} {'speedup':>8} {'RSS MB':>7} {'cosine':>8} " + \
+        " ".join(f"{'ovl@' + str(k):>7}" for k in args.k) + " " + \
+        " ".join(f"{'b=' + str(b) + '/s':>8}" for b in args.batch_sizes)
+    print(header)
+    for backend in backends:
+        r = results[backend]
+        print(f"{backend:>10} {r['load_s']:>7} {r['corpus_embeddings_per_s']:>8} "
+              f"{r['corpus_embeddings_per_s'] / reference_speed:>7.2f}x {r['rss_model_mb']:>7} "
+              f"{r['cosine_to_reference']:>8} " + " ".join(f"{r['overlap'][str(k)]:>7}" for k in args.k) + " " +
+              " ".join(f"{r['throughput_per_s'][str(b)]:>8}" for b in args.batch_sizes))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, ensure_ascii=False, indent=2)
+    if failed:
+        print(f"overlap@k below {args.min_overlap} for at least one backend")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,122 @@
+# Сравнение раскладок промпта outter_api по переиспользованию KV-кэша Ollama.
+#
+# Заглушка Ollama имитирует вычисление промпта с заданной скоростью и хранит KV-кэш
+# последних промптов: заново вычисляется только часть после общего с кэшем префикса.
+# Для каждой раскладки (PROMPT_LAYOUT) прогоняются одинаковые многоходовые диалоги
+# через /api/v1/get_answer_stream/ и по номеру хода выводятся время до первого токена
+# и число заново вычисленных токенов промпта (prompt_eval_count).
+#
+# Пример:
+#   python benchmarks/bench_prompt_layout.py --conversations 8 --turns 6 --prompt-eval-rate 300
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stubs import ServerThread, create_stub_ml_service, create_stub_ollama  # noqa: E402
+
+LAYOUTS = ("context_first", "stable_prefix")
+
+
+async def run_conversation(client: httpx.AsyncClient, api_url: str, index: int, turns: int):
+    history, per_turn = [], []
+    for turn in range(turns):
+        history.append({"role": "user", "content": f"Диалог {index}: как оформить заявку на пропуск, вопрос {turn}?"})
+        started = time.perf_counter()
+        ttft, answer, context = None, [], {}
+        async with client.stream("POST", f"{api_url}/api/v1/get_answer_stream/", json={"history": history}) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if ttft is None and chunk["message"]["content"]:
+                    ttft = time.perf_counter() - started
+                answer.append(chunk["message"]["content"])
+                if chunk["done"]:
+                    context = chunk.get("context") or {}
+        history.append({"role": "assistant", "content": "".join(answer)})
+        per_turn.append({"ttft": ttft, "prompt_eval_count": context.get("prompt_eval_count"),
+                         "prompt_tokens": context.get("prompt_tokens")})
+    return per_turn
+
+
+async def run_layout(api_url: str, conversations: int, turns: int, concurrency: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    async with httpx.AsyncClient(timeout=600) as client:
+        async def one(index):
+            async with semaphore:
+                return await run_conversation(client, api_url, index, turns)
+        return await asyncio.gather(*(one(i) for i in range(conversations)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение раскладок промпта по переиспользованию KV-кэша")
+    parser.add_argument("--conversations", type=int, default=8)
+    parser.add_argument("--turns", type=int, default=6)
+    parser.add_argument("--concurrency", type=int, default=1, help="одновременных диалогов")
+    parser.add_argument("--prompt-eval-rate", type=float, default=300, help="скорость вычисления промпта, токенов/с")
+    parser.add_argument("--kv-slots", type=int, default=4, help="число промптов в KV-кэше заглушки")
+    parser.add_argument("--first-token-latency", type=float, default=0.05)
+    parser.add_argument("--token-latency", type=float, default=0.005)
+    parser.add_argument("--tokens", type=int, default=40)
+    parser.add_argument("--routing", action="store_true",
+                        help="включить маршрутизацию outter_api (ROUTING_ENABLED); по умолчанию все ответы генерирует основная модель")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    ml = ServerThread(create_stub_ml_service(latency=0.01)).start()
+    ollama_app = create_stub_ollama(args.first_token_latency, args.token_latency, args.tokens,
+                                    prompt_eval_rate=args.prompt_eval_rate, kv_slots=args.kv_slots)
+    ollama = ServerThread(ollama_app).start()
+    os.environ.update({
+        "ML_SERVICE_URL": ml.url,
+        "OLLAMA_URL": ollama.url,
+        "SEMANTIC_CACHE_ENABLED": "0",
+        "ROUTING_ENABLED": "1" if args.routing else "0",
+        "LOG_PAYLOAD_SAMPLE_RATE": "0"
+    })
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ui+api"))
+    import outter_api
+    api = ServerThread(outter_api.app).start()
+
+    report = {}
+    try:
+        for layout in LAYOUTS:
+            outter_api.PROMPT_LAYOUT = layout
+            ollama_app.state.kv_cache.clear()
+            conversations = asyncio.run(run_layout(api.url, args.conversations, args.turns, args.concurrency))
+            report[layout] = []
+            for turn in range(args.turns):
+                results = [conversation[turn] for conversation in conversations]
+                report[layout].append({
+                    "turn": turn + 1,
+                    "ttft_ms": statistics.mean(r["ttft"] for r in results) * 1000,
+                    "prompt_eval_count": statistics.mean(r["prompt_eval_count"] for r in results),
+                    "prompt_tokens": statistics.mean(r["prompt_tokens"] for r in results)
+                })
+    finally:
+        api.stop()
+        ollama.stop()
+        ml.stop()
+
+    print(f"{'turn':>4} | " + " | ".join(f"{layout:^34}" for layout in LAYOUTS))
+    print(f"{'':>4} | " + " | ".join(f"{'ttft ms':>10} {'evaluated':>10} {'prompt':>10} " for _ in LAYOUTS))
+    for turn in range(args.turns):
+        print(f"{turn + 1:>4} | " + " | ".join(
+            f"{report[layout][turn]['ttft_ms']:>10.1f} {report[layout][turn]['prompt_eval_count']:>10.0f} "
+            f"{report[layout][turn]['prompt_tokens']:>10.0f} " for layout in LAYOUTS))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"args": vars(args), "results": report}, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+# Сравнение режимов поиска ml-service (dense / sparse / hybrid) по recall@k и задержке.
+#
+# Набор для оценки - CSV с колонками query и answer: запрос считается найденным,
+# если ожидаемый ответ есть среди первых k результатов.
+#
+# Пример:
+#   python benchmarks/bench_retrieval.py eval.csv --url http://localhost:8000 --k 1 3 5
+import argparse
+import json
+import statistics
+import time
+
+import pandas as pd
+import requests
+
+MODES = ("dense", "sparse", "hybrid")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def evaluate(session, url, eval_set, mode, ks):
+    max_k = max(ks)
+    hits = {k: 0 for k in ks}
+    latencies = []
+    for query, expected in eval_set:
+        payload = {"queries": [query], "n_results": max_k, "retrieval_mode": mode}
+        started = time.perf_counter()
+        response = session.post(f"{url}/api/v1/get_answer/", json=payload)
+        latencies.append(time.perf_counter() - started)
+        response.raise_for_status()
+        answers = [r["answer"] for r in response.json()["results"][0]["results"]]
+        for k in ks:
+            if expected in answers[:k]:
+                hits[k] += 1
+    return {
+        "mode": mode,
+        "queries": len(eval_set),
+        **{f"recall@{k}": hits[k] / len(eval_set) for k in ks},
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000
+    }
+
+
+def load_eval_set(path, query_column="query", answer_column="answer"):
+    df = pd.read_csv(path)
+    return list(zip(df[query_column].astype(str), df[answer_column].astype(str)))
+
+
+def print_table(results, ks):
+    header = f"{'mode':>8} " + " ".join(f"{'R@' + str(k):>7}" for k in ks) + f" {'p50, ms':>8} {'p95, ms':>8}"
+    print(header)
+    for r in results:
+        print(f"{r['mode']:>8} " + " ".join(f"{r[f'recall@{k}']:>7.3f}" for k in ks)
+              + f" {r['p50_ms']:>8.1f} {r['p95_ms']:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение режимов поиска ml-service")
+    parser.add_argument("eval_csv", help="CSV с колонками query и answer")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--k", type=int, nargs="+", default=[1, 3, 5])
+    parser.add_argument("--modes", nargs="+", default=list(MODES), choices=MODES)
+    parser.add_argument("--query-column", default="query")
+    parser.add_argument("--answer-column", default="answer")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    eval_set = load_eval_set(args.eval_csv, args.query_column, args.answer_column)
+    with requests.Session() as session:
+        results = [evaluate(session, args.url, eval_set, mode, args.k) for mode in args.modes]
+
+    print_table(results, args.k)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,252 @@
+# Воспроизводимый бенчмарк задержки и пропускной способности всего конвейера.
+#
+# В одном процессе поднимаются ml-service (Chroma во временном каталоге, хэширующая
+# функция эмбеддингов вместо модели), детерминированная заглушка Ollama и outter_api.
+# Корпус вопрос-ответ генерируется с фиксированным seed. Для каждого сценария и уровня
+# параллелизма измеряются p50/p95/p99 задержки, пропускная способность, время до первого
+# токена (для потокового сценария) и память процесса. Результаты пишутся в JSON и могут
+# сравниваться с результатами другого коммита.
+#
+# Примеры:
+#   python benchmarks/bench_suite.py --corpus-size 10000 --output results.json
+#   python benchmarks/bench_suite.py --corpus-size 10000 --compare baseline.json
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from corpus import HashingEmbeddingFunction, generate_conversations, generate_corpus  # noqa: E402
+from stubs import ServerThread, create_stub_ollama  # noqa: E402
+
+SCENARIOS = ("ml_query", "api_answer", "api_stream")
+# Метрики, для которых рост значения - регрессия
+LOWER_IS_BETTER = ("p50_ms", "p95_ms", "p99_ms", "ttft_p50_ms", "ttft_p95_ms")
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+def rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT_DIR,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_ml_service(args, data_dir):
+    os.environ.update({
+        "CHROMA_DB_PATH": data_dir,
+        "STARTUP_MODE": "eager",
+        "LOG_LEVEL": "WARNING",
+        "LOG_PAYLOAD_SAMPLE_RATE": "0",
+        "IMPORT_CHUNK_SIZE": "5000",
+        "RETRIEVAL_MODE": args.retrieval_mode
+    })
+    sys.path.insert(0, os.path.join(ROOT_DIR, "ml-service"))
+    import app as ml_app
+    ml_app.create_embedding_function = lambda: HashingEmbeddingFunction(args.embedding_dim)
+    return ml_app, ServerThread(ml_app.app).start()
+
+
+def start_outter_api(ml_url, ollama_url, args):
+    os.environ.update({
+        "ML_SERVICE_URL": ml_url,
+        "OLLAMA_URL": ollama_url,
+        "SEMANTIC_CACHE_ENABLED": "0",
+        "ROUTING_ENABLED": "1" if args.routing else "0",
+        "LOG_PAYLOAD_SAMPLE_RATE": "0",
+        "LLM_CONCURRENCY": str(max(args.concurrency))
+    })
+    sys.path.insert(0, os.path.join(ROOT_DIR, "ui+api"))
+    import outter_api
+    return ServerThread(outter_api.app).start()
+
+
+async def run_scenario(scenario, urls, payloads, concurrency):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies, ttfts, errors = [], [], 0
+
+    async with httpx.AsyncClient(timeout=600, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one(payload):
+            nonlocal errors
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    if scenario == "ml_query":
+                        response = await client.post(f"{urls['ml']}/api/v1/get_answer/", json=payload)
+                        response.raise_for_status()
+                    elif scenario == "api_answer":
+                        response = await client.post(f"{urls['api']}/api/v1/get_answer/", json=payload)
+                        response.raise_for_status()
+                    else:
+                        ttft = None
+                        async with client.stream("POST", f"{urls['api']}/api/v1/get_answer_stream/",
+                                                 json=payload) as response:
+                            response.raise_for_status()
+                            async for line in response.aiter_lines():
+                                if ttft is None and line and json.loads(line)["message"]["content"]:
+                                    ttft = time.perf_counter() - started
+                        ttfts.append(ttft if ttft is not None else time.perf_counter() - started)
+                except httpx.HTTPError:
+                    errors += 1
+                    return
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(payload) for payload in payloads))
+        wall = time.perf_counter() - started
+
+    result = {
+        "requests": len(payloads),
+        "errors": errors,
+        "wall_s": round(wall, 3),
+        "throughput_rps": round(len(latencies) / wall, 2),
+        "p50_ms": round(percentile(latencies, 50) * 1000, 1) if latencies else None,
+        "p95_ms": round(percentile(latencies, 95) * 1000, 1) if latencies else None,
+        "p99_ms": round(percentile(latencies, 99) * 1000, 1) if latencies else None,
+        "rss_mb": round(rss_mb(), 1)
+    }
+    if ttfts:
+        result["ttft_p50_ms"] = round(percentile(ttfts, 50) * 1000, 1)
+        result["ttft_p95_ms"] = round(percentile(ttfts, 95) * 1000, 1)
+    return result
+
+
+def build_payloads(scenario, conversations):
+    if scenario == "ml_query":
+        # Тот же набор запросов, что формирует outter_api.process_history
+        payloads = []
+        for history in conversations:
+            user_messages = [m["content"] for m in history if m["role"] == "user"][-2:]
+            context = " ".join(m["content"] for m in history[-3:])
+            payloads.append({"queries": user_messages + [context], "n_results": 5})
+        return payloads
+    return [{"history": history} for history in conversations]
+
+
+def compare(results, baseline_path, threshold):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    base = {(r["scenario"], r["turns"], r["concurrency"]): r for r in baseline["results"]}
+    print(f"\nComparison with {baseline_path} (commit {baseline['meta'].get('commit')}):")
+    regressions = 0
+    for r in results:
+        b = base.get((r["scenario"], r["turns"], r["concurrency"]))
+        if b is None:
+            continue
+        changes = []
+        for metric in LOWER_IS_BETTER + ("throughput_rps",):
+            if r.get(metric) is None or not b.get(metric):
+                continue
+            delta = (r[metric] - b[metric]) / b[metric] * 100
+            worse = delta > threshold if metric in LOWER_IS_BETTER else delta < -threshold
+            regressions += worse
+            changes.append(f"{metric} {delta:+.1f}%{' !' if worse else ''}")
+        print(f"  {r['scenario']:>10} turns={r['turns']} c={r['concurrency']}: " + ", ".join(changes))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк задержки и пропускной способности чат-бота")
+    parser.add_argument("--corpus-size", type=int, default=10000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--scenarios", nargs="+", default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--turns", type=int, nargs="+", default=[1, 5], help="число реплик пользователя в диалоге")
+    parser.add_argument("--requests", type=int, default=64, help="число запросов на каждую точку")
+    parser.add_argument("--retrieval-mode", default="dense", choices=["dense", "sparse", "hybrid"])
+    parser.add_argument("--embedding-dim", type=int, default=312)
+    parser.add_argument("--llm-first-token", type=float, default=0.3, help="задержка первого токена заглушки, с")
+    parser.add_argument("--llm-tokens-per-second", type=float, default=50.0)
+    parser.add_argument("--llm-tokens", type=int, default=60)
+    parser.add_argument("--routing", action="store_true",
+                        help="включить маршрутизацию outter_api (ROUTING_ENABLED); по умолчанию все ответы генерирует основная модель")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    parser.add_argument("--compare", help="JSON с результатами другого запуска для сравнения")
+    parser.add_argument("--regression-threshold", type=float, default=10.0, help="допустимое ухудшение, %%")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="bench-chroma-")
+    ml_app, ml_server = start_ml_service(args, data_dir)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    started = time.perf_counter()
+    questions, answers = generate_corpus(args.corpus_size, args.seed)
+    ml_app.batch_addition(questions, answers)
+    seed_seconds = time.perf_counter() - started
+    print(f"Seeded {args.corpus_size} QA pairs in {seed_seconds:.1f} s, RSS {rss_mb():.0f} MB")
+
+    ollama = ServerThread(create_stub_ollama(first_token_latency=args.llm_first_token,
+                                             token_latency=1 / args.llm_tokens_per_second,
+                                             tokens=args.llm_tokens)).start()
+    api = start_outter_api(ml_server.url, ollama.url, args)
+    logging.getLogger().setLevel(logging.WARNING)
+    urls = {"ml": ml_server.url, "api": api.url}
+
+    results = []
+    try:
+        for scenario in args.scenarios:
+            for turns in args.turns:
+                conversations = generate_conversations(questions, answers, args.requests, turns, args.seed)
+                payloads = build_payloads(scenario, conversations)
+                for concurrency in args.concurrency:
+                    result = asyncio.run(run_scenario(scenario, urls, payloads, concurrency))
+                    result.update({"scenario": scenario, "turns": turns, "concurrency": concurrency})
+                    results.append(result)
+                    ttft = f" ttft p50 {result['ttft_p50_ms']} ms" if "ttft_p50_ms" in result else ""
+                    print(f"{scenario:>10} turns={turns:<2} c={concurrency:<3} rps {result['throughput_rps']:>7} "
+                          f"p50 {result['p50_ms']} p95 {result['p95_ms']} p99 {result['p99_ms']} ms{ttft}")
+    finally:
+        api.stop()
+        ollama.stop()
+        ml_server.stop()
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed_seconds": round(seed_seconds, 2),
+            "peak_rss_mb": round(rss_mb(), 1),
+            "args": vars(args)
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+    if args.compare:
+        regressions = compare(results, args.compare, args.regression_threshold)
+        if regressions:
+            print(f"{regressions} metric(s) regressed by more than {args.regression_threshold}%")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,227 @@
+# Пропускная способность ml-service в зависимости от числа воркеров gunicorn.
+#
+# Поднимается сервер Chroma (chroma run) во временном каталоге, корпус загружается
+# один раз через /import/file, затем для каждого числа воркеров запускается
+# gunicorn с ml-service/gunicorn.conf.py и измеряются пропускная способность и
+# задержка запросов /api/v1/get_answer/, а также суммарная память процессов (PSS:
+# страницы модели, общие для воркеров после fork, делятся между ними).
+# С --write-during-load во время нагрузки идёт импорт: проверяется, что чтения
+# не падают, пока единственный писатель меняет коллекцию.
+#
+# Примеры:
+#   python benchmarks/bench_workers.py --workers 1 2 4 --corpus-size 20000
+#   python benchmarks/bench_workers.py --workers 1 4 --embedding model --write-during-load
+import argparse
+import asyncio
+import csv
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import httpx
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+from bench_suite import build_payloads, git_commit, run_scenario  # noqa: E402
+from corpus import generate_conversations, generate_corpus  # noqa: E402
+from stubs import free_port  # noqa: E402
+
+
+def wait_for(url, timeout, process=None):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process is not None and process.poll() is not None:
+            raise RuntimeError(f"Process exited with code {process.returncode} while waiting for {url}")
+        try:
+            if httpx.get(url, timeout=5).status_code == 200:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.5)
+    raise RuntimeError(f"Timed out waiting for {url}")
+
+
+def stop(process):
+    process.terminate()
+    try:
+        process.wait(timeout=60)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+
+def process_tree(pid):
+    pids = [pid]
+    for child in pids:
+        try:
+            with open(f"/proc/{child}/task/{child}/children") as f:
+                pids.extend(int(p) for p in f.read().split())
+        except OSError:
+            continue
+    return pids
+
+
+def pss_mb(pid):
+    # Сумма PSS мастера и воркеров; без /proc (не Linux) возвращается None
+    total = 0
+    for child in process_tree(pid):
+        try:
+            with open(f"/proc/{child}/smaps_rollup") as f:
+                for line in f:
+                    if line.startswith("Pss:"):
+                        total += int(line.split()[1])
+        except OSError:
+            return None
+    return round(total / 1024, 1)
+
+
+def corpus_csv(questions, answers):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(["question", "answer"])
+    writer.writerows(zip(questions, answers))
+    return buffer.getvalue().encode("utf-8")
+
+
+def start_import(url, questions, answers):
+    response = httpx.post(f"{url}/import/file", files={"file": ("corpus.csv", corpus_csv(questions, answers))},
+                          timeout=600)
+    response.raise_for_status()
+    return response.json()["job_id"]
+
+
+def wait_import(url, job_id):
+    while True:
+        job = httpx.get(f"{url}/import/jobs/{job_id}", timeout=60).json()
+        if job["status"] != "running":
+            if job["status"] != "completed":
+                raise RuntimeError(f"Import failed: {job.get('error')}")
+            return job
+        time.sleep(0.5)
+
+
+def start_chroma(command, data_dir, port):
+    process = subprocess.Popen([command, "run", "--path", os.path.join(data_dir, "chroma"), "--port", str(port)],
+                               cwd=data_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    wait_for(f"http://127.0.0.1:{port}/api/v1/heartbeat", 120, process)
+    return process
+
+
+def start_ml_service(args, workers, data_dir, chroma_port):
+    port = free_port()
+    env = dict(os.environ,
+               WEB_CONCURRENCY=str(workers),
+               BIND=f"127.0.0.1:{port}",
+               CHROMA_SERVER=f"127.0.0.1:{chroma_port}",
+               CHROMA_DB_PATH=os.path.join(data_dir, "shared"),
+               STARTUP_MODE="eager",
+               LOG_LEVEL="WARNING",
+               LOG_PAYLOAD_SAMPLE_RATE="0",
+               RETRIEVAL_MODE=args.retrieval_mode,
+               BENCH_EMBEDDING=args.embedding,
+               BENCH_EMBEDDING_DIM=str(args.embedding_dim))
+    if args.model_name:
+        env["BENCH_MODEL_NAME"] = args.model_name
+    if args.threads_per_worker:
+        env["EMBEDDING_THREADS"] = str(args.threads_per_worker)
+    process = subprocess.Popen([sys.executable, "-m", "gunicorn", "-c", os.path.join(ROOT_DIR, "ml-service",
+                                "gunicorn.conf.py"), "--chdir", BENCH_DIR, "worker_app:app"], env=env)
+    url = f"http://127.0.0.1:{port}"
+    wait_for(f"{url}/health/ready", 600, process)
+    # Каждый воркер загружается сам; дожидаемся, пока запросы перестанут упираться в загрузку
+    for _ in range(workers * 4):
+        wait_for(f"{url}/health/ready", 600, process)
+    return process, url
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Масштабирование ml-service по числу воркеров")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--corpus-size", type=int, default=20000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=512)
+    parser.add_argument("--turns", type=int, default=3, help="число реплик пользователя в диалоге")
+    parser.add_argument("--retrieval-mode", default="dense", choices=["dense", "sparse", "hybrid"])
+    parser.add_argument("--embedding", default="hashing", choices=["hashing", "model"],
+                        help="hashing - хэширующая функция из corpus.py, model - настоящая модель ml-service")
+    parser.add_argument("--model-name", help="модель эмбеддингов вместо модели ml-service (для --embedding model)")
+    parser.add_argument("--embedding-dim", type=int, default=312)
+    parser.add_argument("--threads-per-worker", type=int, help="EMBEDDING_THREADS для каждого воркера")
+    parser.add_argument("--write-during-load", action="store_true",
+                        help="импортировать дополнительные пары во время нагрузки")
+    parser.add_argument("--chroma-command", default="chroma", help="команда запуска сервера Chroma")
+    parser.add_argument("--output", help="сохранить результаты в JSON")
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp(prefix="bench-workers-")
+    questions, answers = generate_corpus(args.corpus_size, args.seed)
+    conversations = generate_conversations(questions, answers, args.requests, args.turns, args.seed)
+    payloads = build_payloads("ml_query", conversations)
+    extra_questions, extra_answers = generate_corpus(max(args.corpus_size // 10, 100), args.seed + 1)
+
+    chroma_port = free_port()
+    chroma = start_chroma(args.chroma_command, data_dir, chroma_port)
+    results = []
+    seed_seconds = None
+    try:
+        for workers in args.workers:
+            ml_service, url = start_ml_service(args, workers, data_dir, chroma_port)
+            try:
+                if seed_seconds is None:
+                    started = time.perf_counter()
+                    wait_import(url, start_import(url, questions, answers))
+                    seed_seconds = time.perf_counter() - started
+                    print(f"Seeded {args.corpus_size} QA pairs in {seed_seconds:.1f} s")
+                # Прогрев: лексические индексы и дескрипторы коллекций в каждом воркере
+                asyncio.run(run_scenario("ml_query", {"ml": url}, payloads[:workers * 8], args.concurrency))
+
+                job_id = None
+                if args.write_during_load:
+                    extra = [f"{q} (воркеров: {workers})" for q in extra_questions]
+                    job_id = start_import(url, extra, extra_answers)
+                result = asyncio.run(run_scenario("ml_query", {"ml": url}, payloads, args.concurrency))
+                if job_id:
+                    job = wait_import(url, job_id)
+                    result["imported_during_load"] = job["new_pairs_count"]
+                result.pop("rss_mb")
+                result.update({"workers": workers, "concurrency": args.concurrency,
+                               "pss_mb": pss_mb(ml_service.pid)})
+            finally:
+                stop(ml_service)
+            base = results[0]["throughput_rps"] if results else result["throughput_rps"]
+            result["speedup"] = round(result["throughput_rps"] / base, 2) if base else None
+            results.append(result)
+            print(f"workers={workers:<3} rps {result['throughput_rps']:>7} speedup {result['speedup']:>5} "
+                  f"p50 {result['p50_ms']} p95 {result['p95_ms']} ms errors {result['errors']} "
+                  f"PSS {result['pss_mb']} MB")
+    finally:
+        stop(chroma)
+
+    report = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "seed_seconds": round(seed_seconds, 2) if seed_seconds else None,
+            "args": vars(args)
+        },
+        "results": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
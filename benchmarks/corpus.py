@@ -0,0 +1,77 @@
+# Детерминированные синтетические данные для бенчмарков: корпус вопрос-ответ заданного
+# размера, диалоги пользователей и хэширующая функция эмбеддингов вместо модели,
+# чтобы бенчмарки работали без сети и без загрузки весов.
+import hashlib
+import random
+from typing import Dict, List, Tuple
+
+import numpy as np
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
+
+SUBJECTS = ["пароль", "отпуск", "зарплата", "больничный", "касса", "терминал", "пропуск", "доступ в SAP",
+            "служебная записка", "командировка", "аванс", "личный кабинет", "график смен", "инвентаризация",
+            "заявка в 1С", "почта", "VPN", "принтер", "накладная", "возврат товара"]
+ACTIONS = ["как оформить", "как восстановить", "не работает", "где посмотреть", "как изменить", "ошибка при",
+           "как получить", "кто согласует", "сколько ждать", "как отменить"]
+DETAILS = ["в магазине", "на складе", "в офисе", "через портал", "в мобильном приложении", "у руководителя",
+           "после увольнения", "в выходной день", "для нового сотрудника", "в другом регионе"]
+ANSWER_STEPS = ["Откройте личный кабинет", "Перейдите в раздел заявок", "Заполните форму", "Приложите документы",
+                "Дождитесь согласования руководителя", "Обратитесь в 1ЛТП", "Проверьте статус заявки",
+                "Перезагрузите устройство", "Укажите номер магазина", "Сохраните изменения"]
+
+
+def generate_corpus(size: int, seed: int = 42) -> Tuple[List[str], List[str]]:
+    rng = random.Random(seed)
+    questions, answers = [], []
+    for i in range(size):
+        code = f"{rng.choice('EKMZ')}{rng.randrange(10000):04d}"
+        question = f"{rng.choice(ACTIONS)} {rng.choice(SUBJECTS)} {rng.choice(DETAILS)} код {code} #{i}"
+        steps = rng.sample(ANSWER_STEPS, rng.randint(2, 5))
+        questions.append(question)
+        answers.append(". ".join(steps) + f". Номер инструкции {i}.")
+    return questions, answers
+
+
+def perturb(text: str, rng: random.Random) -> str:
+    # Перефразировка: выбрасываем одно слово и меняем регистр, как в живых обращениях
+    words = text.split()
+    if len(words) > 3:
+        del words[rng.randrange(len(words))]
+    return " ".join(words).lower() if rng.random() < 0.5 else " ".join(words)
+
+
+def generate_conversations(questions: List[str], answers: List[str], count: int, turns: int,
+                           seed: int = 42) -> List[List[Dict[str, str]]]:
+    rng = random.Random(seed)
+    conversations = []
+    for _ in range(count):
+        history = []
+        for turn in range(turns):
+            index = rng.randrange(len(questions))
+            if turn:
+                history.append({"role": "assistant", "content": answers[rng.randrange(len(answers))]})
+            history.append({"role": "user", "content": perturb(questions[index], rng)})
+        conversations.append(history)
+    return conversations
+
+
+class HashingEmbeddingFunction(EmbeddingFunction[Documents]):
+    # Хэширование слов и символьных триграмм в вектор фиксированной размерности;
+    # одинаковый текст всегда даёт одинаковый вектор, похожие тексты - близкие векторы
+
+    def __init__(self, dimension: int = 312):
+        self.dimension = dimension
+
+    def _embed(self, text: str) -> List[float]:
+        vector = np.zeros(self.dimension, dtype=np.float32)
+        text = text.lower()
+        features = text.split() + [text[i:i + 3] for i in range(max(len(text) - 2, 0))]
+        for feature in features:
+            digest = hashlib.md5(feature.encode("utf-8")).digest()
+            bucket = int.from_bytes(digest[:4], "little") % self.dimension
+            vector[bucket] += 1.0 if digest[4] & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def __call__(self, input: Documents) -> Embeddings:
+        return [self._embed(text) for text in input]
@@ -0,0 +1,99 @@
+# Нагрузочный тест outter_api против локальных заглушек ml-service и Ollama.
+#
+# Запускает заглушки и outter_api в одном процессе (один uvicorn worker для API),
+# отправляет запросы к /api/v1/get_answer/ с разной степенью параллелизма и
+# сравнивает пропускную способность. При неблокирующем исходящем I/O время
+# прохождения N параллельных запросов близко ко времени одного запроса.
+#
+# Пример:
+#   python benchmarks/load_test_outter_api.py --requests 64 --concurrency 1 8 32
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from stubs import ServerThread, chat_history, create_stub_ml_service, create_stub_ollama  # noqa: E402
+
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(len(values) - 1, max(0, int(round(p / 100 * len(values))) - 1))
+    return values[index]
+
+
+async def run_level(api_url: str, total: int, concurrency: int, turns: int):
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async with httpx.AsyncClient(timeout=300, limits=httpx.Limits(max_connections=concurrency)) as client:
+        async def one():
+            async with semaphore:
+                started = time.perf_counter()
+                response = await client.post(f"{api_url}/api/v1/get_answer/", json={"history": chat_history(turns)})
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one() for _ in range(total)))
+        wall = time.perf_counter() - started
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "wall_s": wall,
+        "throughput_rps": total / wall,
+        "p50_ms": statistics.median(latencies) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест outter_api")
+    parser.add_argument("--requests", type=int, default=32, help="число запросов на каждый уровень параллелизма")
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 8, 32])
+    parser.add_argument("--turns", type=int, default=3, help="число реплик пользователя в истории")
+    parser.add_argument("--rag-latency", type=float, default=0.05, help="задержка заглушки ml-service, с")
+    parser.add_argument("--llm-first-token", type=float, default=0.2, help="задержка первого токена, с")
+    parser.add_argument("--llm-token-latency", type=float, default=0.005, help="задержка между токенами, с")
+    parser.add_argument("--llm-tokens", type=int, default=40)
+    parser.add_argument("--routing", action="store_true",
+                        help="включить маршрутизацию outter_api (ROUTING_ENABLED); по умолчанию все ответы генерирует основная модель")
+    args = parser.parse_args()
+
+    ml_service = ServerThread(create_stub_ml_service(latency=args.rag_latency)).start()
+    ollama = ServerThread(create_stub_ollama(first_token_latency=args.llm_first_token,
+                                             token_latency=args.llm_token_latency,
+                                             tokens=args.llm_tokens)).start()
+
+    os.environ["ML_SERVICE_URL"] = ml_service.url
+    os.environ["OLLAMA_URL"] = ollama.url
+    os.environ["SEMANTIC_CACHE_ENABLED"] = "0"
+    os.environ["ROUTING_ENABLED"] = "1" if args.routing else "0"
+    os.environ.setdefault("LLM_CONCURRENCY", str(max(args.concurrency)))
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ui+api"))
+    import logging
+    import outter_api
+    logging.getLogger().setLevel(logging.WARNING)
+
+    api = ServerThread(outter_api.app).start()
+    try:
+        results = [asyncio.run(run_level(api.url, args.requests, c, args.turns)) for c in args.concurrency]
+    finally:
+        api.stop()
+        ollama.stop()
+        ml_service.stop()
+
+    base = results[0]["throughput_rps"]
+    print(f"{'concurrency':>11} {'wall, s':>8} {'rps':>8} {'p50, ms':>8} {'p95, ms':>8} {'speedup':>8}")
+    for r in results:
+        print(f"{r['concurrency']:>11} {r['wall_s']:>8.2f} {r['throughput_rps']:>8.1f} "
+              f"{r['p50_ms']:>8.0f} {r['p95_ms']:>8.0f} {r['throughput_rps'] / base:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# Локальные заглушки внешних сервисов (ml-service и Ollama) для нагрузочных тестов.
+# Заглушки повторяют формат ответов настоящих сервисов и имитируют их задержки
+# через asyncio.sleep, поэтому не нагружают CPU и работают без сети.
+import asyncio
+import json
+import math
+import re
+import socket
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class ServerThread:
+    # Запуск uvicorn-сервера в отдельном потоке со своим event loop
+
+    def __init__(self, app: FastAPI, port: Optional[int] = None):
+        self.port = port or free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        config = uvicorn.Config(app, host="127.0.0.1", port=self.port, log_level="warning", access_log=False)
+        self.server = uvicorn.Server(config)
+        self.thread = threading.Thread(target=self.server.run, daemon=True)
+
+    def start(self) -> "ServerThread":
+        self.thread.start()
+        while not self.server.started:
+            time.sleep(0.01)
+        return self
+
+    def stop(self):
+        self.server.should_exit = True
+        self.thread.join(timeout=10)
+
+
+def create_stub_ml_service(latency: float = 0.05, answers: int = 5) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+
+    @app.post("/api/v1/get_answer/")
+    async def get_answer(request: Request):
+        data = await request.json()
+        app.state.requests += 1
+        await asyncio.sleep(latency)
+        results = []
+        for query in data["queries"]:
+            query_results = [
+                {
+                    "id": str(i),
+                    "question": f"Вопрос {i}",
+                    "answer": f"Ответ {i}",
+                    "distance": 0.1 * (i + 1)
+                }
+                for i in range(min(data.get("n_results", 3), answers))
+            ]
+            item = {"query": query, "results": query_results}
+            if data.get("return_embeddings"):
+                item["embedding"] = [float(len(query)), 1.0]
+            results.append(item)
+        return {"results": results, "collection_version": 0}
+
+    return app
+
+
+KEEP_ALIVE_RE = re.compile(r"^(-?\d+(?:\.\d+)?)(ms|s|m|h)?$")
+KEEP_ALIVE_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, None: 1}
+
+
+def parse_keep_alive(value: Any) -> float:
+    # Формат Ollama: число секунд или строка вида "30m"; отрицательное значение - держать всегда
+    match = KEEP_ALIVE_RE.match(str(value if value is not None else "5m"))
+    seconds = float(match.group(1)) * KEEP_ALIVE_UNITS[match.group(2)] if match else 300
+    return math.inf if seconds < 0 else seconds
+
+
+# Заглушка Ollama. Кроме задержек генерации имитирует:
+# - вычисление промпта со скоростью prompt_eval_rate токенов в секунду (0 - без задержки)
+#   с переиспользованием KV-кэша: в kv_slots слотах хранятся последние промпты вместе
+#   с ответами, заново вычисляется только часть промпта после общего префикса;
+# - выгрузку модели по истечении keep_alive из запроса: следующая загрузка занимает load_latency
+def create_stub_ollama(first_token_latency: float = 0.2, token_latency: float = 0.02, tokens: int = 50,
+                       prompt_eval_rate: float = 0, kv_slots: int = 4, load_latency: float = 0) -> FastAPI:
+    app = FastAPI()
+    app.state.requests = 0
+    app.state.kv_cache = []
+    app.state.loaded_until = 0.0
+
+    def chunk(model: str, content: str, done: bool) -> Dict[str, Any]:
+        return {"model": model, "message": {"role": "assistant", "content": content}, "done": done}
+
+    def tokenize(text: str) -> List[str]:
+        return [text[i:i + 4] for i in range(0, len(text), 4)]
+
+    def common_prefix(a: List[str], b: List[str]) -> int:
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    def evaluate_prompt(payload: Dict[str, Any]) -> Dict[str, Any]:
+        now = time.monotonic()
+        load_duration = 0.0
+        if now > app.state.loaded_until:
+            load_duration = load_latency
+            app.state.kv_cache.clear()
+        app.state.loaded_until = math.inf
+
+        # KV-кэш у каждой модели свой, поэтому имя модели входит в префикс
+        prompt = f"<{payload.get('model')}>" + "".join(
+            f"<{msg.get('role')}>{msg.get('content', '')}" for msg in payload.get("messages", []))
+        prompt_tokens = tokenize(prompt)
+        reused = max((common_prefix(prompt_tokens, cached) for cached in app.state.kv_cache), default=0)
+        evaluated = len(prompt_tokens) - reused
+        return {
+            "prompt": prompt,
+            "keep_alive": parse_keep_alive(payload.get("keep_alive")),
+            "load_duration": load_duration,
+            "prompt_eval_count": evaluated,
+            "prompt_eval_duration": evaluated / prompt_eval_rate if prompt_eval_rate else 0.0
+        }
+
+    def finish(state: Dict[str, Any], answer: str) -> Dict[str, Any]:
+        app.state.kv_cache.append(tokenize(state["prompt"] + "<assistant>" + answer))
+        del app.state.kv_cache[:-kv_slots]
+        app.state.loaded_until = time.monotonic() + state["keep_alive"]
+        return {
+            "done_reason": "stop",
+            "eval_count": tokens,
+            "prompt_eval_count": state["prompt_eval_count"],
+            "load_duration": int(state["load_duration"] * 1e9),
+            "prompt_eval_duration": int((first_token_latency + state["prompt_eval_duration"]) * 1e9),
+            "eval_duration": int(token_latency * max(tokens - 1, 1) * 1e9)
+        }
+
+    async def generate(model: str, state: Dict[str, Any]):
+        await asyncio.sleep(state["load_duration"] + first_token_latency + state["prompt_eval_duration"])
+        for i in range(tokens):
+            if i:
+                await asyncio.sleep(token_latency)
+            yield json.dumps(chunk(model, f"т{i} ", False), ensure_ascii=False) + "\n"
+        final = chunk(model, "", True)
+        final.update(finish(state, "".join(f"т{i} " for i in range(tokens))))
+        yield json.dumps(final) + "\n"
+
+    @app.post("/api/chat")
+    async def chat(request: Request):
+        payload = await request.json()
+        app.state.requests += 1
+        model = payload.get("model", "stub")
+        state = evaluate_prompt(payload)
+        if payload.get("stream", True):
+            return StreamingResponse(generate(model, state), media_type="application/x-ndjson")
+        await asyncio.sleep(state["load_duration"] + first_token_latency + state["prompt_eval_duration"]
+                            + token_latency * (tokens - 1))
+        answer = "".join(f"т{i} " for i in range(tokens))
+        response = chunk(model, answer, True)
+        response.update(finish(state, answer))
+        return response
+
+    return app
+
+
+def chat_history(turns: int = 1) -> List[Dict[str, str]]:
+    history = []
+    for i in range(turns):
+        if i:
+            history.append({"role": "assistant", "content": f"Ответ на вопрос {i - 1}"})
+        history.append({"role": "user", "content": f"Как сбросить пароль, попытка {i}?"})
+    return history
@@ -0,0 +1,20 @@
+# Точка входа ml-service для bench_workers.py: то же приложение, но при
+# BENCH_EMBEDDING=hashing вместо модели используется хэширующая функция эмбеддингов,
+# а BENCH_MODEL_NAME позволяет подставить другую (например, локальную) модель
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(BENCH_DIR), "ml-service"))
+sys.path.insert(0, BENCH_DIR)
+import app as ml_app  # noqa: E402
+from corpus import HashingEmbeddingFunction  # noqa: E402
+
+if os.getenv("BENCH_EMBEDDING", "hashing") == "hashing":
+    dimension = int(os.getenv("BENCH_EMBEDDING_DIM", "312"))
+    ml_app.create_embedding_function = lambda backend=None: HashingEmbeddingFunction(dimension)
+
+if os.getenv("BENCH_MODEL_NAME"):
+    ml_app.EMBEDDING_MODEL_NAME = os.environ["BENCH_MODEL_NAME"]
+
+app = ml_app.app
@@ -1,45 +1,385 @@
 import chromadb
 from chromadb.utils import embedding_functions
+from chromadb.api.types import Documents, EmbeddingFunction, Embeddings
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Optional, Literal
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Depends
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 import os
 import requests
 import pandas as pd
 import io
+import csv
 import logging
-import traceback
+import asyncio
+import time
+import re
+import hashlib
+import math
+import heapq
+import pickle
+import threading
+import numpy as np
+from operator import itemgetter
+from array import array
+from collections import defaultdict, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+import tempfile
+import shutil
+import uuid
+import random
+import contextvars
+import json
+import fcntl
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
+
+# Идентификатор запроса: приходит в заголовке X-Request-ID от outter_api
+# (или создаётся заново) и добавляется во все строки лога
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
 
 # Настройка логирования
-logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# Доля запросов, для которых в лог пишутся полные запросы и результаты
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s - %(levelname)s - [%(request_id)s] %(message)s')
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
 logger = logging.getLogger(__name__)
 
-app = FastAPI()
+
+def log_payload(message, payload):
+    if LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logger.info(f"{message}: {payload}")
+
+
+# Метрики Prometheus
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+REQUEST_SECONDS = Histogram("ml_request_duration_seconds", "HTTP request duration",
+                            ["method", "endpoint", "status"], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("ml_stage_duration_seconds", "Duration of query processing stages",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+BATCH_QUERIES = Histogram("ml_query_batch_queries", "Number of query texts per micro-batch",
+                          buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+BATCH_REQUESTS = Histogram("ml_query_batch_requests", "Number of HTTP requests per micro-batch",
+                           buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256))
+EMBEDDING_CACHE_LOOKUPS = Counter("ml_embedding_cache_lookups_total", "Query embedding cache lookups", ["result"])
+
+
+@contextmanager
+def observe_stage(stage):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if STARTUP_MODE == "eager":
+        load_resources()
+    else:
+        threading.Thread(target=load_resources, name="startup-loader", daemon=True).start()
+    await query_batcher.start()
+    try:
+        yield
+    finally:
+        await query_batcher.stop()
+        persist_lexical_indexes()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def request_context(request, call_next):
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        REQUEST_SECONDS.labels(request.method, endpoint, str(status)).observe(time.perf_counter() - started)
+        request_id_var.reset(token)
 os.environ['HF_HUB_DOWNLOAD_TIMEOUT'] = '500'
 
-CHROMA_DB_PATH = './'
-# CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "/app/data/chroma")
+CHROMA_DB_PATH = os.getenv("CHROMA_DB_PATH", "./")
+# Адрес сервера Chroma (host:port). Если задан, воркеры работают с базой через HttpClient,
+# иначе база открывается в процессе (PersistentClient), что допустимо только для одного воркера
+CHROMA_SERVER = os.getenv("CHROMA_SERVER", "")
+# Число воркеров gunicorn (см. gunicorn.conf.py)
+WORKERS = int(os.getenv("WEB_CONCURRENCY", "1"))
 HF_HOME = os.getenv("HF_HOME", "/root/.cache/huggingface")
 
-logger.info(f"Initializing Chroma client with path: {CHROMA_DB_PATH}")
-chroma_client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
-logger.info("Chroma client initialized successfully")
+EMBEDDING_MODEL_NAME = "WpythonW/RUbert-tiny_custom_test_2"
+
+# Бэкенд эмбеддингов: torch - SentenceTransformer в fp32, onnx - та же модель в ONNX Runtime,
+# onnx-int8 - ONNX с динамической int8-квантизацией весов. ONNX-модель экспортируется
+# при первом запуске и сохраняется в ONNX_MODEL_DIR
+EMBEDDING_BACKENDS = ("torch", "onnx", "onnx-int8")
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch")
+if EMBEDDING_BACKEND not in EMBEDDING_BACKENDS:
+    raise ValueError(f"Unknown EMBEDDING_BACKEND: {EMBEDDING_BACKEND}")
+EMBEDDING_THREADS = int(os.getenv("EMBEDDING_THREADS", "0"))  # потоков внутри одной операции, 0 - по числу ядер
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", "64"))
+ONNX_MODEL_DIR = os.getenv("ONNX_MODEL_DIR", os.path.join(HF_HOME, "onnx"))
+
+# Режим запуска: lazy - сервер сразу принимает соединения, а модель и коллекция
+# загружаются в фоне (до готовности эндпоинты отвечают 503); eager - загрузка до старта
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+WARMUP_ON_STARTUP = os.getenv("WARMUP_ON_STARTUP", "1") == "1"
+WARMUP_BATCH_SIZE = int(os.getenv("WARMUP_BATCH_SIZE", "32"))
+
+chroma_client = None
+emb_fn = None
+EMBEDDING_DIMENSION = None
+
+startup_state = {
+    "phase": "starting",
+    "ready": False,
+    "error": None,
+    "timings": {}
+}
+
+
+@contextmanager
+def startup_phase(name):
+    startup_state["phase"] = name
+    started = time.perf_counter()
+    yield
+    elapsed = time.perf_counter() - started
+    startup_state["timings"][name] = round(elapsed, 3)
+    logger.info(f"Startup phase '{name}' finished in {elapsed:.2f} s")
+
+
+def embedding_dimension(collection_metadata=None):
+    if collection_metadata and collection_metadata.get("dimension"):
+        return int(collection_metadata["dimension"])
+    model = getattr(emb_fn, "_model", None)
+    if model is not None and model.get_sentence_embedding_dimension():
+        return model.get_sentence_embedding_dimension()
+    return len(emb_fn(["test"])[0])
+
+
+# Экспорт всей модели SentenceTransformer (трансформер, пулинг, нормализация) в один ONNX-граф,
+# поэтому эмбеддинги совпадают с torch-бэкендом с точностью до округления
+def export_onnx_model(model_name, quantize=False):
+    target = os.path.join(ONNX_MODEL_DIR, model_name.replace("/", "__"))
+    fp32_path = os.path.join(target, "model.onnx")
+    if not os.path.exists(fp32_path):
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        logger.info(f"Exporting {model_name} to ONNX: {fp32_path}")
+        model = SentenceTransformer(model_name, device="cpu").eval()
+
+        class SentenceEmbedding(torch.nn.Module):
+            def __init__(self, input_names):
+                super().__init__()
+                self.model = model
+                self.input_names = input_names
+
+            def forward(self, *inputs):
+                return self.model(dict(zip(self.input_names, inputs)))["sentence_embedding"]
+
+        sample = model.tokenizer(["пример запроса", "ещё один пример запроса"], padding=True, return_tensors="pt")
+        input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+        os.makedirs(target, exist_ok=True)
+        model.tokenizer.save_pretrained(target)
+        with open(os.path.join(target, "embedding_config.json"), "w") as f:
+            json.dump({"max_seq_length": model.max_seq_length, "input_names": input_names,
+                       "pad_token": model.tokenizer.pad_token, "pad_token_id": model.tokenizer.pad_token_id}, f)
+
+        tmp_path = f"{fp32_path}.{os.getpid()}.tmp"
+        dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+        dynamic_axes["sentence_embedding"] = {0: "batch"}
+        with torch.no_grad():
+            torch.onnx.export(SentenceEmbedding(input_names), tuple(sample[name] for name in input_names), tmp_path,
+                              input_names=input_names, output_names=["sentence_embedding"],
+                              dynamic_axes=dynamic_axes, opset_version=14, dynamo=False)
+        os.replace(tmp_path, fp32_path)
+
+    if not quantize:
+        return fp32_path
+    int8_path = os.path.join(target, "model.int8.onnx")
+    if not os.path.exists(int8_path):
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        logger.info(f"Quantizing {fp32_path} to int8: {int8_path}")
+        tmp_path = f"{int8_path}.{os.getpid()}.tmp"
+        quantize_dynamic(fp32_path, tmp_path, weight_type=QuantType.QInt8)
+        os.replace(tmp_path, int8_path)
+    return int8_path
+
+
+# Для инференса нужны только onnxruntime и tokenizers: torch и transformers не загружаются,
+# если модель уже экспортирована
+class OnnxEmbeddingFunction(EmbeddingFunction[Documents]):
+    def __init__(self, model_name, quantize=False, threads=EMBEDDING_THREADS, batch_size=EMBEDDING_BATCH_SIZE):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        path = export_onnx_model(model_name, quantize)
+        with open(os.path.join(os.path.dirname(path), "embedding_config.json")) as f:
+            config = json.load(f)
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=["CPUExecutionProvider"])
+        self.tokenizer = Tokenizer.from_file(os.path.join(os.path.dirname(path), "tokenizer.json"))
+        self.tokenizer.enable_truncation(config["max_seq_length"])
+        self.tokenizer.enable_padding(pad_id=config["pad_token_id"], pad_token=config["pad_token"])
+        self.input_names = config["input_names"]
+        self.batch_size = batch_size
+
+    # Тексты группируются в батчи по длине, чтобы меньше вычислять на паддинге
+    def __call__(self, input: Documents) -> Embeddings:
+        order = sorted(range(len(input)), key=lambda i: len(input[i]))
+        embeddings = [None] * len(input)
+        for start in range(0, len(order), self.batch_size):
+            positions = order[start:start + self.batch_size]
+            encodings = self.tokenizer.encode_batch([input[i] for i in positions])
+            encoded = {
+                "input_ids": [e.ids for e in encodings],
+                "attention_mask": [e.attention_mask for e in encodings],
+                "token_type_ids": [e.type_ids for e in encodings]
+            }
+            feeds = {name: np.array(encoded[name], dtype=np.int64) for name in self.input_names}
+            for i, embedding in zip(positions, self.session.run(None, feeds)[0].tolist()):
+                embeddings[i] = embedding
+        return embeddings
+
+
+def create_embedding_function(backend=None):
+    backend = backend or EMBEDDING_BACKEND
+    logger.info(f"Embedding backend: {backend}, threads: {EMBEDDING_THREADS or 'default'}")
+    if backend != "torch":
+        return OnnxEmbeddingFunction(EMBEDDING_MODEL_NAME, quantize=backend == "onnx-int8")
+    if EMBEDDING_THREADS:
+        import torch
+        torch.set_num_threads(EMBEDDING_THREADS)
+    return embedding_functions.SentenceTransformerEmbeddingFunction(
+        model_name=EMBEDDING_MODEL_NAME,
+    )
+
+
+def warmup(batch_size=WARMUP_BATCH_SIZE):
+    texts = [f"прогрев модели, запрос номер {i}" for i in range(batch_size)]
+    embeddings = emb_fn(texts)
+    # Первый поиск загружает HNSW-индекс коллекции в память
+    with database_lock.read():
+        collection = collection_cache.get()
+        if collection.count():
+            collection.query(query_embeddings=[list(map(float, embeddings[0]))], n_results=1)
+
 
-logger.info("Initializing embedding function")
-emb_fn = embedding_functions.SentenceTransformerEmbeddingFunction(
-    model_name="WpythonW/RUbert-tiny_custom_test_2",
-)
-logger.info("Embedding function initialized successfully")
+def create_chroma_client():
+    if CHROMA_SERVER:
+        host, _, port = CHROMA_SERVER.rpartition(":")
+        logger.info(f"Connecting to Chroma server: {CHROMA_SERVER}")
+        return chromadb.HttpClient(host=host, port=int(port))
+    if WORKERS > 1:
+        raise RuntimeError("PersistentClient cannot be shared by several workers, set CHROMA_SERVER")
+    logger.info(f"Initializing Chroma client with path: {CHROMA_DB_PATH}")
+    return chromadb.PersistentClient(path=CHROMA_DB_PATH)
 
-EMBEDDING_DIMENSION = len(emb_fn("test"))
-logger.info(f"Embedding dimension: {EMBEDDING_DIMENSION}")
 
+# Загрузка модели в мастер-процессе gunicorn до fork (preload_app): воркеры получают
+# веса через copy-on-write и не держат каждый свою копию. Прогон модели до fork не делается,
+# а ONNX Runtime создаёт пулы потоков при загрузке, поэтому его сессия создаётся в воркере
+def preload_embedding_model():
+    global emb_fn
+    if EMBEDDING_BACKEND == "torch":
+        logger.info("Preloading embedding model before forking workers")
+        emb_fn = create_embedding_function()
 
-def get_or_create_collection(name="qa_corpus"):
+
+def load_resources():
+    global chroma_client, emb_fn, EMBEDDING_DIMENSION
+    started = time.perf_counter()
+    try:
+        with startup_phase("chroma_client"):
+            chroma_client = create_chroma_client()
+
+        with startup_phase("embedding_model"):
+            if emb_fn is None:
+                logger.info("Initializing embedding function")
+                emb_fn = create_embedding_function()
+
+        with startup_phase("collection"):
+            try:
+                metadata = open_collection(DEFAULT_COLLECTION_NAME).metadata
+            except ValueError:
+                metadata = None
+            EMBEDDING_DIMENSION = embedding_dimension(metadata)
+            logger.info(f"Embedding dimension: {EMBEDDING_DIMENSION}")
+            with writer_lock():
+                collection = collection_cache.get(create=True)
+
+        if RETRIEVAL_MODE != "dense":
+            with startup_phase("lexical_index"), writer_lock():
+                get_lexical_index(collection)
+                save_lexical_index(collection.name)
+
+        if WARMUP_ON_STARTUP:
+            with startup_phase("warmup"):
+                warmup()
+
+        startup_state["timings"]["total"] = round(time.perf_counter() - started, 3)
+        startup_state["phase"] = "ready"
+        startup_state["ready"] = True
+        logger.info(f"ml-service is ready, startup timings: {startup_state['timings']}")
+    except Exception as e:
+        logger.error(f"Startup failed in phase '{startup_state['phase']}': {str(e)}", exc_info=True)
+        startup_state["error"] = str(e)
+        startup_state["phase"] = "failed"
+        if STARTUP_MODE == "eager":
+            raise
+
+
+def require_ready():
+    if not startup_state["ready"]:
+        raise HTTPException(status_code=503, detail=f"Service is not ready: {startup_state['phase']}")
+
+
+DEFAULT_COLLECTION_NAME = "qa_corpus"
+
+
+# PersistentClient сообщает об отсутствии коллекции через ValueError, а HttpClient -
+# через Exception с текстом ошибки сервера; приводим оба случая к ValueError
+def open_collection(name):
+    try:
+        return chroma_client.get_collection(name=name, embedding_function=emb_fn)
+    except ValueError:
+        raise
+    except Exception as e:
+        if "does not exist" in str(e):
+            raise ValueError(str(e)) from e
+        raise
+
+
+def get_or_create_collection(name=DEFAULT_COLLECTION_NAME):
     logger.info(f"Getting or creating collection: {name}")
     try:
-        collection = chroma_client.get_collection(name=name, embedding_function=emb_fn)
+        collection = open_collection(name)
         logger.info(f"Collection '{name}' retrieved successfully")
         return collection
     except ValueError:
@@ -53,12 +393,181 @@ def get_or_create_collection(name="qa_corpus"):
         return collection
 
 
-default_collection = get_or_create_collection()
+# Изменения базы (импорт, очистка, удаление, сброс) выполняет один писатель: блокировка
+# файла в каталоге данных общая для всех потоков и всех воркеров. Вложенно не берётся
+WRITE_LOCK_PATH = os.path.join(CHROMA_DB_PATH, ".write.lock")
+
+
+@contextmanager
+def writer_lock():
+    os.makedirs(CHROMA_DB_PATH, exist_ok=True)
+    with open(WRITE_LOCK_PATH, "a") as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+# Версии коллекций: увеличиваются при каждом изменении данных, чтобы внешние кэши
+# (семантический кэш outter_api) и другие воркеры могли себя инвалидировать.
+# Хранятся в файле рядом с базой и перечитываются при изменении времени модификации
+class CollectionVersions:
+    def __init__(self, path):
+        self.path = path
+        self.versions = {}
+        self.mtime = None
+        self.lock = threading.Lock()
+
+    def _refresh(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime != self.mtime:
+            with open(self.path) as f:
+                self.versions = json.load(f)
+            self.mtime = mtime
+
+    def get(self, name=None):
+        with self.lock:
+            self._refresh()
+            return self.versions.get(name or DEFAULT_COLLECTION_NAME, 0)
+
+    def names(self):
+        with self.lock:
+            self._refresh()
+            return list(self.versions)
+
+    # Вызывается только под writer_lock
+    def bump(self, names):
+        with self.lock:
+            self._refresh()
+            for name in names:
+                self.versions[name] = self.versions.get(name, 0) + 1
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.versions, f)
+            os.replace(tmp_path, self.path)
+            self.mtime = os.stat(self.path).st_mtime_ns
+
+
+collection_versions = CollectionVersions(os.path.join(CHROMA_DB_PATH, "collection_versions.json"))
+
+
+# Версии коллекций, с которыми работает этот воркер. Если другой воркер изменил коллекцию,
+# дескриптор и лексический индекс сбрасываются и загружаются заново
+seen_versions = {}
+
+
+def bump_collection_version(name=None):
+    name = name or DEFAULT_COLLECTION_NAME
+    collection_versions.bump([name])
+    seen_versions[name] = collection_versions.get(name)
+
+
+def sync_collection(name):
+    version = collection_versions.get(name)
+    if seen_versions.get(name, version) != version:
+        logger.info(f"Collection {name} changed by another worker (version {version}), reloading")
+        collection_cache.invalidate(name)
+        with lexical_indexes_lock:
+            lexical_indexes.pop(name, None)
+    seen_versions[name] = version
+
+
+# Блокировка читатель-писатель для клиента Chroma: поиск, импорт и чтение работают
+# параллельно, а сброс базы и удаление коллекции ждут завершения начатых операций
+# и не пускают новые, пока клиент и дескрипторы коллекций не будут пересозданы
+class RWLock:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                if not self.readers:
+                    self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+database_lock = RWLock()
+
+COLLECTION_CACHE_SIZE = int(os.getenv("COLLECTION_CACHE_SIZE", "64"))
+
+
+# Дескрипторы коллекций переиспользуются между запросами вместо get_collection
+# на каждый запрос; при превышении размера вытесняется давно не использованный
+class CollectionCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.handles = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name=None, create=False):
+        name = name or DEFAULT_COLLECTION_NAME
+        with self.lock:
+            collection = self.handles.get(name)
+            if collection is not None:
+                self.handles.move_to_end(name)
+                return collection
+        # Коллекция по умолчанию создаётся заново, если её удалили
+        if create or name == DEFAULT_COLLECTION_NAME:
+            collection = get_or_create_collection(name)
+        else:
+            collection = open_collection(name)
+        with self.lock:
+            self.handles[name] = collection
+            self.handles.move_to_end(name)
+            while len(self.handles) > self.max_size:
+                self.handles.popitem(last=False)
+        return collection
+
+    def invalidate(self, name):
+        with self.lock:
+            self.handles.pop(name, None)
+
+    def clear(self):
+        with self.lock:
+            self.handles.clear()
+
+
+collection_cache = CollectionCache(COLLECTION_CACHE_SIZE)
 
 
 class Query(BaseModel):
     queries: List[str]
     n_results: int = 3
+    return_embeddings: bool = False
+    retrieval_mode: Optional[Literal["dense", "sparse", "hybrid"]] = None
+    collection: Optional[str] = None
+    collections: Optional[List[str]] = None
 
 
 class GoogleSheetInfo(BaseModel):
@@ -73,150 +582,1210 @@ class BatchAddition(BaseModel):
     collection: Optional[str] = None
 
 
-@app.post("/api/v1/get_answer/")
+# Настройки микробатчинга: запросы, пришедшие в течение окна, эмбеддятся
+# одним батчем и ищутся в Chroma одним вызовом query
+QUERY_BATCHING_ENABLED = os.getenv("QUERY_BATCHING_ENABLED", "1") == "1"
+QUERY_BATCH_WINDOW_MS = float(os.getenv("QUERY_BATCH_WINDOW_MS", "5"))
+QUERY_BATCH_MAX_SIZE = int(os.getenv("QUERY_BATCH_MAX_SIZE", "64"))
+
+
+# Настройки кэша эмбеддингов запросов (ограничение по числу записей и по объёму)
+EMBEDDING_CACHE_ENABLED = os.getenv("EMBEDDING_CACHE_ENABLED", "1") == "1"
+EMBEDDING_CACHE_MAX_ENTRIES = int(os.getenv("EMBEDDING_CACHE_MAX_ENTRIES", "50000"))
+EMBEDDING_CACHE_MAX_BYTES = int(os.getenv("EMBEDDING_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+WHITESPACE_RE = re.compile(r"\s+")
+
+
+def normalize_query(text):
+    text = PUNCTUATION_RE.sub(" ", text.lower().replace("ё", "е"))
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+
+# LRU-кэш эмбеддингов по нормализованному тексту запроса. Векторы хранятся
+# в array('f'), чтобы учитывать и ограничивать реальный объём памяти
+class EmbeddingCache:
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _size(key, vector):
+        return len(key.encode("utf-8")) + vector.itemsize * len(vector)
+
+    def get_many(self, keys):
+        found = {}
+        with self.lock:
+            for key in keys:
+                vector = self.entries.get(key)
+                if vector is None:
+                    self.misses += 1
+                    EMBEDDING_CACHE_LOOKUPS.labels("miss").inc()
+                else:
+                    self.hits += 1
+                    EMBEDDING_CACHE_LOOKUPS.labels("hit").inc()
+                    self.entries.move_to_end(key)
+                    found[key] = vector
+        return found
+
+    def put_many(self, items):
+        with self.lock:
+            for key, vector in items.items():
+                if key in self.entries:
+                    self.bytes -= self._size(key, self.entries.pop(key))
+                self.entries[key] = vector
+                self.bytes += self._size(key, vector)
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                key, vector = self.entries.popitem(last=False)
+                self.bytes -= self._size(key, vector)
+                self.evictions += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": EMBEDDING_CACHE_ENABLED,
+                "entries": len(self.entries),
+                "bytes": self.bytes,
+                "max_entries": self.max_entries,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions
+            }
+
+
+embedding_cache = EmbeddingCache(EMBEDDING_CACHE_MAX_ENTRIES, EMBEDDING_CACHE_MAX_BYTES)
+
+
+def embed_queries(queries):
+    if not EMBEDDING_CACHE_ENABLED:
+        with observe_stage("embedding"):
+            return [list(map(float, emb)) for emb in emb_fn(queries)]
+
+    keys = [normalize_query(q) for q in queries]
+    cached = embedding_cache.get_many(keys)
+
+    # Эмбеддим только промахи, одинаковые после нормализации тексты - один раз
+    missing = {}
+    for key, text in zip(keys, queries):
+        if key not in cached and key not in missing:
+            missing[key] = text
+    if missing:
+        with observe_stage("embedding"):
+            computed = {key: array('f', map(float, emb))
+                        for key, emb in zip(missing, emb_fn(list(missing.values())))}
+        embedding_cache.put_many(computed)
+        cached.update(computed)
+
+    return [cached[key].tolist() for key in keys]
+
+
+# Лексический поиск (BM25) по вопросам: находит точные совпадения кодов ошибок,
+# транзакций SAP и номеров магазинов, которые плохо ловит плотный поиск
+RETRIEVAL_MODES = ("dense", "sparse", "hybrid")
+RETRIEVAL_MODE = os.getenv("RETRIEVAL_MODE", "dense")
+if RETRIEVAL_MODE not in RETRIEVAL_MODES:
+    raise ValueError(f"RETRIEVAL_MODE must be one of {RETRIEVAL_MODES}, got '{RETRIEVAL_MODE}'")
+HYBRID_CANDIDATES = int(os.getenv("HYBRID_CANDIDATES", "20"))  # кандидатов от каждого вида поиска
+RRF_K = int(os.getenv("RRF_K", "60"))
+BM25_K1 = float(os.getenv("BM25_K1", "1.2"))
+BM25_B = float(os.getenv("BM25_B", "0.75"))
+LEXICAL_INDEX_DIR = os.path.join(CHROMA_DB_PATH, "bm25")
+
+TOKEN_RE = re.compile(r"[0-9a-zа-я]+(?:[-_./][0-9a-zа-я]+)*")
+TOKEN_SEPARATORS_RE = re.compile(r"[-_./]")
+CYRILLIC_WORD_RE = re.compile(r"[а-я]+")
+RU_STOPWORDS = frozenset("""
+и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только ее мне было вот от
+меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни быть был него до вас нибудь опять уж
+вам ведь там потом себя ничего ей может они тут где есть надо ней для мы тебя их чем была сам чтоб без
+будто чего раз тоже себе под будет ж тогда кто этот того потому этого какой совсем ним здесь этом один
+почти мой тем чтобы нее сейчас были куда зачем всех никогда можно при наконец два об другой хоть после
+над больше тот через эти нас про всего них какая много разве три эту моя впрочем хорошо свою этой перед
+иногда лучше чуть том нельзя такой им более всегда конечно всю между это мне
+""".split())
+RU_SUFFIXES = sorted("""
+иями ями ами ией ий ый ой ей ем ом ам ах ях ою ею ую юю ая яя ое ее ые ие ых их ого его ому ему ыми ими
+ость ости остью ение ения ением ении ться тся ешь ете ить ать ять ует уют ишь ите ила ило или ала ало
+али ыла ыло ыли ела ело ели ся сь а я о е ы и у ю ь й
+""".split(), key=len, reverse=True)
+
+
+def stem_token(token):
+    if len(token) <= 4 or not CYRILLIC_WORD_RE.fullmatch(token):
+        return token
+    for suffix in RU_SUFFIXES:
+        if token.endswith(suffix) and len(token) - len(suffix) >= 3:
+            return token[:-len(suffix)]
+    return token
+
+
+def tokenize(text):
+    tokens = []
+    for match in TOKEN_RE.finditer(str(text).lower().replace("ё", "е")):
+        token = match.group()
+        parts = TOKEN_SEPARATORS_RE.split(token)
+        # Составные коды (ZMM-001, 1.5.2) индексируются целиком и по частям
+        if len(parts) > 1:
+            tokens.append(token)
+        tokens.extend(stem_token(part) for part in parts if part not in RU_STOPWORDS)
+    return tokens
+
+
+# Инвертированный индекс BM25. Списки документов и частот термов хранятся в array,
+# удалённые документы помечаются и вычищаются при сохранении, если их много
+class BM25Index:
+    FORMAT_VERSION = 1
+
+    def __init__(self, path):
+        self.path = path
+        self.doc_ids = []  # номер документа -> id в Chroma
+        self.doc_index = {}  # id в Chroma -> номер документа
+        self.doc_lengths = array('I')
+        self.postings = {}  # терм -> (array('I') номера документов, array('H') частоты)
+        self.deleted = set()
+        self.total_length = 0
+        self.dirty = False
+        self.lock = threading.RLock()
+
+    @property
+    def size(self):
+        return len(self.doc_index)
+
+    def add(self, ids, texts):
+        with self.lock:
+            for id_, text in zip(ids, texts):
+                if id_ in self.doc_index:
+                    self._delete(id_)
+                tokens = tokenize(text)
+                number = len(self.doc_ids)
+                self.doc_ids.append(id_)
+                self.doc_index[id_] = number
+                self.doc_lengths.append(len(tokens))
+                self.total_length += len(tokens)
+                term_counts = defaultdict(int)
+                for token in tokens:
+                    term_counts[token] += 1
+                for term, count in term_counts.items():
+                    posting = self.postings.get(term)
+                    if posting is None:
+                        posting = self.postings[term] = (array('I'), array('H'))
+                    posting[0].append(number)
+                    posting[1].append(min(count, 65535))
+            self.dirty = True
+
+    def _delete(self, id_):
+        number = self.doc_index.pop(id_, None)
+        if number is not None:
+            self.deleted.add(number)
+            self.total_length -= self.doc_lengths[number]
+
+    def delete(self, ids):
+        with self.lock:
+            for id_ in ids:
+                self._delete(id_)
+            self.dirty = True
+
+    def clear(self):
+        with self.lock:
+            self.doc_ids, self.doc_index, self.postings = [], {}, {}
+            self.doc_lengths = array('I')
+            self.deleted = set()
+            self.total_length = 0
+            self.dirty = True
+
+    def search(self, query, k):
+        with self.lock:
+            n_docs = self.size
+            if not n_docs:
+                return []
+            avg_length = self.total_length / n_docs or 1.0
+            scores = defaultdict(float)
+            for term in set(tokenize(query)):
+                posting = self.postings.get(term)
+                if posting is None:
+                    continue
+                numbers, frequencies = posting
+                df = len(numbers)
+                idf = math.log(1 + (n_docs - df + 0.5) / (df + 0.5))
+                for number, tf in zip(numbers, frequencies):
+                    if number in self.deleted:
+                        continue
+                    norm = BM25_K1 * (1 - BM25_B + BM25_B * self.doc_lengths[number] / avg_length)
+                    scores[number] += idf * tf * (BM25_K1 + 1) / (tf + norm)
+            top = heapq.nlargest(k, scores.items(), key=itemgetter(1))
+            return [(self.doc_ids[number], score) for number, score in top]
+
+    def _compact(self):
+        remap = {}
+        doc_ids, doc_lengths = [], array('I')
+        for number, id_ in enumerate(self.doc_ids):
+            if number not in self.deleted:
+                remap[number] = len(doc_ids)
+                doc_ids.append(id_)
+                doc_lengths.append(self.doc_lengths[number])
+        postings = {}
+        for term, (numbers, frequencies) in self.postings.items():
+            new_numbers, new_frequencies = array('I'), array('H')
+            for number, tf in zip(numbers, frequencies):
+                if number in remap:
+                    new_numbers.append(remap[number])
+                    new_frequencies.append(tf)
+            if new_numbers:
+                postings[term] = (new_numbers, new_frequencies)
+        self.doc_ids, self.doc_lengths, self.postings = doc_ids, doc_lengths, postings
+        self.doc_index = {id_: number for number, id_ in enumerate(doc_ids)}
+        self.deleted = set()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            if len(self.deleted) > 0.2 * len(self.doc_ids):
+                self._compact()
+            state = {
+                "format_version": self.FORMAT_VERSION,
+                "doc_ids": self.doc_ids,
+                "doc_lengths": self.doc_lengths,
+                "postings": self.postings,
+                "deleted": self.deleted,
+                "total_length": self.total_length
+            }
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp_path = f"{self.path}.{os.getpid()}.tmp"
+            with open(tmp_path, "wb") as f:
+                pickle.dump(state, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as f:
+            state = pickle.load(f)
+        if state.get("format_version") != cls.FORMAT_VERSION:
+            raise ValueError(f"Unsupported lexical index format: {state.get('format_version')}")
+        index = cls(path)
+        index.doc_ids = state["doc_ids"]
+        index.doc_lengths = state["doc_lengths"]
+        index.postings = state["postings"]
+        index.deleted = state["deleted"]
+        index.total_length = state["total_length"]
+        index.doc_index = {id_: number for number, id_ in enumerate(index.doc_ids) if number not in index.deleted}
+        return index
+
+
+lexical_indexes = {}
+lexical_indexes_lock = threading.Lock()
+
+
+def lexical_index_path(name):
+    return os.path.join(LEXICAL_INDEX_DIR, f"{name}.pkl")
+
+
+# Вопросы, объединённые с записью при сжатии коллекции, хранятся в её метаданных
+# и ищутся лексическим поиском вместе с основным вопросом
+def alternate_questions(metadata):
+    return json.loads((metadata or {}).get("alternate_questions") or "[]")
+
+
+def merged_ids(metadata):
+    return json.loads((metadata or {}).get("merged_ids") or "[]")
+
+
+def lexical_text(document, metadata):
+    alternates = alternate_questions(metadata)
+    return " ".join([document] + alternates) if alternates else document
+
+
+def rebuild_lexical_index(collection):
+    logger.info(f"Building lexical index for collection {collection.name}")
+    index = BM25Index(lexical_index_path(collection.name))
+    offset = 0
+    while True:
+        page = collection.get(include=['documents', 'metadatas'], limit=CHROMA_WRITE_BATCH_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        index.add(page['ids'], [lexical_text(document, metadata)
+                                for document, metadata in zip(page['documents'], page['metadatas'])])
+        offset += len(page['ids'])
+    # На диск индекс пишется только под writer_lock: в операциях записи и в persist_lexical_indexes
+    index.dirty = True
+    logger.info(f"Lexical index for collection {collection.name} built: {index.size} documents")
+    return index
+
+
+# Индекс загружается с диска; полная перестройка нужна, только если файла нет
+# или число документов в нём не совпадает с коллекцией
+def get_lexical_index(collection):
+    with lexical_indexes_lock:
+        index = lexical_indexes.get(collection.name)
+        if index is None:
+            path = lexical_index_path(collection.name)
+            if os.path.exists(path):
+                try:
+                    index = BM25Index.load(path)
+                except Exception as e:
+                    logger.error(f"Error loading lexical index {path}: {str(e)}", exc_info=True)
+            if index is None or index.size != collection.count():
+                index = rebuild_lexical_index(collection)
+            lexical_indexes[collection.name] = index
+        return index
+
+
+def save_lexical_index(name):
+    index = lexical_indexes.get(name)
+    if index is not None:
+        index.save()
+
+
+# Сохранение индексов, перестроенных при поиске. Индекс пишется, только если коллекция
+# не менялась после того, как воркер его построил, иначе он затёр бы более новый файл
+def persist_lexical_indexes():
+    with writer_lock():
+        for name in list(lexical_indexes):
+            version = collection_versions.get(name)
+            if seen_versions.get(name, version) == version:
+                save_lexical_index(name)
+
+
+def drop_lexical_index(name):
+    with lexical_indexes_lock:
+        lexical_indexes.pop(name, None)
+        path = lexical_index_path(name)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    scores = defaultdict(float)
+    for ranking in rankings:
+        for rank, id_ in enumerate(ranking, 1):
+            scores[id_] += 1 / (k + rank)
+    return sorted(scores, key=scores.get, reverse=True), scores
+
+
+def cosine_distance(a, b):
+    a, b = np.asarray(a, dtype=np.float32), np.asarray(b, dtype=np.float32)
+    return float(1 - np.dot(a, b) / ((np.linalg.norm(a) * np.linalg.norm(b)) or 1.0))
+
+
+def run_queries(collection, queries, query_embeddings, n_results, modes=None):
+    modes = modes or [RETRIEVAL_MODE] * len(queries)
+    candidates = n_results if all(mode == "dense" for mode in modes) else max(n_results, HYBRID_CANDIDATES)
+
+    per_query = [{"embedding": embedding} for embedding in query_embeddings]
+    dense_positions = [i for i, mode in enumerate(modes) if mode != "sparse"]
+    if dense_positions:
+        with observe_stage("chroma_search"):
+            results = collection.query(
+                query_embeddings=[query_embeddings[i] for i in dense_positions],
+                n_results=candidates,
+                include=['metadatas', 'documents', 'distances']
+            )
+        for j, i in enumerate(dense_positions):
+            per_query[i].update({
+                "ids": results['ids'][j],
+                "documents": results['documents'][j] if results['documents'] else None,
+                "metadatas": results['metadatas'][j] if results['metadatas'] else None,
+                "distances": results['distances'][j] if results['distances'] else None,
+                "scores": None
+            })
+
+    sparse_positions = [i for i, mode in enumerate(modes) if mode != "dense"]
+    if not sparse_positions:
+        return per_query
+
+    index = get_lexical_index(collection)
+    rankings = {}
+    for i in sparse_positions:
+        with observe_stage("lexical_search"):
+            hits = index.search(queries[i], candidates)
+        if modes[i] == "sparse":
+            rankings[i] = ([id_ for id_, _ in hits], dict(hits))
+        else:
+            rankings[i] = reciprocal_rank_fusion([per_query[i]["ids"], [id_ for id_, _ in hits]])
+
+    # Документы и расстояния для найденных только лексическим поиском берутся из Chroma одним запросом
+    known = {}
+    for i in dense_positions:
+        result = per_query[i]
+        for j, id_ in enumerate(result["ids"]):
+            known[(i, id_)] = (result["documents"][j] if result["documents"] else None,
+                               result["metadatas"][j] if result["metadatas"] else None,
+                               result["distances"][j] if result["distances"] else None)
+    missing = sorted({id_ for i in sparse_positions for id_ in rankings[i][0][:candidates]
+                      if (i, id_) not in known})
+    stored = {}
+    if missing:
+        with observe_stage("fetch_documents"):
+            records = collection.get(ids=missing, include=['documents', 'metadatas', 'embeddings'])
+        for id_, document, metadata, embedding in zip(records['ids'], records['documents'],
+                                                       records['metadatas'], records['embeddings']):
+            stored[id_] = (document, metadata, embedding)
+
+    for i in sparse_positions:
+        order, scores = rankings[i]
+        result = {"ids": [], "documents": [], "metadatas": [], "distances": [], "scores": [],
+                  "embedding": query_embeddings[i]}
+        for id_ in order[:candidates]:
+            if (i, id_) in known:
+                document, metadata, distance = known[(i, id_)]
+            elif id_ in stored:
+                document, metadata, embedding = stored[id_]
+                distance = cosine_distance(query_embeddings[i], embedding)
+            else:
+                continue
+            result["ids"].append(id_)
+            result["documents"].append(document)
+            result["metadatas"].append(metadata)
+            result["distances"].append(distance)
+            result["scores"].append(scores[id_])
+        per_query[i] = result
+    return per_query
+
+
+def search_collection(name, queries, query_embeddings, n_results, modes):
+    sync_collection(name)
+    with database_lock.read():
+        return run_queries(collection_cache.get(name), queries, query_embeddings, n_results, modes)
+
+
+# Гистограмма Prometheus в виде словаря для JSON-эндпоинтов: накопительные счётчики по границам корзин
+def histogram_summary(histogram):
+    summary = {"buckets": {}, "count": 0, "sum": 0.0}
+    for metric in histogram.collect():
+        for sample in metric.samples:
+            if sample.name.endswith("_bucket"):
+                summary["buckets"][sample.labels["le"]] = int(sample.value)
+            elif sample.name.endswith("_count"):
+                summary["count"] = int(sample.value)
+            elif sample.name.endswith("_sum"):
+                summary["sum"] = sample.value
+    return summary
+
+
+class PendingQuery:
+    def __init__(self, queries, n_results, mode, collection, future):
+        self.queries = queries
+        self.n_results = n_results
+        self.mode = mode
+        self.collection = collection
+        self.future = future
+        self.enqueued_at = time.perf_counter()
+
+
+# Объединяет одновременные запросы: первый запрос открывает окно QUERY_BATCH_WINDOW_MS,
+# все запросы, пришедшие за это время (но не более QUERY_BATCH_MAX_SIZE текстов),
+# обрабатываются одним батчем в пуле потоков: эмбеддинги считаются один раз на весь батч,
+# поиск по разным коллекциям выполняется параллельно
+class QueryBatcher:
+    def __init__(self, window_ms, max_size):
+        self.window = window_ms / 1000
+        self.max_size = max_size
+        self.queue = None
+        self.task = None
+
+    async def start(self):
+        if QUERY_BATCHING_ENABLED:
+            self.queue = asyncio.Queue()
+            self.task = asyncio.create_task(self._run())
+            logger.info(f"Query batcher started: window {self.window * 1000} ms, max batch {self.max_size}")
+
+    async def stop(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    async def submit(self, queries, n_results, mode=RETRIEVAL_MODE, collection=DEFAULT_COLLECTION_NAME):
+        loop = asyncio.get_running_loop()
+        if self.task is None:
+            query_embeddings = await loop.run_in_executor(None, embed_queries, queries)
+            return await loop.run_in_executor(None, search_collection, collection, queries, query_embeddings,
+                                              n_results, [mode] * len(queries))
+        future = loop.create_future()
+        await self.queue.put(PendingQuery(queries, n_results, mode, collection, future))
+        return await future
+
+    async def _collect(self):
+        loop = asyncio.get_running_loop()
+        batch = [await self.queue.get()]
+        size = len(batch[0].queries)
+        deadline = loop.time() + self.window
+        while size < self.max_size:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(self.queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            size += len(item.queries)
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            queries = [q for item in batch for q in item.queries]
+            BATCH_QUERIES.observe(len(queries))
+            BATCH_REQUESTS.observe(len(batch))
+            started = time.perf_counter()
+            for item in batch:
+                STAGE_SECONDS.labels("batch_wait").observe(started - item.enqueued_at)
+            try:
+                query_embeddings = await loop.run_in_executor(None, embed_queries, queries)
+            except Exception as e:
+                for item in batch:
+                    if not item.future.done():
+                        item.future.set_exception(e)
+                continue
+
+            groups = defaultdict(list)
+            offset = 0
+            for item in batch:
+                groups[item.collection].append((item, query_embeddings[offset:offset + len(item.queries)]))
+                offset += len(item.queries)
+            outcomes = await asyncio.gather(*(
+                loop.run_in_executor(
+                    None, search_collection, name,
+                    [q for item, _ in items for q in item.queries],
+                    [emb for _, embeddings in items for emb in embeddings],
+                    max(item.n_results for item, _ in items),
+                    [item.mode for item, _ in items for _ in item.queries]
+                )
+                for name, items in groups.items()
+            ), return_exceptions=True)
+            logger.debug(f"Processed batch of {len(batch)} requests ({len(queries)} queries, "
+                         f"{len(groups)} collections) in {(time.perf_counter() - started) * 1000:.1f} ms")
+
+            for items, results in zip(groups.values(), outcomes):
+                offset = 0
+                for item, _ in items:
+                    item_results = None if isinstance(results, Exception) \
+                        else results[offset:offset + len(item.queries)]
+                    offset += len(item.queries)
+                    if item.future.done():
+                        continue
+                    if item_results is None:
+                        item.future.set_exception(results)
+                        continue
+                    for result in item_results:
+                        for key in ("ids", "documents", "metadatas", "distances", "scores"):
+                            if result[key] is not None:
+                                result[key] = result[key][:item.n_results]
+                    item.future.set_result(item_results)
+
+    def stats(self):
+        return {
+            "enabled": self.task is not None,
+            "window_ms": self.window * 1000,
+            "max_batch_size": self.max_size,
+            "queries_per_batch": histogram_summary(BATCH_QUERIES),
+            "requests_per_batch": histogram_summary(BATCH_REQUESTS)
+        }
+
+
+query_batcher = QueryBatcher(QUERY_BATCH_WINDOW_MS, QUERY_BATCH_MAX_SIZE)
+
+
+def format_results(result, collection_name):
+    query_results = []
+    for j in range(len(result['ids'])):
+        item = {
+            "id": result['ids'][j],
+            "question": result['documents'][j] if result['documents'] else "No question available",
+            "answer": result['metadatas'][j].get("answer", "No answer available") if result[
+                'metadatas'] else "No answer available",
+            "distance": result['distances'][j] if result['distances'] else None,
+            "collection": collection_name
+        }
+        if result['scores']:
+            item["score"] = result['scores'][j]
+        query_results.append(item)
+    return query_results
+
+
+# Результаты одной коллекции уже упорядочены поиском (по расстоянию, BM25 или RRF) и не пересортировываются.
+# Несколько коллекций объединяются по расстоянию в режиме dense, иначе - по убыванию score
+def merge_results(results, n_results, mode):
+    if len(results) == 1:
+        return results[0][:n_results]
+    merged = [item for query_results in results for item in query_results]
+    if mode == "dense":
+        merged.sort(key=lambda item: item["distance"] if item["distance"] is not None else math.inf)
+    else:
+        merged.sort(key=lambda item: item.get("score") if item.get("score") is not None else -math.inf,
+                    reverse=True)
+    return merged[:n_results]
+
+
+@app.post("/api/v1/get_answer/", dependencies=[Depends(require_ready)])
 async def query(query_data: Query):
-    logger.info(f"Received query: {query_data}")
+    log_payload("Received query", query_data)
+    names = list(dict.fromkeys(query_data.collections or [query_data.collection or DEFAULT_COLLECTION_NAME]))
+    for name in names:
+        sync_collection(name)
+        try:
+            collection_cache.get(name)
+        except ValueError:
+            raise HTTPException(status_code=404, detail=f"Collection {name} not found")
     try:
-        results = default_collection.query(
-            query_texts=query_data.queries,
-            n_results=query_data.n_results,
-            include=['metadatas', 'documents', 'distances']
-        )
+        # По нескольким коллекциям поиск идёт параллельно, результаты объединяются в merge_results
+        mode = query_data.retrieval_mode or RETRIEVAL_MODE
+        per_collection = await asyncio.gather(*(
+            query_batcher.submit(query_data.queries, query_data.n_results, mode, name)
+            for name in names
+        ))
 
         formatted_results = []
         for i, query in enumerate(query_data.queries):
-            query_results = []
-            for j in range(len(results['ids'][i])):
-                result = {
-                    "id": results['ids'][i][j],
-                    "question": results['documents'][i][j] if results['documents'] else "No question available",
-                    "answer": results['metadatas'][i][j].get("answer", "No answer available") if results[
-                        'metadatas'] else "No answer available",
-                    "distance": results['distances'][i][j] if results['distances'] else None
-                }
-                query_results.append(result)
-
-            formatted_results.append({
+            formatted_query = {
                 "query": query,
-                "results": query_results
-            })
+                "results": merge_results(
+                    [format_results(results[i], name) for name, results in zip(names, per_collection)],
+                    query_data.n_results, mode
+                )
+            }
+            if query_data.return_embeddings:
+                formatted_query["embedding"] = per_collection[0][i]['embedding']
+            formatted_results.append(formatted_query)
 
-        logger.info(f"Query results: {formatted_results}")
-        return {"results": formatted_results}
+        log_payload("Query results", formatted_results)
+        if len(names) == 1:
+            version = collection_versions.get(names[0])
+        else:
+            version = ",".join(f"{name}:{collection_versions.get(name)}" for name in sorted(names))
+        return {
+            "results": formatted_results,
+            "collection_version": version
+        }
     except Exception as e:
         logger.error(f"Error processing query: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error processing query: {str(e)}")
 
 
-def batch_addition(questions, answers, collection_name=None):
-    logger.info(f"Adding batch of {len(questions)} questions to collection: {collection_name or 'default'}")
-    collection = get_or_create_collection(collection_name) if collection_name else default_collection
+# Максимальный размер одного запроса на чтение/запись в Chroma
+CHROMA_WRITE_BATCH_SIZE = int(os.getenv("CHROMA_WRITE_BATCH_SIZE", "5000"))
+
+# Настройки потокового импорта: CSV читается кусками по IMPORT_CHUNK_SIZE строк,
+# эмбеддинги следующего куска считаются в пуле потоков, пока текущий пишется в Chroma
+IMPORT_CHUNK_SIZE = int(os.getenv("IMPORT_CHUNK_SIZE", "1000"))
+IMPORT_EMBED_WORKERS = int(os.getenv("IMPORT_EMBED_WORKERS", "2"))
+IMPORT_LOCAL_DIR = os.path.abspath(os.getenv("IMPORT_LOCAL_DIR", "./import"))
+
+import_executor = ThreadPoolExecutor(max_workers=IMPORT_EMBED_WORKERS, thread_name_prefix="import-embed")
+
+
+# Идентификатор записи - хэш нормализованного вопроса: одинаковые вопросы
+# получают одинаковый id, поэтому дубликаты находятся поиском по id без чтения всей коллекции
+def question_id(question):
+    return hashlib.sha1(normalize_query(str(question)).encode("utf-8")).hexdigest()
 
-    existing_docs = collection.get(include=['documents'])
-    existing_questions = set(existing_docs['documents'])
 
-    unique_questions = {}
-    questions_to_add = []
-    answers_to_add = []
+QUESTION_ID_RE = re.compile(r"^[0-9a-f]{40}$")
+migrated_collections = set()
 
+
+# Коллекции, заполненные до перехода на хэш-идентификаторы, хранят позиционные id ("0", "1", ...),
+# и повторный импорт той же таблицы продублировал бы все записи. Перед первым импортом такие
+# записи переключаются на id по хэшу вопроса: векторы копируются, модель не вызывается.
+# Если у вопроса уже есть запись (более ранняя или с хэш-id), старая запись удаляется как дубликат.
+# Проверяются все id (без документов и векторов); коллекция, уже проверенная этим процессом,
+# пропускается: новые записи получают только хэш-id
+def migrate_positional_ids(collection):
+    if collection.name in migrated_collections:
+        return 0
+    legacy = []
+    offset = 0
+    while True:
+        page = collection.get(include=[], limit=CHROMA_WRITE_BATCH_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        legacy.extend(id_ for id_ in page['ids'] if not QUESTION_ID_RE.match(id_))
+        offset += len(page['ids'])
+    if not legacy:
+        migrated_collections.add(collection.name)
+        return 0
+    legacy.sort(key=lambda id_: (len(id_), id_))
+    logger.warning(f"Collection {collection.name} has {len(legacy)} records with positional ids, "
+                   f"re-keying them by question hash")
+
+    index = get_lexical_index(collection)
+    for start in range(0, len(legacy), CHROMA_WRITE_BATCH_SIZE):
+        chunk_ids = legacy[start:start + CHROMA_WRITE_BATCH_SIZE]
+        records = collection.get(ids=chunk_ids, include=['embeddings', 'documents', 'metadatas'])
+        by_id = dict(zip(records['ids'], zip(records['documents'], records['embeddings'], records['metadatas'])))
+        targets = OrderedDict()
+        for id_ in chunk_ids:
+            if id_ in by_id:
+                targets.setdefault(question_id(by_id[id_][0]), id_)
+        existing = set(collection.get(ids=list(targets), include=[])['ids'])
+        moved = {new_id: old_id for new_id, old_id in targets.items() if new_id not in existing}
+        if moved:
+            documents, embeddings, metadatas = zip(*(by_id[old_id] for old_id in moved.values()))
+            collection.add(ids=list(moved), documents=list(documents), embeddings=list(embeddings),
+                           metadatas=list(metadatas))
+            index.add(list(moved), [lexical_text(document, metadata)
+                                    for document, metadata in zip(documents, metadatas)])
+        collection.delete(ids=chunk_ids)
+        index.delete(chunk_ids)
+    save_lexical_index(collection.name)
+    bump_collection_version(collection.name)
+    migrated_collections.add(collection.name)
+    return len(legacy)
+
+
+# id вопросов, удалённых при сжатии коллекции -> id записи, в которую они объединены.
+# Читаются только записи с полем merged_ids, а не вся коллекция
+def load_merged_aliases(collection):
+    aliases = {}
+    offset = 0
+    while True:
+        page = collection.get(where={"merged_ids": {"$ne": ""}}, include=['metadatas'],
+                              limit=CHROMA_WRITE_BATCH_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        for id_, metadata in zip(page['ids'], page['metadatas']):
+            aliases.update((alias, id_) for alias in merged_ids(metadata))
+        offset += len(page['ids'])
+    return aliases
+
+
+# Повторы вопроса в одном импорте: текст вопроса остаётся от первого вхождения, ответ - от
+# последнего. Счётчики считаются по вопросам, а не по записям в Chroma: вопрос новый, если его
+# не было до импорта, и обновлённый, если итоговый ответ отличается от ответа до импорта,
+# остальные строки - дубликаты. Поэтому счётчики не зависят от разбиения на куски.
+# seen - состояние вопросов этого импорта: id -> [хэш ответа до импорта (None - новый), хэш
+# последнего ответа]. pending - ответы ещё не записанного предыдущего куска (id -> ответ), с ними
+# сравнивается вместо Chroma. Вопрос, объединённый при сжатии с другой записью, считается
+# строкой этой записи: с тем же ответом он дубликат, с изменённым - обновляет её ответ
+def plan_batch(collection, questions, answers, pending=None, aliases=None, seen=None):
+    pending = pending or {}
+    aliases = aliases or {}
+    seen = {} if seen is None else seen
+    batch = OrderedDict()
     for question, answer in zip(questions, answers):
-        if question not in existing_questions and question not in unique_questions:
-            questions_to_add.append(question)
-            answers_to_add.append({"answer": answer})
-            unique_questions[question] = True
-
-    if questions_to_add:
-        new_ids = [str(i) for i in range(len(existing_questions), len(existing_questions) + len(questions_to_add))]
-        logger.info(f"Adding {len(questions_to_add)} new question-answer pairs")
+        id_ = question_id(question)
+        id_ = aliases.get(id_, id_)
+        batch[id_] = (batch[id_][0] if id_ in batch else question, answer)
+    final_answers = {id_: answer for id_, (_, answer) in batch.items()}
+
+    plan = {
+        "rows": len(questions),
+        "add_ids": [], "add_questions": [], "add_metadatas": [],
+        "update_ids": [], "update_metadatas": [],
+        "updated": 0
+    }
+
+    for id_, (_, answer) in list(batch.items()):
+        if id_ in pending:
+            del batch[id_]
+            if pending[id_] != answer:
+                plan["update_ids"].append(id_)
+                plan["update_metadatas"].append({"answer": answer})
+
+    batch_ids = list(batch)
+    existing_answers = {}
+    for start in range(0, len(batch_ids), CHROMA_WRITE_BATCH_SIZE):
+        chunk_ids = batch_ids[start:start + CHROMA_WRITE_BATCH_SIZE]
+        existing = collection.get(ids=chunk_ids, include=['metadatas'])
+        existing_answers.update(
+            (id_, (metadata or {}).get("answer"))
+            for id_, metadata in zip(existing['ids'], existing['metadatas'] or [])
+        )
+
+        for id_ in chunk_ids:
+            question, answer = batch[id_]
+            if id_ not in existing_answers:
+                plan["add_ids"].append(id_)
+                plan["add_questions"].append(question)
+                plan["add_metadatas"].append({"answer": answer})
+            elif existing_answers[id_] != answer:
+                plan["update_ids"].append(id_)
+                plan["update_metadatas"].append({"answer": answer})
+
+    # Вопросы, которых нет в seen, встречаются впервые: ни в Chroma, ни в pending их этот импорт ещё не менял
+    for id_, answer in final_answers.items():
+        state = seen.get(id_)
+        if state is None:
+            before = existing_answers.get(id_)
+            state = seen[id_] = [None if before is None else hash(before)] * 2
+        was_updated = state[0] is not None and state[1] != state[0]
+        state[1] = hash(answer)
+        plan["updated"] += (state[0] is not None and state[1] != state[0]) - was_updated
+
+    return plan
+
+
+def embed_documents(documents):
+    if not documents:
+        return []
+    with observe_stage("import_embedding"):
+        return [list(map(float, emb)) for emb in emb_fn(documents)]
+
+
+def apply_batch(collection, plan, embeddings):
+    index = get_lexical_index(collection) if plan["add_ids"] else None
+    for start in range(0, len(plan["add_ids"]), CHROMA_WRITE_BATCH_SIZE):
+        end = start + CHROMA_WRITE_BATCH_SIZE
         collection.add(
-            documents=questions_to_add,
-            metadatas=answers_to_add,
-            ids=new_ids
+            documents=plan["add_questions"][start:end],
+            metadatas=plan["add_metadatas"][start:end],
+            embeddings=embeddings[start:end],
+            ids=plan["add_ids"][start:end]
         )
+        index.add(plan["add_ids"][start:end], plan["add_questions"][start:end])
+    # Изменился только ответ - вопрос и его эмбеддинг остаются прежними
+    for start in range(0, len(plan["update_ids"]), CHROMA_WRITE_BATCH_SIZE):
+        end = start + CHROMA_WRITE_BATCH_SIZE
+        collection.update(ids=plan["update_ids"][start:end], metadatas=plan["update_metadatas"][start:end])
+
+
+# Конвейер импорта: эмбеддинги куска k+1 считаются в пуле потоков, пока кусок k
+# записывается в Chroma. План куска k+1 сверяется с ответами ещё не записанного куска k,
+# поэтому повтор вопроса не добавляется дважды, а итоговые ответы и счётчики не зависят
+# от IMPORT_CHUNK_SIZE
+def import_chunks(chunks, collection_name=None, job=None):
+    with writer_lock():
+        return _import_chunks(chunks, collection_name, job)
+
+
+def _import_chunks(chunks, collection_name=None, job=None):
+    # Индекс в памяти воркера мог устареть после записи другим воркером: он перечитывается,
+    # чтобы сохранение в конце импорта не затёрло файл устаревшей копией
+    sync_collection(collection_name or DEFAULT_COLLECTION_NAME)
+    with database_lock.read():
+        collection = collection_cache.get(collection_name, create=True)
+        migrate_positional_ids(collection)
+        aliases = load_merged_aliases(collection)
+    totals = {"rows": 0, "added": 0, "updated": 0, "writes": 0}
+    # Состояние всех вопросов импорта (см. plan_batch), чтобы счётчики не зависели от IMPORT_CHUNK_SIZE
+    seen = {}
+
+    def write(plan, embeddings_future):
+        embeddings = embeddings_future.result()
+        with observe_stage("import_write"), database_lock.read():
+            apply_batch(collection, plan, embeddings)
+        totals["rows"] += plan["rows"]
+        totals["added"] += len(plan["add_ids"])
+        totals["updated"] += plan["updated"]
+        totals["writes"] += len(plan["add_ids"]) + len(plan["update_ids"])
+        if job is not None:
+            job.update(rows_processed=totals["rows"], new_pairs_count=totals["added"],
+                       updated_pairs_count=totals["updated"], chunks_processed=job["chunks_processed"] + 1)
+            save_import_job(job)
+
+    pending = None
+    try:
+        for questions, answers in chunks:
+            pending_answers = {} if pending is None else {
+                id_: metadata["answer"]
+                for ids, metadatas in ((pending[0]["add_ids"], pending[0]["add_metadatas"]),
+                                       (pending[0]["update_ids"], pending[0]["update_metadatas"]))
+                for id_, metadata in zip(ids, metadatas)
+            }
+            with database_lock.read():
+                plan = plan_batch(collection, questions, answers, pending_answers, aliases, seen)
+            embeddings_future = import_executor.submit(embed_documents, plan["add_questions"])
+            if pending is not None:
+                write(*pending)
+            pending = (plan, embeddings_future)
+        if pending is not None:
+            write(*pending)
+    finally:
+        save_lexical_index(collection.name)
+        if totals["writes"]:
+            bump_collection_version(collection_name)
 
     result = {
         "status": "success",
-        "message": f"Added {len(questions_to_add)} new unique question-answer pairs",
-        "new_pairs_count": len(questions_to_add),
-        "duplicates_skipped": len(questions) - len(questions_to_add)
+        "message": f"Added {totals['added']} new unique question-answer pairs",
+        "new_pairs_count": totals["added"],
+        "updated_pairs_count": totals["updated"],
+        "duplicates_skipped": totals["rows"] - totals["added"] - totals["updated"]
     }
-    logger.info(f"Batch addition result: {result}")
+    logger.info(f"Import result: {result}")
     return result
 
 
+def iter_list_chunks(questions, answers, chunk_size=IMPORT_CHUNK_SIZE):
+    for start in range(0, len(questions), chunk_size):
+        yield questions[start:start + chunk_size], answers[start:start + chunk_size]
+
+
+def batch_addition(questions, answers, collection_name=None):
+    logger.info(f"Adding batch of {len(questions)} questions to collection: {collection_name or 'default'}")
+    return import_chunks(iter_list_chunks(questions, answers), collection_name)
+
+
+def iter_csv_chunks(source, question_column, answer_column, info):
+    reader = pd.read_csv(source, header=[0], chunksize=IMPORT_CHUNK_SIZE)
+    for df in reader:
+        if "question_column" not in info:
+            logger.info(f"Available columns: {df.columns.tolist()}")
+            if question_column in df.columns and answer_column in df.columns:
+                info["question_column"] = question_column
+                info["answer_column"] = answer_column
+            else:
+                if len(df.columns) < 2:
+                    raise ValueError("Sheet must contain at least two columns")
+                info["question_column"] = df.columns[0]
+                info["answer_column"] = df.columns[1]
+                logger.warning(f"Columns '{question_column}' and '{answer_column}' not found. "
+                               f"Using '{info['question_column']}' for questions "
+                               f"and '{info['answer_column']}' for answers")
+        info["total_rows"] = info.get("total_rows", 0) + len(df)
+        yield df[info["question_column"]].to_list(), df[info["answer_column"]].to_list()
+
+
+@contextmanager
+def open_sheet(sheet_id, gid):
+    url = f'https://docs.google.com/spreadsheets/d/{sheet_id}/gviz/tq?tqx=out:csv&gid={gid}'
+    logger.info(f"Fetching data from URL: {url}")
+    with requests.get(url, stream=True) as response:
+        response.raise_for_status()
+        response.raw.decode_content = True
+        yield io.TextIOWrapper(response.raw, encoding='utf-8')
+
+
+def resolve_local_path(path):
+    full_path = os.path.abspath(os.path.join(IMPORT_LOCAL_DIR, path))
+    if os.path.commonpath([full_path, IMPORT_LOCAL_DIR]) != IMPORT_LOCAL_DIR:
+        raise ValueError(f"Path must be inside {IMPORT_LOCAL_DIR}")
+    if not os.path.isfile(full_path):
+        raise ValueError(f"File not found: {path}")
+    return full_path
+
+
+def run_csv_import(open_source, question_column, answer_column, collection_name=None, job=None):
+    info = {}
+    with open_source() as source:
+        result = import_chunks(iter_csv_chunks(source, question_column, answer_column, info), collection_name, job)
+    return {
+        **result,
+        "total_rows_in_sheet": info.get("total_rows", 0),
+        "used_question_column": info.get("question_column"),
+        "used_answer_column": info.get("answer_column")
+    }
+
+
+# Фоновые задачи импорта: состояние хранится в памяти процесса и доступно по job_id.
+# Копия пишется в каталог данных, чтобы статус был виден из любого воркера
+import_jobs = OrderedDict()
+IMPORT_JOBS_HISTORY = 100
+IMPORT_JOBS_DIR = os.path.join(CHROMA_DB_PATH, "import_jobs")
+
+
+def import_job_path(job_id):
+    return os.path.join(IMPORT_JOBS_DIR, f"{job_id}.json")
+
+
+def save_import_job(job):
+    try:
+        os.makedirs(IMPORT_JOBS_DIR, exist_ok=True)
+        tmp_path = f"{import_job_path(job['job_id'])}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(job, f, ensure_ascii=False)
+        os.replace(tmp_path, import_job_path(job["job_id"]))
+    except OSError as e:
+        logger.warning(f"Could not save import job {job['job_id']}: {str(e)}")
+
+
+def load_import_jobs():
+    if not os.path.isdir(IMPORT_JOBS_DIR):
+        return []
+    jobs = []
+    for filename in os.listdir(IMPORT_JOBS_DIR):
+        if filename.endswith(".json"):
+            try:
+                with open(os.path.join(IMPORT_JOBS_DIR, filename)) as f:
+                    jobs.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    jobs.sort(key=lambda job: job["started_at"])
+    for job in jobs[:-IMPORT_JOBS_HISTORY]:
+        try:
+            os.remove(import_job_path(job["job_id"]))
+        except OSError:
+            pass
+    return jobs[-IMPORT_JOBS_HISTORY:]
+
+
+def start_import_job(source, open_source, question_column, answer_column, collection_name=None, cleanup=None):
+    job_id = uuid.uuid4().hex
+    job = {
+        "job_id": job_id,
+        "status": "running",
+        "source": source,
+        "collection": collection_name or "default",
+        "rows_processed": 0,
+        "chunks_processed": 0,
+        "new_pairs_count": 0,
+        "updated_pairs_count": 0,
+        "started_at": time.time(),
+        "finished_at": None
+    }
+    import_jobs[job_id] = job
+    while len(import_jobs) > IMPORT_JOBS_HISTORY:
+        import_jobs.popitem(last=False)
+    save_import_job(job)
+
+    def run():
+        try:
+            job["result"] = run_csv_import(open_source, question_column, answer_column, collection_name, job)
+            job["status"] = "completed"
+        except Exception as e:
+            logger.error(f"Import job {job_id} failed: {str(e)}", exc_info=True)
+            job["status"] = "failed"
+            job["error"] = str(e)
+        finally:
+            job["finished_at"] = time.time()
+            save_import_job(job)
+            if cleanup:
+                cleanup()
+
+    threading.Thread(target=run, name=f"import-{job_id[:8]}", daemon=True).start()
+    logger.info(f"Started import job {job_id} from {source}")
+    return job
+
+
 class GoogleSheetInfo(BaseModel):
     sheet_id: str
     gid: str
     collection: Optional[str] = None
     question_column: Optional[str] = 'question'
     answer_column: Optional[str] = 'answer'
+    background: bool = False
 
 
-@app.post("/add_from_sheet")
+class LocalFileImport(BaseModel):
+    path: str
+    collection: Optional[str] = None
+    question_column: Optional[str] = 'question'
+    answer_column: Optional[str] = 'answer'
+
+
+@app.post("/add_from_sheet", dependencies=[Depends(require_ready)])
 async def add_data_from_sheet(sheet_info: GoogleSheetInfo):
     logger.info(f"Adding data from Google Sheet: {sheet_info}")
+    open_source = partial(open_sheet, sheet_info.sheet_id, sheet_info.gid)
+    if sheet_info.background:
+        return start_import_job(f"sheet:{sheet_info.sheet_id}/{sheet_info.gid}", open_source,
+                                sheet_info.question_column, sheet_info.answer_column, sheet_info.collection)
     try:
-        url = f'https://docs.google.com/spreadsheets/d/{sheet_info.sheet_id}/gviz/tq?tqx=out:csv&gid={sheet_info.gid}'
-        logger.info(f"Fetching data from URL: {url}")
-        response = requests.get(url)
-        response.encoding = 'utf-8'
-        df = pd.read_csv(io.StringIO(response.text), header=[0])
-        logger.info(f"Data fetched successfully. Shape: {df.shape}")
-
-        logger.info(f"Available columns: {df.columns.tolist()}")
-
-        if sheet_info.question_column in df.columns and sheet_info.answer_column in df.columns:
-            question_column = sheet_info.question_column
-            answer_column = sheet_info.answer_column
-        else:
-            if len(df.columns) < 2:
-                raise ValueError("Sheet must contain at least two columns")
-            question_column = df.columns[0]
-            answer_column = df.columns[1]
-            logger.warning(f"Columns '{sheet_info.question_column}' and '{sheet_info.answer_column}' not found. "
-                           f"Using '{question_column}' for questions and '{answer_column}' for answers")
-
-        questions = df[question_column].to_list()
-        answers = df[answer_column].to_list()
-
-        result = batch_addition(questions, answers, sheet_info.collection)
+        loop = asyncio.get_running_loop()
+        result = await loop.run_in_executor(None, run_csv_import, open_source, sheet_info.question_column,
+                                            sheet_info.answer_column, sheet_info.collection)
         logger.info(f"Data added from sheet. Result: {result}")
-        return {
-            **result,
-            "total_rows_in_sheet": len(questions),
-            "used_question_column": question_column,
-            "used_answer_column": answer_column
-        }
+        return result
     except Exception as e:
         logger.error(f"Error processing Google Sheet: {str(e)}", exc_info=True)
         raise HTTPException(status_code=500, detail=f"Error processing Google Sheet: {str(e)}")
 
 
-@app.post("/batch_add")
+@app.post("/import/file", dependencies=[Depends(require_ready)])
+async def import_file(file: UploadFile = File(...), collection: Optional[str] = Form(None),
+                      question_column: str = Form('question'), answer_column: str = Form('answer')):
+    logger.info(f"Importing uploaded file: {file.filename}")
+    # Загруженный файл копируется на диск кусками: задача читает его уже после ответа на запрос
+    tmp = tempfile.NamedTemporaryFile(suffix=".csv", delete=False)
+    try:
+        while True:
+            data = await file.read(1024 * 1024)
+            if not data:
+                break
+            tmp.write(data)
+    finally:
+        tmp.close()
+    open_source = partial(open, tmp.name, encoding='utf-8')
+    return start_import_job(f"upload:{file.filename}", open_source, question_column, answer_column, collection,
+                            cleanup=partial(os.remove, tmp.name))
+
+
+@app.post("/import/local", dependencies=[Depends(require_ready)])
+async def import_local(file_info: LocalFileImport):
+    logger.info(f"Importing local file: {file_info.path}")
+    try:
+        path = resolve_local_path(file_info.path)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return start_import_job(f"local:{file_info.path}", partial(open, path, encoding='utf-8'),
+                            file_info.question_column, file_info.answer_column, file_info.collection)
+
+
+@app.get("/import/jobs")
+async def list_import_jobs():
+    jobs = {job["job_id"]: job for job in load_import_jobs()}
+    jobs.update(import_jobs)
+    return {"jobs": sorted(jobs.values(), key=lambda job: job["started_at"])}
+
+
+@app.get("/import/jobs/{job_id}")
+async def import_job_status(job_id: str):
+    job = import_jobs.get(job_id)
+    if job is None and os.path.exists(import_job_path(job_id)):
+        with open(import_job_path(job_id)) as f:
+            job = json.load(f)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Import job {job_id} not found")
+    return job
+
+
+@app.post("/batch_add", dependencies=[Depends(require_ready)])
 async def batch_add(batch_data: BatchAddition):
     logger.info(f"Received batch addition request: {len(batch_data.questions)} questions")
-    return batch_addition(batch_data.questions, batch_data.answers, batch_data.collection)
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, batch_addition, batch_data.questions, batch_data.answers,
+                                      batch_data.collection)
 
 
-@app.post("/clear_collection")
-async def clear_collection(collection_name: Optional[str] = None):
+# Обработчики, работающие с Chroma под блокировкой, объявлены синхронными:
+# FastAPI выполняет их в пуле потоков, и ожидание блокировки не останавливает event loop
+@app.post("/clear_collection", dependencies=[Depends(require_ready)])
+def clear_collection(collection_name: Optional[str] = None):
     logger.info(f"Clearing collection: {collection_name or 'default'}")
     try:
-        collection = chroma_client.get_collection(collection_name) if collection_name else default_collection
-        all_ids = collection.get()["ids"]
-        logger.info(f"Deleting {len(all_ids)} items from collection")
-        collection.delete(all_ids)
-        return {"status": "success", "message": f"Коллекция {collection.name} очищена"}
+        with writer_lock(), database_lock.read():
+            collection = collection_cache.get(collection_name)
+            deleted = delete_all_items(collection)
+            logger.info(f"Deleted {deleted} items from collection {collection.name}")
+            get_lexical_index(collection).clear()
+            save_lexical_index(collection.name)
+            bump_collection_version(collection.name)
+        return {"status": "success", "message": f"Коллекция {collection.name} очищена", "deleted_count": deleted}
     except Exception as e:
         logger.error(f"Error clearing collection: {str(e)}", exc_info=True)
         return {"status": "error", "message": f"Ошибка при очистке коллекции: {str(e)}"}
 
 
-@app.post("/drop_collection")
-async def drop_collection(collection_name: str):
+@app.post("/drop_collection", dependencies=[Depends(require_ready)])
+def drop_collection(collection_name: str):
     logger.info(f"Dropping collection: {collection_name}")
     try:
-        chroma_client.delete_collection(collection_name)
+        with writer_lock(), database_lock.write():
+            collection_cache.invalidate(collection_name)
+            chroma_client.delete_collection(collection_name)
+            drop_lexical_index(collection_name)
+            bump_collection_version(collection_name)
         logger.info(f"Collection {collection_name} dropped successfully")
         return {"status": "success", "message": f"Коллекция {collection_name} удалена"}
     except Exception as e:
@@ -224,38 +1793,41 @@ async def drop_collection(collection_name: str):
         return {"status": "error", "message": f"Ошибка при удалении коллекции: {str(e)}"}
 
 
-@app.post("/reset_database")
-async def reset_database():
+@app.post("/reset_database", dependencies=[Depends(require_ready)])
+def reset_database():
     logger.info("Starting database reset")
-    global chroma_client, default_collection
+    global chroma_client
     try:
-        collections = chroma_client.list_collections()
-        logger.info(f"Found {len(collections)} collections")
+        with writer_lock(), database_lock.write():
+            collections = chroma_client.list_collections()
+            logger.info(f"Found {len(collections)} collections")
 
-        for collection in collections:
-            try:
-                logger.info(f"Clearing collection {collection.name}")
-                all_ids = collection.get()["ids"]
-                if all_ids:
-                    logger.info(f"Deleting {len(all_ids)} items from collection {collection.name}")
-                    collection.delete(ids=all_ids)
-                else:
-                    logger.info(f"Collection {collection.name} is already empty")
-            except Exception as e:
-                logger.error(f"Error clearing collection {collection.name}: {str(e)}", exc_info=True)
+            for collection in collections:
+                try:
+                    logger.info(f"Clearing collection {collection.name}")
+                    deleted = delete_all_items(collection)
+                    logger.info(f"Deleted {deleted} items from collection {collection.name}")
+                except Exception as e:
+                    logger.error(f"Error clearing collection {collection.name}: {str(e)}", exc_info=True)
 
-        logger.info("Recreating Chroma client")
-        chroma_client = chromadb.PersistentClient(path=CHROMA_DB_PATH)
+            logger.info("Recreating Chroma client")
+            collection_cache.clear()
+            chroma_client = create_chroma_client()
 
-        for collection in chroma_client.list_collections():
-            try:
-                logger.info(f"Deleting collection: {collection.name}")
-                chroma_client.delete_collection(collection.name)
-            except Exception as e:
-                logger.error(f"Error deleting collection {collection.name}: {str(e)}", exc_info=True)
+            for collection in chroma_client.list_collections():
+                try:
+                    logger.info(f"Deleting collection: {collection.name}")
+                    chroma_client.delete_collection(collection.name)
+                except Exception as e:
+                    logger.error(f"Error deleting collection {collection.name}: {str(e)}", exc_info=True)
 
-        logger.info("Creating new default collection")
-        default_collection = get_or_create_collection()
+            with lexical_indexes_lock:
+                lexical_indexes.clear()
+                shutil.rmtree(LEXICAL_INDEX_DIR, ignore_errors=True)
+
+            logger.info("Creating new default collection")
+            collection_cache.get(create=True)
+            collection_versions.bump(set(collection_versions.names() + [DEFAULT_COLLECTION_NAME]))
 
         logger.info("Database reset completed successfully")
         return {"status": "success", "message": "База данных сброшена, все коллекции очищены"}
@@ -264,47 +1836,370 @@ async def reset_database():
         return {"status": "error", "message": f"Ошибка при сбросе базы данных: {str(e)}"}
 
 
-@app.get("/view_top_n")
-async def view_top_n(n: int = 10, collection_name: Optional[str] = None):
+# Просмотр и выгрузка коллекции постранично: из Chroma запрашиваются только нужные поля,
+# в памяти одновременно находится не больше одной страницы
+ITEM_FIELDS = ("id", "question", "answer", "metadata")
+DEFAULT_ITEM_FIELDS = "id,question,answer"
+ITEMS_MAX_LIMIT = int(os.getenv("ITEMS_MAX_LIMIT", "1000"))
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+
+
+def parse_fields(fields):
+    names = [name.strip() for name in (fields or DEFAULT_ITEM_FIELDS).split(",") if name.strip()]
+    unknown = [name for name in names if name not in ITEM_FIELDS]
+    if unknown or not names:
+        raise ValueError(f"Unknown fields: {unknown}, available: {list(ITEM_FIELDS)}")
+    return list(dict.fromkeys(names))
+
+
+# Фильтр по метаданным в синтаксисе Chroma, например {"answer": "..."}
+def parse_where(where):
+    if not where:
+        return None
+    try:
+        parsed = json.loads(where)
+    except ValueError as e:
+        raise ValueError(f"Invalid where filter: {str(e)}")
+    if not isinstance(parsed, dict):
+        raise ValueError("where filter must be a JSON object")
+    return parsed
+
+
+def fetch_items(collection, offset, limit, fields, where=None, question_contains=None):
+    include = []
+    if "question" in fields:
+        include.append("documents")
+    if "answer" in fields or "metadata" in fields:
+        include.append("metadatas")
+    page = collection.get(offset=offset, limit=limit, where=where, include=include,
+                          where_document={"$contains": question_contains} if question_contains else None)
+    columns = {"id": page["ids"]}
+    if "question" in fields:
+        columns["question"] = page["documents"]
+    if "metadata" in fields:
+        columns["metadata"] = page["metadatas"]
+    if "answer" in fields:
+        columns["answer"] = [(metadata or {}).get("answer") for metadata in page["metadatas"]]
+    return [dict(zip(fields, row)) for row in zip(*(columns[field] for field in fields))]
+
+
+def iter_item_pages(collection, fields, where=None, question_contains=None, page_size=EXPORT_PAGE_SIZE):
+    offset = 0
+    while True:
+        # Блокировка берётся на одну страницу, чтобы долгая выгрузка не задерживала запись
+        with database_lock.read():
+            items = fetch_items(collection, offset, page_size, fields, where, question_contains)
+        if items:
+            yield items
+        if len(items) < page_size:
+            return
+        offset += len(items)
+
+
+def delete_all_items(collection):
+    deleted = 0
+    while True:
+        ids = collection.get(limit=CHROMA_WRITE_BATCH_SIZE, include=[])["ids"]
+        if not ids:
+            return deleted
+        collection.delete(ids=ids)
+        deleted += len(ids)
+
+
+def resolve_browse_params(collection_name, fields, where):
+    try:
+        fields = parse_fields(fields)
+        where = parse_where(where)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    sync_collection(collection_name or DEFAULT_COLLECTION_NAME)
+    try:
+        collection = collection_cache.get(collection_name)
+    except ValueError:
+        raise HTTPException(status_code=404, detail=f"Collection {collection_name} not found")
+    return collection, fields, where
+
+
+@app.get("/items", dependencies=[Depends(require_ready)])
+def list_items(collection_name: Optional[str] = None, offset: int = 0, limit: int = 100,
+               fields: Optional[str] = None, where: Optional[str] = None, question_contains: Optional[str] = None):
+    if offset < 0 or not 1 <= limit <= ITEMS_MAX_LIMIT:
+        raise HTTPException(status_code=400, detail=f"offset must be >= 0, limit between 1 and {ITEMS_MAX_LIMIT}")
+    with database_lock.read():
+        collection, fields, where = resolve_browse_params(collection_name, fields, where)
+        # Лишняя запись показывает, есть ли следующая страница
+        items = fetch_items(collection, offset, limit + 1, fields, where, question_contains)
+        total = collection.count() if where is None and not question_contains else None
+    has_more = len(items) > limit
+    items = items[:limit]
+    logger.info(f"Listed {len(items)} items from collection {collection.name} at offset {offset}")
+    return {
+        "collection": collection.name,
+        "offset": offset,
+        "limit": limit,
+        "total": total,
+        "next_offset": offset + limit if has_more else None,
+        "items": items
+    }
+
+
+@app.get("/export", dependencies=[Depends(require_ready)])
+def export_items(collection_name: Optional[str] = None, format: Literal["ndjson", "csv"] = "ndjson",
+                 fields: Optional[str] = None, where: Optional[str] = None, question_contains: Optional[str] = None):
+    with database_lock.read():
+        collection, fields, where = resolve_browse_params(collection_name, fields, where)
+    logger.info(f"Exporting collection {collection.name} as {format}, fields: {fields}")
+    pages = iter_item_pages(collection, fields, where, question_contains)
+
+    def ndjson():
+        for items in pages:
+            yield "".join(json.dumps(item, ensure_ascii=False) + "\n" for item in items)
+
+    def csv_rows():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(fields)
+        for items in pages:
+            for item in items:
+                writer.writerow([json.dumps(item[field], ensure_ascii=False) if field == "metadata" else item[field]
+                                 for field in fields])
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    headers = {"Content-Disposition": f'attachment; filename="{collection.name}.{format}"'}
+    if format == "csv":
+        return StreamingResponse(csv_rows(), media_type="text/csv; charset=utf-8", headers=headers)
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson", headers=headers)
+
+
+@app.get("/view_top_n", dependencies=[Depends(require_ready)])
+def view_top_n(n: int = 10, collection_name: Optional[str] = None, offset: int = 0, fields: Optional[str] = None):
     logger.info(f"Viewing top {n} items from collection: {collection_name or 'default'}")
+    page = list_items(collection_name, offset, min(max(n, 1), ITEMS_MAX_LIMIT), fields)
+    return {
+        "total_items": len(page["items"]),
+        "items": page["items"]
+    }
+
+
+# Сжатие коллекции: перефразировки вопроса с одинаковым ответом объединяются в одну запись.
+# Вопросы группируются по ответу и внутри группы кластеризуются по косинусной близости
+# сохранённых эмбеддингов, модель при этом не вызывается. От кластера остаются
+# COMPACTION_REPRESENTATIVES наименее похожих друг на друга записей, чтобы поиск по
+# эмбеддингам по-прежнему находил разные формулировки; тексты удалённых вопросов
+# сохраняются в метаданных первой записи и попадают в лексический индекс, а их id -
+# в поле merged_ids: при повторном импорте такие вопросы относятся к оставшейся записи
+COMPACTION_THRESHOLD = float(os.getenv("COMPACTION_THRESHOLD", "0.9"))  # косинусная близость
+COMPACTION_REPRESENTATIVES = int(os.getenv("COMPACTION_REPRESENTATIVES", "2"))
+
+
+class CompactionRequest(BaseModel):
+    collection: Optional[str] = None
+    threshold: float = COMPACTION_THRESHOLD
+    representatives: int = COMPACTION_REPRESENTATIVES
+    dry_run: bool = False
+    rebuild_index: bool = True
+
+
+def group_ids_by_answer(collection):
+    # В памяти держатся только id и хэши ответов, тексты и векторы читаются по группам
+    groups = defaultdict(list)
+    offset = 0
+    while True:
+        page = collection.get(include=['metadatas'], limit=CHROMA_WRITE_BATCH_SIZE, offset=offset)
+        if not page['ids']:
+            break
+        for id_, metadata in zip(page['ids'], page['metadatas']):
+            answer = (metadata or {}).get("answer") or ""
+            groups[hashlib.sha1(answer.encode("utf-8")).digest()].append(id_)
+        offset += len(page['ids'])
+    return [ids for ids in groups.values() if len(ids) > 1]
+
+
+# Жадная кластеризация по лидеру: вектор попадает в кластер первого лидера с близостью
+# не ниже порога, иначе сам становится лидером нового кластера
+def cluster_vectors(vectors, threshold):
+    leaders = np.empty_like(vectors)
+    clusters = []
+    for i, vector in enumerate(vectors):
+        if clusters:
+            similarities = leaders[:len(clusters)] @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= threshold:
+                clusters[best].append(i)
+                continue
+        leaders[len(clusters)] = vector
+        clusters.append([i])
+    return clusters
+
+
+def pick_representatives(vectors, members, count):
+    chosen = [members[0]]
+    while len(chosen) < min(count, len(members)):
+        rest = [m for m in members if m not in chosen]
+        similarities = (vectors[rest] @ vectors[chosen].T).max(axis=1)
+        chosen.append(rest[int(np.argmin(similarities))])
+    return chosen
+
+
+def compact_collection(collection, threshold, representatives, dry_run=False):
+    started = time.perf_counter()
+    records_before = collection.count()
+    index = None if dry_run else get_lexical_index(collection)
+    clusters_merged = 0
+    removed = 0
+    dimension = None
+    for ids in group_ids_by_answer(collection):
+        records = collection.get(ids=ids, include=['embeddings', 'documents', 'metadatas'])
+        vectors = np.asarray(records['embeddings'], dtype=np.float32)
+        dimension = vectors.shape[1]
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+        update_ids, update_metadatas, update_texts, delete_ids = [], [], [], []
+        for members in cluster_vectors(vectors, threshold):
+            if len(members) <= representatives:
+                continue
+            keep = pick_representatives(vectors, members, representatives)
+            leader = keep[0]
+            questions = [question for m in members if m not in keep[1:]
+                         for question in [records['documents'][m]] + alternate_questions(records['metadatas'][m])]
+            alternates = [q for q in dict.fromkeys(questions) if q != records['documents'][leader]]
+            aliases = [alias for m in members if m not in keep[1:]
+                       for alias in ([] if m == leader else [records['ids'][m]]) + merged_ids(records['metadatas'][m])]
+            metadata = dict(records['metadatas'][leader], alternate_questions=json.dumps(alternates, ensure_ascii=False),
+                            merged_ids=json.dumps(list(dict.fromkeys(aliases))))
+            update_ids.append(records['ids'][leader])
+            update_metadatas.append(metadata)
+            update_texts.append(lexical_text(records['documents'][leader], metadata))
+            delete_ids.extend(records['ids'][m] for m in members if m not in keep)
+            clusters_merged += 1
+        removed += len(delete_ids)
+        if dry_run or not delete_ids:
+            continue
+        collection.update(ids=update_ids, metadatas=update_metadatas)
+        collection.delete(ids=delete_ids)
+        index.delete(delete_ids)
+        index.add(update_ids, update_texts)
+
+    records_after = records_before - removed
+    report = {
+        "collection": collection.name,
+        "dry_run": dry_run,
+        "threshold": threshold,
+        "representatives": representatives,
+        "records_before": records_before,
+        "records_after": records_after,
+        "records_removed": removed,
+        "clusters_merged": clusters_merged,
+        "size_reduction": removed / records_before if records_before else 0.0,
+        "seconds": round(time.perf_counter() - started, 3)
+    }
+    if dimension is not None:
+        # Объём векторов float32 в индексе HNSW, без учёта графа связей
+        report["vector_bytes_before"] = records_before * dimension * 4
+        report["vector_bytes_after"] = records_after * dimension * 4
+    return report
+
+
+# HNSW только помечает удалённые векторы, и они продолжают занимать память и участвовать
+# в обходе графа. Чтобы индекс действительно уменьшился, записи копируются в новую коллекцию,
+# которая затем получает имя исходной
+def copy_collection(collection):
+    name = f"{collection.name[:50]}_compacted"
     try:
-        collection = chroma_client.get_collection(collection_name) if collection_name else default_collection
-        logger.info(f"Collection retrieved: {collection.name}")
-
-        results = collection.get(limit=n, include=['metadatas', 'documents'])  # Добавляем 'documents'
-        logger.info(f"Results retrieved: {results}")
-
-        if not results or not isinstance(results, dict):
-            logger.warning(f"Unexpected results format: {results}")
-            return {"error": "No results or unexpected format", "results": str(results)}
-
-        items = []
-        for i in range(len(results.get('ids', []))):
-            item = {
-                "id": results['ids'][i] if 'ids' in results else f"item_{i}",
-                "question": results.get('documents', [])[i] if results.get('documents') and i < len(
-                    results.get('documents', [])) else "No question available",
-                "answer": results.get('metadatas', [])[i].get("answer", "No answer available") if results.get(
-                    'metadatas') and i < len(results.get('metadatas', [])) else "No answer available"
-            }
-            items.append(item)
+        chroma_client.delete_collection(name)
+    except Exception:
+        pass
+    target = chroma_client.create_collection(name=name, embedding_function=emb_fn, metadata=collection.metadata)
+    offset = 0
+    while True:
+        page = collection.get(include=['embeddings', 'documents', 'metadatas'], limit=CHROMA_WRITE_BATCH_SIZE,
+                              offset=offset)
+        if not page['ids']:
+            break
+        target.add(ids=page['ids'], embeddings=page['embeddings'], documents=page['documents'],
+                   metadatas=page['metadatas'])
+        offset += len(page['ids'])
+    return target
 
-        logger.info(f"Processed {len(items)} items")
-        return {
-            "total_items": len(items),
-            "items": items
-        }
-    except Exception as e:
-        logger.error(f"Error viewing top N items: {str(e)}", exc_info=True)
-        return {"error": str(e), "traceback": traceback.format_exc()}
+
+@app.post("/compact_collection", dependencies=[Depends(require_ready)])
+def compact(request: CompactionRequest):
+    if not 0 < request.threshold <= 1 or request.representatives < 1:
+        raise HTTPException(status_code=400, detail="threshold must be in (0, 1], representatives >= 1")
+    logger.info(f"Compacting collection {request.collection or 'default'}: threshold {request.threshold}, "
+                f"representatives {request.representatives}, dry run {request.dry_run}")
+    with writer_lock():
+        with database_lock.read():
+            sync_collection(request.collection or DEFAULT_COLLECTION_NAME)
+            try:
+                collection = collection_cache.get(request.collection)
+            except ValueError:
+                raise HTTPException(status_code=404, detail=f"Collection {request.collection} not found")
+            report = compact_collection(collection, request.threshold, request.representatives, request.dry_run)
+            changed = report["records_removed"] > 0 and not request.dry_run
+            if changed:
+                save_lexical_index(collection.name)
+            compacted = None
+            if changed and request.rebuild_index:
+                logger.info(f"Rebuilding vector index of collection {collection.name}")
+                compacted = copy_collection(collection)
+        # Поиск продолжает работать по старой коллекции, пока идёт копирование;
+        # на время замены запросы ждут
+        if compacted is not None:
+            with database_lock.write():
+                chroma_client.delete_collection(collection.name)
+                compacted.modify(name=collection.name)
+                collection_cache.invalidate(collection.name)
+        report["index_rebuilt"] = compacted is not None
+        if changed:
+            bump_collection_version(collection.name)
+    logger.info(f"Compaction finished: {report}")
+    return report
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
+@app.get("/health/live")
+async def health_live():
+    return {"status": "alive", "phase": startup_state["phase"]}
+
+
+@app.get("/health/ready")
+async def health_ready():
+    status_code = 200 if startup_state["ready"] else 503
+    return JSONResponse(status_code=status_code, content=startup_state)
+
+
+@app.post("/warmup", dependencies=[Depends(require_ready)])
+async def warmup_model(batch_size: int = WARMUP_BATCH_SIZE):
+    started = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, warmup, batch_size)
+    return {"status": "success", "batch_size": batch_size, "elapsed": round(time.perf_counter() - started, 3)}
+
+
+@app.get("/api/v1/batch_stats")
+async def batch_stats():
+    return query_batcher.stats()
+
+
+@app.get("/api/v1/embedding_cache_stats")
+async def embedding_cache_stats():
+    return embedding_cache.stats()
 
 
-@app.get("/count_items")
-async def count_items(collection_name: Optional[str] = None):
+@app.get("/count_items", dependencies=[Depends(require_ready)])
+def count_items(collection_name: Optional[str] = None):
     logger.info(f"Counting items in collection: {collection_name or 'default'}")
     try:
-        collection = chroma_client.get_collection(collection_name) if collection_name else default_collection
-        count = collection.count()
+        with database_lock.read():
+            count = collection_cache.get(collection_name).count()
         logger.info(f"Item count: {count}")
         return {"collection_name": collection_name or "default", "item_count": count}
     except Exception as e:
@@ -0,0 +1,25 @@
+# Запуск ml-service в нескольких процессах:
+#   gunicorn -c gunicorn.conf.py app:app
+# Число воркеров задаёт WEB_CONCURRENCY. При нескольких воркерах база Chroma должна
+# работать отдельным сервером (CHROMA_SERVER=host:port), а CHROMA_DB_PATH - быть общим
+# каталогом: в нём лежат блокировка записи, версии коллекций и лексические индексы
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "1"))
+worker_class = "uvicorn.workers.UvicornWorker"
+# Приложение импортируется в мастер-процессе до fork, чтобы модель эмбеддингов
+# загружалась один раз и делилась между воркерами через copy-on-write
+preload_app = True
+# Загрузка модели и построение лексического индекса могут занимать минуты
+timeout = int(os.getenv("WORKER_TIMEOUT", "600"))
+graceful_timeout = 30
+
+
+# when_ready вызывается до запуска воркеров: пока модель загружается, порт никто не
+# обслуживает и /health/live не отвечает. Поэтому модель загружается заранее только при
+# нескольких воркерах, где это экономит память; один воркер грузит её в фоне, как uvicorn
+def when_ready(server):
+    if workers > 1:
+        import app
+        app.preload_embedding_model()
@@ -0,0 +1,137 @@
+# Импорт и сжатие коллекций ml-service: хэш-идентификаторы вопросов, миграция позиционных id,
+# повторы вопроса при разбиении на куски, повторный импорт после сжатия. Вместо модели
+# эмбеддингов используется хэширующая функция из benchmarks/corpus.py
+import os
+import sys
+import tempfile
+import uuid
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DATA_DIR = tempfile.mkdtemp(prefix="ml-service-test-")
+os.environ.update({
+    "CHROMA_DB_PATH": DATA_DIR,
+    "STARTUP_MODE": "eager",
+    "LOG_LEVEL": "WARNING",
+    "LOG_PAYLOAD_SAMPLE_RATE": "0"
+})
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT_DIR, "ml-service"))
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import app as ml_app  # noqa: E402
+from corpus import HashingEmbeddingFunction  # noqa: E402
+
+ml_app.create_embedding_function = lambda: HashingEmbeddingFunction(64)
+
+
+@pytest.fixture(scope="module")
+def client():
+    with TestClient(ml_app.app) as test_client:
+        yield test_client
+
+
+@pytest.fixture
+def collection_name(client):
+    return f"test_{uuid.uuid4().hex[:12]}"
+
+
+def import_rows(name, rows, chunk_size=ml_app.IMPORT_CHUNK_SIZE):
+    questions, answers = [q for q, _ in rows], [a for _, a in rows]
+    return ml_app.import_chunks(ml_app.iter_list_chunks(questions, answers, chunk_size), name)
+
+
+def stored(name):
+    records = ml_app.collection_cache.get(name).get(include=["documents", "metadatas"])
+    return {document: metadata["answer"] for document, metadata in zip(records["documents"], records["metadatas"])}
+
+
+def add_positional(name, rows, ids):
+    collection = ml_app.collection_cache.get(name, create=True)
+    questions = [q for q, _ in rows]
+    collection.add(ids=ids, documents=questions, embeddings=[list(map(float, e)) for e in ml_app.emb_fn(questions)],
+                   metadatas=[{"answer": a} for _, a in rows])
+    return collection
+
+
+def test_reimport_does_not_duplicate(collection_name):
+    rows = [("Как сбросить пароль?", "Через портал"), ("Где график отпусков", "У руководителя")]
+    first = import_rows(collection_name, rows)
+    second = import_rows(collection_name, rows)
+    assert first["new_pairs_count"] == 2
+    assert (second["new_pairs_count"], second["updated_pairs_count"], second["duplicates_skipped"]) == (0, 0, 2)
+    assert ml_app.collection_cache.get(collection_name).count() == 2
+
+
+def test_changed_answer_is_updated(collection_name):
+    import_rows(collection_name, [("Как сбросить пароль?", "Через портал")])
+    result = import_rows(collection_name, [("как сбросить пароль", "Через 1ЛТП")])
+    assert result["updated_pairs_count"] == 1
+    assert stored(collection_name) == {"Как сбросить пароль?": "Через 1ЛТП"}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 1000])
+def test_repeated_question_last_answer_wins(collection_name, chunk_size):
+    rows = [("q1", "a1"), ("q2", "a2"), ("q1", "a1b"), ("Q1!", "a1c")]
+    import_rows(collection_name, rows, chunk_size)
+    assert stored(collection_name) == {"q1": "a1c", "q2": "a2"}
+
+
+def counts(result):
+    return result["new_pairs_count"], result["updated_pairs_count"], result["duplicates_skipped"]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 1000])
+def test_counts_do_not_depend_on_chunk_size(collection_name, chunk_size):
+    import_rows(collection_name, [("q1", "a1"), ("q2", "a2")])
+    rows = [("q1", "a1"), ("q3", "a3"), ("q1", "a1b"), ("q3", "a3"), ("q2", "a2b"), ("q2", "a2"), ("q1", "a1c")]
+    assert counts(import_rows(collection_name, rows, chunk_size)) == (1, 1, 5)
+    assert stored(collection_name) == {"q1": "a1c", "q2": "a2", "q3": "a3"}
+    assert counts(import_rows(collection_name, rows, chunk_size)) == (0, 0, 7)
+
+
+def test_positional_ids_are_migrated(collection_name):
+    rows = [("Как сбросить пароль?", "p"), ("Где график отпусков", "v"), ("как сбросить пароль", "p2")]
+    add_positional(collection_name, rows, ["0", "1", "2"])
+    result = import_rows(collection_name, rows[:2] + [("Новый вопрос", "n")])
+    assert result["new_pairs_count"] == 1
+    ids = ml_app.collection_cache.get(collection_name).get(include=[])["ids"]
+    assert len(ids) == 3 and all(ml_app.QUESTION_ID_RE.match(id_) for id_ in ids)
+    assert stored(collection_name) == {"Как сбросить пароль?": "p", "Где график отпусков": "v", "Новый вопрос": "n"}
+
+
+PARAPHRASES = ["сброс пароля в системе", "сброс пароля в системе сейчас", "сброс пароля в системе срочно"]
+
+
+def compact(client, name):
+    response = client.post("/compact_collection", json={"collection": name, "threshold": 0.5, "representatives": 1})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_compacted_questions_are_not_reimported(client, collection_name):
+    rows = [(q, "p") for q in PARAPHRASES] + [("где график отпусков", "v")]
+    import_rows(collection_name, rows)
+    assert compact(client, collection_name)["records_removed"] == 2
+    result = import_rows(collection_name, rows)
+    assert (result["new_pairs_count"], result["duplicates_skipped"]) == (0, 4)
+    assert ml_app.collection_cache.get(collection_name).count() == 2
+
+
+def test_compacted_question_with_changed_answer_updates_leader(client, collection_name):
+    import_rows(collection_name, [(q, "A") for q in PARAPHRASES])
+    compact(client, collection_name)
+    leader = next(iter(stored(collection_name)))
+    result = import_rows(collection_name, [(q, "A2") for q in PARAPHRASES if q != leader][:1])
+    assert (result["updated_pairs_count"], result["duplicates_skipped"]) == (1, 0)
+    assert stored(collection_name) == {leader: "A2"}
+
+
+def test_positional_ids_are_migrated_without_record_zero(collection_name):
+    rows = [("Как сбросить пароль?", "p"), ("Где график отпусков", "v"), ("Пропуск", "k")]
+    collection = add_positional(collection_name, rows, ["0", "1", "2"])
+    collection.delete(ids=["0"])
+    result = import_rows(collection_name, rows[1:])
+    assert (result["new_pairs_count"], result["duplicates_skipped"]) == (0, 2)
+    assert stored(collection_name) == {"Где график отпусков": "v", "Пропуск": "k"}
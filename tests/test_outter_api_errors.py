@@ -0,0 +1,50 @@
+# Ошибки ml-service: outter_api отвечает 503/502 с понятным сообщением, потоковый API -
+# одной NDJSON-строкой с полем error
+import json
+import os
+import sys
+from contextlib import contextmanager
+
+os.environ.setdefault("SEMANTIC_CACHE_ENABLED", "0")
+os.environ.setdefault("LOG_PAYLOAD_SAMPLE_RATE", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ui+api"))
+
+import httpx  # noqa: E402
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import outter_api  # noqa: E402
+
+HISTORY = {"history": [{"role": "user", "content": "как сбросить пароль"}]}
+
+
+@contextmanager
+def client_for(handler):
+    with TestClient(outter_api.app) as client:
+        # Клиент создаётся в lifespan; запросы к ml-service уходят в заглушку
+        outter_api.http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        yield client
+
+
+def unavailable(request):
+    raise httpx.ConnectError("connection refused", request=request)
+
+
+@pytest.mark.parametrize("handler, status", [
+    (lambda request: httpx.Response(503, json={"detail": "Service is starting"}), 503),
+    (lambda request: httpx.Response(500, json={"detail": "boom"}), 502),
+    (unavailable, 503),
+])
+def test_ml_service_errors_are_mapped(handler, status):
+    with client_for(handler) as client:
+        response = client.post("/api/v1/get_answer/", json=HISTORY)
+    assert response.status_code == status
+    assert "ml-service" in response.json()["detail"]
+
+
+def test_stream_reports_ml_service_error():
+    with client_for(lambda request: httpx.Response(503, json={"detail": "Service is starting"})) as client:
+        response = client.post("/api/v1/get_answer_stream/", json=HISTORY)
+    assert response.status_code == 503
+    lines = [json.loads(line) for line in response.text.splitlines() if line]
+    assert len(lines) == 1 and lines[0]["done"] and "ml-service" in lines[0]["error"]
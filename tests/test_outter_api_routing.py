@@ -0,0 +1,78 @@
+# Маршрутизация outter_api: решение принимается по результатам поиска для текущего
+# вопроса, а не по сильному совпадению с прошлым вопросом диалога
+import json
+import os
+import sys
+
+os.environ.setdefault("SEMANTIC_CACHE_ENABLED", "0")
+os.environ.setdefault("LOG_PAYLOAD_SAMPLE_RATE", "0")
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ui+api"))
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+
+import outter_api  # noqa: E402
+
+PASSWORD_QUESTION = "как сбросить пароль"
+VACATION_QUESTION = "где посмотреть график отпусков"
+KB = {
+    PASSWORD_QUESTION: [("Как сбросить пароль?", "Ответ про пароль", 0.02),
+                        ("Как сменить логин?", "Ответ про логин", 0.5)],
+    VACATION_QUESTION: [("Где график отпусков?", "Ответ про отпуска", 0.55),
+                        ("Как оформить отпуск?", "Ответ про оформление", 0.6)]
+}
+
+
+async def fake_rag_query(queries, n_results, return_embeddings=False):
+    results = []
+    for query in queries:
+        hits = KB.get(query, [("Как сбросить пароль?", "Ответ про пароль", 0.3)])
+        results.append({"query": query, "results": [
+            {"id": str(i), "question": q, "answer": a, "distance": d} for i, (q, a, d) in enumerate(hits)]})
+    return {"results": results, "collection_version": 0}
+
+
+async def fake_llm_query(msgs, model=outter_api.LLM_MODEL):
+    return {"message": {"role": "assistant", "content": f"ответ {model}"}}
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setattr(outter_api, "rag_query", fake_rag_query)
+    monkeypatch.setattr(outter_api, "llm_query", fake_llm_query)
+    monkeypatch.setattr(outter_api, "ROUTING_ENABLED", True)
+    monkeypatch.setattr(outter_api, "ROUTING_CONFIDENT_MODE", "direct")
+    return TestClient(outter_api.app)
+
+
+def ask(client, history):
+    response = client.post("/api/v1/get_answer/", json={"history": history})
+    assert response.status_code == 200
+    return response.json()
+
+
+def test_route_uses_current_question_only(client):
+    history = [{"role": "user", "content": PASSWORD_QUESTION}]
+    first = ask(client, history)
+    assert first["routing"]["route"] == "direct"
+    assert first["message"]["content"] == "Ответ про пароль"
+
+    history += [first["message"], {"role": "user", "content": VACATION_QUESTION}]
+    second = ask(client, history)
+    assert second["routing"]["route"] == "large"
+    assert second["routing"]["top_distance"] == 0.55
+    assert second["message"]["content"] != "Ответ про пароль"
+
+
+def test_every_response_has_context(client):
+    history = [{"role": "user", "content": PASSWORD_QUESTION}]
+    direct = ask(client, history)
+    history += [direct["message"], {"role": "user", "content": VACATION_QUESTION}]
+    generated = ask(client, history)
+    assert direct["context"]["layout"] == "direct"
+    assert direct["context"]["prompt_tokens"] == 0 and direct["context"]["prompt_eval_count"] is None
+    assert set(direct["context"]) == set(generated["context"])
+
+    stream = client.post("/api/v1/get_answer_stream/", json={"history": history[:1]})
+    last = json.loads(stream.text.splitlines()[-1])
+    assert last["done"] and last["context"]["layout"] == "direct"
@@ -1,77 +1,584 @@
 import logging
 from pydantic import BaseModel
-from typing import List, Dict, Any
-import requests
+from typing import List, Dict, Any, Optional, AsyncIterator, Tuple
+import httpx
+import asyncio
 import json
-from collections import defaultdict
+import os
+import re
+import time
+import math
+import hashlib
+import threading
+import random
+import uuid
+import contextvars
+from collections import defaultdict, OrderedDict
+from contextlib import asynccontextmanager, contextmanager
 import uvicorn
-from fastapi import FastAPI
+from fastapi import FastAPI, Request, HTTPException
+from fastapi.responses import StreamingResponse, Response
+from prometheus_client import Counter, Histogram, generate_latest, CONTENT_TYPE_LATEST
 
-logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] %(message)s")
+# Идентификатор запроса пробрасывается в ml-service заголовком X-Request-ID
+# и добавляется во все строки лога
+request_id_var = contextvars.ContextVar("request_id", default="-")
+
+
+class RequestIdFilter(logging.Filter):
+    def filter(self, record):
+        record.request_id = request_id_var.get()
+        return True
+
+
+logging.basicConfig(level=logging.INFO, format="%(asctime)s [%(levelname)s] [%(request_id)s] %(message)s")
+for handler in logging.getLogger().handlers:
+    handler.addFilter(RequestIdFilter())
+# httpx пишет строку на каждый исходящий запрос
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+# Доля запросов, для которых в лог пишутся история чата, найденный контекст и ответ LLM
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv("LOG_PAYLOAD_SAMPLE_RATE", "0.01"))
+
+
+def log_payload(message: str, payload: Any):
+    if LOG_PAYLOAD_SAMPLE_RATE > 0 and random.random() < LOG_PAYLOAD_SAMPLE_RATE:
+        logging.info(f"{message}: {payload}")
+
+
+# Метрики Prometheus
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+REQUEST_SECONDS = Histogram("api_request_duration_seconds", "HTTP request duration",
+                            ["method", "endpoint", "status"], buckets=LATENCY_BUCKETS)
+STAGE_SECONDS = Histogram("api_stage_duration_seconds", "Duration of answer pipeline stages",
+                          ["stage"], buckets=LATENCY_BUCKETS)
+LLM_TOKENS_PER_SECOND = Histogram("api_llm_tokens_per_second", "LLM generation speed",
+                                  ["model"], buckets=(1, 2, 5, 10, 15, 20, 30, 50, 75, 100, 150, 200))
+PROMPT_TOKENS = Histogram("api_prompt_tokens", "Estimated LLM prompt size in tokens",
+                          buckets=(250, 500, 1000, 1500, 2000, 3000, 4000, 6000, 8000))
+ROUTING_DECISIONS = Counter("api_routing_decisions_total", "Answer routing decisions", ["route"])
+ROUTE_SECONDS = Histogram("api_route_duration_seconds", "Answer generation time per routing tier",
+                          ["route"], buckets=LATENCY_BUCKETS)
+SEMANTIC_CACHE_LOOKUPS = Counter("api_semantic_cache_lookups_total", "Semantic answer cache lookups", ["result"])
+RETRIEVAL_QUERIES = Counter("api_retrieval_queries_total", "Retrieval queries per source", ["source"])
+
+
+@contextmanager
+def observe_stage(stage: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(stage).observe(time.perf_counter() - started)
+
+
+def record_llm_stats(model: str, response: Dict[str, Any], total: float, ttft: Optional[float] = None):
+    STAGE_SECONDS.labels("llm_total").observe(total)
+    # Для непотокового ответа время до первого токена оценивается по полям Ollama (в наносекундах)
+    if ttft is None and "prompt_eval_duration" in response:
+        ttft = (response.get("load_duration", 0) + response["prompt_eval_duration"]) / 1e9
+    if ttft is not None:
+        STAGE_SECONDS.labels("llm_ttft").observe(ttft)
+    if response.get("eval_count") and response.get("eval_duration"):
+        LLM_TOKENS_PER_SECOND.labels(model).observe(response["eval_count"] / (response["eval_duration"] / 1e9))
 
-app = FastAPI()
 ml_service = 'ml-service'  # IP адрес для LLM и RAG сервисов
 ollama_service = 'ollama'
+ML_SERVICE_URL = os.getenv("ML_SERVICE_URL", f"http://{ml_service}:8000")
+OLLAMA_URL = os.getenv("OLLAMA_URL", f"http://{ollama_service}:11434")
+
+# Настройки исходящих HTTP-соединений: общий пул keep-alive соединений,
+# ограничение числа одновременных запросов и таймауты для каждого сервиса
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+RAG_CONCURRENCY = int(os.getenv("RAG_CONCURRENCY", "32"))
+RAG_TIMEOUT = float(os.getenv("RAG_TIMEOUT", "30"))
+LLM_CONCURRENCY = int(os.getenv("LLM_CONCURRENCY", "8"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "300"))
+
+# Настройки семантического кэша ответов
+SEMANTIC_CACHE_ENABLED = os.getenv("SEMANTIC_CACHE_ENABLED", "1") == "1"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # косинусная близость
+SEMANTIC_CACHE_TTL = float(os.getenv("SEMANTIC_CACHE_TTL", "3600"))  # секунды
+SEMANTIC_CACHE_MAX_SIZE = int(os.getenv("SEMANTIC_CACHE_MAX_SIZE", "2048"))
+
+# Хранилище диалогов: результаты поиска по вопросам пользователя переиспользуются на следующих ходах
+SESSION_STORE_ENABLED = os.getenv("SESSION_STORE_ENABLED", "1") == "1"
+SESSION_TTL = float(os.getenv("SESSION_TTL", "3600"))  # секунды без новых сообщений
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+SESSION_MAX_BYTES = int(os.getenv("SESSION_MAX_BYTES", str(64 * 1024 * 1024)))
+SESSION_MAX_TURNS = int(os.getenv("SESSION_MAX_TURNS", "4"))  # хранимых вопросов на диалог
+SESSION_MAX_MESSAGES = int(os.getenv("SESSION_MAX_MESSAGES", "50"))  # хранимых сообщений истории на диалог
+
+# Сборка контекста LLM: найденные QA-пары ранжируются по расстоянию, пары дальше
+# CONTEXT_MAX_DISTANCE и почти одинаковые ответы отбрасываются, системный промпт и
+# история диалога укладываются в CONTEXT_TOKEN_BUDGET токенов (из них на историю -
+# не более HISTORY_TOKEN_BUDGET). Токены оцениваются по длине текста
+RAG_N_RESULTS = int(os.getenv("RAG_N_RESULTS", "5"))
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+HISTORY_TOKEN_BUDGET = int(os.getenv("HISTORY_TOKEN_BUDGET", "1000"))
+CONTEXT_MAX_DISTANCE = float(os.getenv("CONTEXT_MAX_DISTANCE", "1.0"))  # косинусное расстояние
+CONTEXT_DEDUP_THRESHOLD = float(os.getenv("CONTEXT_DEDUP_THRESHOLD", "0.8"))  # сходство Жаккара биграмм слов
+CHARS_PER_TOKEN = float(os.getenv("CHARS_PER_TOKEN", "3.5"))
+EARLIER_QUESTIONS_MAX = 5
+EARLIER_QUESTION_CHARS = 150
+
+# Раскладка промпта (см. render_llm_history) и время, в течение которого Ollama держит
+# модель в памяти после запроса (формат keep_alive Ollama: "30m", "1h", "-1" - всегда)
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "stable_prefix")
+if PROMPT_LAYOUT not in ("stable_prefix", "context_first"):
+    raise ValueError(f"Unknown PROMPT_LAYOUT: {PROMPT_LAYOUT}")
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "30m")
+
+# Маршрутизация по уверенности поиска: если лучшая найденная пара ближе ROUTING_MAX_DISTANCE
+# и отстоит от следующей не меньше чем на ROUTING_MIN_MARGIN, ответ из базы знаний
+# возвращается как есть (ROUTING_CONFIDENT_MODE=direct) или перефразируется малой моделью
+# (rephrase); в остальных случаях отвечает основная модель
+LLM_MODEL = os.getenv("LLM_MODEL", "gemma2:9b")
+LLM_SMALL_MODEL = os.getenv("LLM_SMALL_MODEL", "gemma2:2b-instruct-q8_0")
+ROUTING_ENABLED = os.getenv("ROUTING_ENABLED", "1") == "1"
+ROUTING_MAX_DISTANCE = float(os.getenv("ROUTING_MAX_DISTANCE", "0.15"))
+ROUTING_MIN_MARGIN = float(os.getenv("ROUTING_MIN_MARGIN", "0.1"))
+ROUTING_CONFIDENT_MODE = os.getenv("ROUTING_CONFIDENT_MODE", "rephrase")
+if ROUTING_CONFIDENT_MODE not in ("direct", "rephrase"):
+    raise ValueError(f"Unknown ROUTING_CONFIDENT_MODE: {ROUTING_CONFIDENT_MODE}")
+
+http_client: Optional[httpx.AsyncClient] = None
+rag_semaphore: Optional[asyncio.Semaphore] = None
+llm_semaphore: Optional[asyncio.Semaphore] = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global http_client, rag_semaphore, llm_semaphore
+    http_client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(RAG_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+    )
+    rag_semaphore = asyncio.Semaphore(RAG_CONCURRENCY)
+    llm_semaphore = asyncio.Semaphore(LLM_CONCURRENCY)
+    logging.info(f"HTTP client initialized: ml-service={ML_SERVICE_URL} (concurrency {RAG_CONCURRENCY}), "
+                 f"ollama={OLLAMA_URL} (concurrency {LLM_CONCURRENCY})")
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        http_client = None
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+@app.middleware("http")
+async def request_context(request: Request, call_next):
+    request_id = request.headers.get("X-Request-ID") or uuid.uuid4().hex
+    token = request_id_var.set(request_id)
+    started = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        response.headers["X-Request-ID"] = request_id
+        return response
+    finally:
+        route = request.scope.get("route")
+        endpoint = route.path if route is not None else "unmatched"
+        REQUEST_SECONDS.labels(request.method, endpoint, str(status)).observe(time.perf_counter() - started)
+        request_id_var.reset(token)
+
 
 class Message(BaseModel):
     role: str
     content: str
 
+# Полная история диалога в history или, при известном conversation_id, только новый вопрос в message
 class ChatHistory(BaseModel):
-    history: List[Message]
+    history: List[Message] = []
+    conversation_id: Optional[str] = None
+    message: Optional[str] = None
+
+# LRU-кэш ответов LLM с TTL, поиск по косинусной близости эмбеддингов запроса.
+# Записи сгруппированы по ключу контекста (хэш найденных QA-пар и модели):
+# ответ переиспользуется только если контекст из базы знаний не изменился.
+class SemanticCache:
+
+    def __init__(self, threshold: float, ttl: float, max_size: int):
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_size = max_size
+        self.entries = OrderedDict()  # entry_id -> (context_key, embedding, answer, created_at)
+        self.by_context = defaultdict(set)  # context_key -> {entry_id}
+        self.collection_version = None
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(embedding: List[float]) -> List[float]:
+        norm = math.sqrt(sum(x * x for x in embedding)) or 1.0
+        return [x / norm for x in embedding]
+
+    def _remove(self, entry_id):
+        context_key = self.entries.pop(entry_id)[0]
+        ids = self.by_context[context_key]
+        ids.discard(entry_id)
+        if not ids:
+            del self.by_context[context_key]
+
+    def _check_version(self, collection_version):
+        if collection_version != self.collection_version:
+            if self.entries:
+                logging.info(f"Collection version changed ({self.collection_version} -> {collection_version}), "
+                             f"invalidating {len(self.entries)} cached answers")
+                self.invalidations += 1
+            self.entries.clear()
+            self.by_context.clear()
+            self.collection_version = collection_version
+
+    def lookup(self, embedding: List[float], context_key: str, collection_version) -> Optional[str]:
+        query = self._normalize(embedding)
+        now = time.monotonic()
+        with self.lock:
+            self._check_version(collection_version)
+            best_id, best_score = None, self.threshold
+            for entry_id in list(self.by_context.get(context_key, ())):
+                _, cached, _, created_at = self.entries[entry_id]
+                if now - created_at > self.ttl:
+                    self._remove(entry_id)
+                    continue
+                score = sum(a * b for a, b in zip(query, cached))
+                if score >= best_score:
+                    best_id, best_score = entry_id, score
+            if best_id is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(best_id)
+            return self.entries[best_id][2]
+
+    def store(self, embedding: List[float], context_key: str, collection_version, answer: str):
+        with self.lock:
+            self._check_version(collection_version)
+            entry_id = self.next_id
+            self.next_id += 1
+            self.entries[entry_id] = (context_key, self._normalize(embedding), answer, time.monotonic())
+            self.by_context[context_key].add(entry_id)
+            while len(self.entries) > self.max_size:
+                self._remove(next(iter(self.entries)))
+                self.evictions += 1
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": SEMANTIC_CACHE_ENABLED,
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "threshold": self.threshold,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "collection_version": self.collection_version
+            }
+
+
+semantic_cache = SemanticCache(SEMANTIC_CACHE_THRESHOLD, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_MAX_SIZE)
+
+
+# Диалоги по conversation_id от UI: история сообщений (UI присылает только новый вопрос)
+# и результаты поиска по вопросам пользователя. На следующем ходе прошлые вопросы снова
+# входят в запрос к ml-service; их результаты берутся отсюда, если версия коллекции
+# не изменилась. LRU по диалогам с TTL и ограничением числа диалогов и оценки занимаемой памяти.
+class SessionStore:
+
+    def __init__(self, ttl: float, max_sessions: int, max_bytes: int, max_turns: int, max_messages: int):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.max_turns = max_turns
+        self.max_messages = max_messages
+        # conversation_id -> {"turns": OrderedDict(query -> (result, version, size)),
+        #                     "history": [message], "history_bytes": int, "touched": float}
+        self.sessions = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.lock = threading.Lock()
 
-def rag_query(queries: List[str], n_results: int) -> Dict[str, Any]:
-    url = f"http://{ml_service}:8000/api/v1/get_answer/"
+    @staticmethod
+    def _size(result: Dict[str, Any]) -> int:
+        # Оценка по длине текстов: точный размер объектов Python считать дорого
+        return 200 + sum(len(item["question"]) + len(item["answer"]) + 100 for item in result["results"])
+
+    def _remove(self, conversation_id: str):
+        session = self.sessions.pop(conversation_id)
+        self.bytes -= sum(size for _, _, size in session["turns"].values()) + session["history_bytes"]
+
+    def _expire(self, now: float):
+        while self.sessions:
+            conversation_id, session = next(iter(self.sessions.items()))
+            if now - session["touched"] <= self.ttl:
+                break
+            self._remove(conversation_id)
+            self.expirations += 1
+
+    def _session(self, conversation_id: str, now: float) -> Dict[str, Any]:
+        session = self.sessions.get(conversation_id)
+        if session is None:
+            session = self.sessions[conversation_id] = {"turns": OrderedDict(), "history": [], "history_bytes": 0,
+                                                        "touched": now}
+        session["touched"] = now
+        self.sessions.move_to_end(conversation_id)
+        return session
+
+    def _evict(self):
+        while len(self.sessions) > self.max_sessions or (self.bytes > self.max_bytes and len(self.sessions) > 1):
+            self._remove(next(iter(self.sessions)))
+            self.evictions += 1
+
+    def lookup(self, conversation_id: str, queries: List[str]) -> Dict[str, Tuple[Dict[str, Any], Any]]:
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            session = self.sessions.get(conversation_id)
+            found = {}
+            for query in queries:
+                if session is not None and query in session["turns"]:
+                    result, version, _ = session["turns"][query]
+                    found[query] = (result, version)
+                    self.hits += 1
+                else:
+                    self.misses += 1
+            if session is not None:
+                session["touched"] = now
+                self.sessions.move_to_end(conversation_id)
+            return found
+
+    def store(self, conversation_id: str, query: str, result: Dict[str, Any], collection_version):
+        result = {key: value for key, value in result.items() if key != "embedding"}
+        size = self._size(result)
+        with self.lock:
+            session = self._session(conversation_id, time.monotonic())
+            if query in session["turns"]:
+                self.bytes -= session["turns"].pop(query)[2]
+            session["turns"][query] = (result, collection_version, size)
+            self.bytes += size
+            while len(session["turns"]) > self.max_turns:
+                self.bytes -= session["turns"].popitem(last=False)[1][2]
+            self._evict()
+
+    # None - диалог неизвестен или истёк, тогда клиент присылает историю целиком
+    def get_history(self, conversation_id: str) -> Optional[List[Dict[str, str]]]:
+        now = time.monotonic()
+        with self.lock:
+            self._expire(now)
+            if conversation_id not in self.sessions:
+                return None
+            return list(self._session(conversation_id, now)["history"])
+
+    def append_history(self, conversation_id: str, messages: List[Dict[str, str]], replace: bool = False):
+        with self.lock:
+            session = self._session(conversation_id, time.monotonic())
+            history = (list(messages) if replace else session["history"] + list(messages))[-self.max_messages:]
+            history_bytes = sum(len(message["content"]) + 50 for message in history)
+            self.bytes += history_bytes - session["history_bytes"]
+            session["history"], session["history_bytes"] = history, history_bytes
+            self._evict()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "enabled": SESSION_STORE_ENABLED,
+                "sessions": len(self.sessions),
+                "max_sessions": self.max_sessions,
+                "bytes": self.bytes,
+                "max_bytes": self.max_bytes,
+                "ttl": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / total if total else 0.0,
+                "evictions": self.evictions,
+                "expirations": self.expirations
+            }
+
+
+session_store = SessionStore(SESSION_TTL, SESSION_MAX_SESSIONS, SESSION_MAX_BYTES, SESSION_MAX_TURNS,
+                             SESSION_MAX_MESSAGES)
+
+
+def context_cache_key(qa_pairs: List[Dict[str, Any]], model: str) -> str:
+    # Расстояния зависят от формулировки запроса и в ключ не входят
+    pairs = [{"questions": pair["questions"], "answer": pair["answer"]} for pair in qa_pairs]
+    payload = json.dumps({"model": model, "qa_pairs": pairs}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+
+async def rag_query(queries: List[str], n_results: int, return_embeddings: bool = False) -> Dict[str, Any]:
+    url = f"{ML_SERVICE_URL}/api/v1/get_answer/"
     data = {
         "queries": queries,
-        "n_results": n_results
+        "n_results": n_results,
+        "return_embeddings": return_embeddings
     }
-    response = requests.post(url, json=data)
+    try:
+        async with rag_semaphore:
+            with observe_stage("rag_http"):
+                response = await http_client.post(url, json=data, headers={"X-Request-ID": request_id_var.get()})
+        response.raise_for_status()
+    except httpx.HTTPStatusError as e:
+        # 503 - ml-service ещё загружает модель (ленивый запуск), остальные коды - ошибка ml-service
+        status = e.response.status_code
+        logging.error(f"ml-service returned {status}: {e.response.text[:200]}")
+        if status == 503:
+            raise HTTPException(status_code=503, detail="ml-service is starting, retry later")
+        raise HTTPException(status_code=502, detail=f"ml-service returned {status}")
+    except httpx.RequestError as e:
+        logging.error(f"ml-service request failed: {type(e).__name__}: {str(e)}")
+        raise HTTPException(status_code=503, detail="ml-service is unavailable")
     return response.json()
 
-def llm_query(msgs: List[Dict[str, str]], model: str = "gemma2:9b") -> Dict[str, Any]:
-    url = f"http://{ollama_service}:11434/api/chat"
+async def llm_query(msgs: List[Dict[str, str]], model: str = LLM_MODEL) -> Dict[str, Any]:
+    url = f"{OLLAMA_URL}/api/chat"
     payload = {
         "model": model,
         "messages": msgs,
         "stream": False,
         "options": {"temperature": 0.0},
+        "keep_alive": LLM_KEEP_ALIVE,
     }
-    headers = {"Content-Type": "application/json"}
-    response = requests.post(url, headers=headers, data=json.dumps(payload))
-    return response.json()
+    async with llm_semaphore:
+        started = time.perf_counter()
+        response = await http_client.post(url, json=payload, timeout=LLM_TIMEOUT)
+        result = response.json()
+        record_llm_stats(model, result, time.perf_counter() - started)
+    return result
 
-def process_history(history: List[Message], N: int = 2, M: int = 3) -> List[Dict[str, Any]]:
+async def llm_query_stream(msgs: List[Dict[str, str]], model: str = LLM_MODEL) -> AsyncIterator[Dict[str, Any]]:
+    url = f"{OLLAMA_URL}/api/chat"
+    payload = {
+        "model": model,
+        "messages": msgs,
+        "stream": True,
+        "options": {"temperature": 0.0},
+        "keep_alive": LLM_KEEP_ALIVE,
+    }
+    async with llm_semaphore:
+        started = time.perf_counter()
+        ttft = None
+        async with http_client.stream("POST", url, json=payload, timeout=LLM_TIMEOUT) as response:
+            response.raise_for_status()
+            async for line in response.aiter_lines():
+                if line:
+                    chunk = json.loads(line)
+                    if ttft is None and chunk.get("message", {}).get("content"):
+                        ttft = time.perf_counter() - started
+                    if chunk.get("done"):
+                        record_llm_stats(model, chunk, time.perf_counter() - started, ttft)
+                    yield chunk
+
+WORD_RE = re.compile(r"\w+")
+
+
+def count_tokens(text: str) -> int:
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def answer_shingles(answer: str) -> set:
+    words = WORD_RE.findall(answer.lower().replace("ё", "е"))
+    return set(zip(words, words[1:])) or set(words)
+
+
+def jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+# Результаты всех запросов объединяются по ответу с лучшим расстоянием, сортируются,
+# отсекаются по порогу релевантности; почти совпадающие ответы сливаются в одну пару
+def rank_qa_pairs(rag_results: Dict[str, Any]) -> List[Dict[str, Any]]:
+    by_answer = {}
+    for query_result in rag_results['results']:
+        for result in query_result['results']:
+            distance = result.get('distance')
+            distance = math.inf if distance is None else distance
+            pair = by_answer.setdefault(result['answer'],
+                                        {"questions": [], "answer": result['answer'], "distance": distance})
+            if result['question'] not in pair["questions"]:
+                pair["questions"].append(result['question'])
+            pair["distance"] = min(pair["distance"], distance)
+
+    ranked = sorted(by_answer.values(), key=lambda pair: pair["distance"])
+    kept = []
+    for pair in ranked:
+        if pair["distance"] > CONTEXT_MAX_DISTANCE:
+            break
+        shingles = answer_shingles(pair["answer"])
+        duplicate = next((kept_pair for kept_pair, kept_shingles in kept
+                          if jaccard(shingles, kept_shingles) >= CONTEXT_DEDUP_THRESHOLD), None)
+        if duplicate is None:
+            kept.append((pair, shingles))
+        else:
+            duplicate["questions"].extend(q for q in pair["questions"] if q not in duplicate["questions"])
+    return [pair for pair, _ in kept]
+
+
+async def process_history(history: List[Message], N: int = 2, M: int = 3, return_embeddings: bool = False,
+                          conversation_id: Optional[str] = None):
     user_messages = [msg.content for msg in history if msg.role == "user"][-N:]
     all_messages = " ".join([msg.content for msg in history[-M:]])
     queries = user_messages + [all_messages]
-    
-    rag_results = rag_query(queries, n_results=5)
-    
-    answer_to_questions = defaultdict(list)
-    for query_result in rag_results['results']:
-        for result in query_result['results']:
-            answer_to_questions[result['answer']].append(result['question'])
-    
-    processed_results = [
-        {
-            "questions": questions,
-            "answer": answer
-        }
-        for answer, questions in answer_to_questions.items()
-    ]
-    
-    return processed_results
 
-def create_condensed_qa_prompt(user_question: str, qa_pairs: List[Dict[str, Any]]) -> str:
-    prompt = f'Вопрос от пользователя: "{user_question}"\n\nРелевантные вопросы и ответы из базы знаний:\n'
+    # Прошлые вопросы диалога уже искались на предыдущих ходах: в ml-service уходят только
+    # новый вопрос и скользящий контекст, остальное берётся из хранилища диалогов
+    use_sessions = SESSION_STORE_ENABLED and conversation_id is not None
+    earlier = [query for query in user_messages[:-1] if query not in (user_messages[-1], all_messages)]
+    reused = session_store.lookup(conversation_id, earlier) if use_sessions else {}
+    fetch = [query for query in dict.fromkeys(queries) if query not in reused]
+    rag_results = await rag_query(fetch, n_results=RAG_N_RESULTS, return_embeddings=return_embeddings)
+    collection_version = rag_results.get("collection_version")
+    by_query = dict(zip(fetch, rag_results['results']))
 
-    for i, pair in enumerate(qa_pairs, 1):
-        questions = ', '.join(f'"{q}"' for q in pair['questions'])
-        prompt += f"#{i}. Вопросы: {questions}\n   Ответ: {pair['answer']}\n\n"
-    
-    prompt += '''
-Задача: Основываясь на вспомогательных материалах корпоративной базы знаний компании x5 retail group, развёрнуто и чётко ответить на вопрос пользователя. 
+    # После изменения базы знаний сохранённые результаты запрашиваются заново
+    stale = [query for query, (_, version) in reused.items() if version != collection_version]
+    if stale:
+        refreshed = await rag_query(stale, n_results=RAG_N_RESULTS)
+        by_query.update(zip(stale, refreshed['results']))
+        collection_version = refreshed.get("collection_version")
+    for query, (result, _) in reused.items():
+        by_query.setdefault(query, result)
+    RETRIEVAL_QUERIES.labels("fetched").inc(len(fetch) + len(stale))
+    RETRIEVAL_QUERIES.labels("reused").inc(len(reused) - len(stale))
+
+    if use_sessions and user_messages:
+        session_store.store(conversation_id, user_messages[-1], by_query[user_messages[-1]], collection_version)
+    rag_results = {"results": [by_query[query] for query in queries], "collection_version": collection_version}
+    return rank_qa_pairs(rag_results), rag_results
+
+
+def format_qa_pair(i: int, pair: Dict[str, Any]) -> str:
+    questions = ', '.join(f'"{q}"' for q in pair['questions'])
+    return f"#{i}. Вопросы: {questions}\n   Ответ: {pair['answer']}\n\n"
+
+
+def shorten(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[:limit].rstrip() + "…"
+
+
+QA_INSTRUCTIONS = '''Задача: Основываясь на вспомогательных материалах корпоративной базы знаний компании x5 retail group, развёрнуто и чётко ответить на вопрос пользователя. 
 Важно, что вспомогательные данные не всегда ранжированы по релевантности. 
 Если ты считаешь, вопрос пользователя релевантен вопросам из базы знаний, дай соответствующий ответ. 
 Общайся с пользователем непринужденно, как с другом, но оставайся профессиональным.
@@ -79,40 +586,362 @@ def create_condensed_qa_prompt(user_question: str, qa_pairs: List[Dict[str, Any]
 Если в вспомогательных данных есть несколько вопросов, которые релевантны данному, задай уточняющий вопрос, чтобы понять, какой из вопросов больше подходит.
 Ответ должен быть полным, как в базе знаний. Из базы знаний нужно выбрать лишь один ответ!
 Отвечай только на русском языке.'''
-    
+
+
+def format_qa_context(qa_pairs: List[Dict[str, Any]], earlier_questions: Optional[List[str]] = None) -> str:
+    context = ""
+    if earlier_questions:
+        context += "Ранее в диалоге пользователь спрашивал: " + "; ".join(f'"{q}"' for q in earlier_questions) + "\n\n"
+    context += "Релевантные вопросы и ответы из базы знаний:\n"
+    for i, pair in enumerate(qa_pairs, 1):
+        context += format_qa_pair(i, pair)
+    return context
+
+
+def create_condensed_qa_prompt(user_question: str, qa_pairs: List[Dict[str, Any]],
+                               earlier_questions: Optional[List[str]] = None) -> str:
+    prompt = f'Вопрос от пользователя: "{user_question}"\n\n'
+    prompt += format_qa_context(qa_pairs, earlier_questions)
+    prompt += "\n" + QA_INSTRUCTIONS
     return prompt
 
-@app.post("/api/v1/get_answer/")
-async def get_answer(history: ChatHistory):
-    logging.info(f"Received chat history: {history}")
 
-    qa_pairs = process_history(history.history)
-    logging.info(f"Processed QA pairs: {qa_pairs}")
+# Сообщение текущего хода для раскладки stable_prefix: найденный контекст идёт
+# после неизменной части промпта, сразу перед вопросом
+def create_turn_message(user_question: str, qa_pairs: List[Dict[str, Any]],
+                        earlier_questions: Optional[List[str]] = None) -> str:
+    return format_qa_context(qa_pairs, earlier_questions) + f'\nВопрос от пользователя: "{user_question}"'
+
+
+# Раскладка stable_prefix: системное сообщение содержит только неизменные инструкции,
+# за ним идёт история диалога без контекста, а найденные QA-пары добавляются в последнее
+# сообщение. Префикс запроса совпадает с предыдущим ходом, и Ollama переиспользует KV-кэш.
+# Раскладка context_first: весь контекст в первом системном сообщении (префикс меняется каждый ход)
+def render_llm_history(kept: List[Message], qa_pairs: List[Dict[str, Any]],
+                       earlier_questions: List[str]) -> List[Dict[str, str]]:
+    user_question = kept[-1].content
+    if PROMPT_LAYOUT == "stable_prefix":
+        llm_history = [{"role": "system", "content": QA_INSTRUCTIONS}]
+        llm_history += [{"role": msg.role, "content": msg.content} for msg in kept[:-1]]
+        llm_history.append({"role": kept[-1].role,
+                            "content": create_turn_message(user_question, qa_pairs, earlier_questions)})
+        return llm_history
+    llm_history = [{"role": "system", "content": create_condensed_qa_prompt(user_question, qa_pairs, earlier_questions)}]
+    llm_history += [{"role": msg.role, "content": msg.content} for msg in kept]
+    return llm_history
+
+
+def history_tokens(llm_history: List[Dict[str, str]]) -> int:
+    return sum(count_tokens(msg["content"]) for msg in llm_history)
+
+
+# Поле context ответа: одинаковый набор полей на всех путях. Если промпт не строился
+# (ответ из базы знаний), размеры промпта нулевые
+def context_stats(layout: str, llm_history: List[Dict[str, str]], kb_pairs: int = 0, kb_pairs_dropped: int = 0,
+                  history_messages: int = 0, history_messages_dropped: int = 0) -> Dict[str, Any]:
+    return {
+        "layout": layout,
+        "prompt_chars": sum(len(msg["content"]) for msg in llm_history),
+        "prompt_tokens": history_tokens(llm_history),
+        "token_budget": CONTEXT_TOKEN_BUDGET,
+        "kb_pairs": kb_pairs,
+        "kb_pairs_dropped": kb_pairs_dropped,
+        "history_messages": history_messages,
+        "history_messages_dropped": history_messages_dropped
+    }
+
+
+# Последнее сообщение входит всегда, более ранние - от новых к старым, пока помещаются
+# в HISTORY_TOKEN_BUDGET; из не поместившихся остаются только короткие вопросы пользователя.
+# QA-пары добавляются в порядке релевантности, пока промпт укладывается в CONTEXT_TOKEN_BUDGET
+def build_llm_context(history: List[Message],
+                      qa_pairs: List[Dict[str, Any]]) -> Tuple[List[Dict[str, Any]], List[Dict[str, str]], Dict[str, Any]]:
+    kept = [history[-1]]
+    kept_tokens = count_tokens(history[-1].content)
+    for msg in reversed(history[:-1]):
+        tokens = count_tokens(msg.content)
+        if kept_tokens + tokens > HISTORY_TOKEN_BUDGET:
+            break
+        kept.append(msg)
+        kept_tokens += tokens
+    kept.reverse()
+    dropped = history[:len(history) - len(kept)]
+    earlier_questions = [shorten(msg.content, EARLIER_QUESTION_CHARS)
+                         for msg in dropped if msg.role == "user"][-EARLIER_QUESTIONS_MAX:]
+
+    while True:
+        budget = CONTEXT_TOKEN_BUDGET - history_tokens(render_llm_history(kept, [], earlier_questions))
+        if budget >= 0 or not earlier_questions:
+            break
+        earlier_questions.pop(0)
+    selected = []
+    for pair in qa_pairs:
+        tokens = count_tokens(format_qa_pair(len(selected) + 1, pair))
+        if tokens <= budget:
+            selected.append(pair)
+            budget -= tokens
+
+    llm_history = render_llm_history(kept, selected, earlier_questions)
+    stats = context_stats(PROMPT_LAYOUT, llm_history, kb_pairs=len(selected),
+                          kb_pairs_dropped=len(qa_pairs) - len(selected),
+                          history_messages=len(kept), history_messages_dropped=len(dropped))
+    return selected, llm_history, stats
+
+REPHRASE_INSTRUCTIONS = '''Ты помощник сотрудников компании x5 retail group. Тебе дан вопрос пользователя и ответ на него из корпоративной базы знаний.
+Перескажи ответ из базы знаний так, чтобы он отвечал на вопрос пользователя. Сохрани все шаги, названия и номера без изменений, ничего не добавляй от себя.
+Общайся непринужденно, но профессионально. Отвечай только на русском языке.'''
+
+ERROR_MESSAGE = "Извините, произошла ошибка при обработке вашего запроса."
+
+
+# Маршрут выбирается только по результатам поиска для текущего вопроса: результаты
+# прошлых вопросов и скользящего контекста в этом ранжировании не участвуют
+def choose_route(history: List[Message], qa_pairs: List[Dict[str, Any]]) -> Dict[str, Any]:
+    top = qa_pairs[0]["distance"] if qa_pairs else math.inf
+    runner_up = qa_pairs[1]["distance"] if len(qa_pairs) > 1 else math.inf
+    confident = (ROUTING_ENABLED and history[-1].role == "user"
+                 and top <= ROUTING_MAX_DISTANCE and runner_up - top >= ROUTING_MIN_MARGIN)
+    route = ("direct" if ROUTING_CONFIDENT_MODE == "direct" else "small") if confident else "large"
+    decision = {
+        "route": route,
+        "top_distance": None if math.isinf(top) else round(top, 4),
+        "margin": None if math.isinf(runner_up - top) else round(runner_up - top, 4)
+    }
+    ROUTING_DECISIONS.labels(route).inc()
+    logging.info(f"Routing decision: {decision}")
+    return decision
+
+
+def build_rephrase_request(user_question: str, pair: Dict[str, Any]) -> Tuple[List[Dict[str, str]], Dict[str, Any]]:
+    llm_history = [
+        {"role": "system", "content": REPHRASE_INSTRUCTIONS},
+        {"role": "user", "content": f'Вопрос пользователя: "{user_question}"\n\nОтвет из базы знаний: {pair["answer"]}'}
+    ]
+    return llm_history, context_stats("rephrase", llm_history, kb_pairs=1)
+
+
+def resolve_history(chat: ChatHistory) -> ChatHistory:
+    use_sessions = SESSION_STORE_ENABLED and chat.conversation_id is not None
+    if chat.message is None:
+        if not chat.history:
+            raise HTTPException(status_code=400, detail="Either history or message is required")
+        if use_sessions:
+            session_store.append_history(chat.conversation_id, [
+                {"role": msg.role, "content": msg.content} for msg in chat.history], replace=True)
+        return chat
+
+    if chat.conversation_id is None:
+        raise HTTPException(status_code=400, detail="message requires conversation_id")
+    if not SESSION_STORE_ENABLED:
+        # Хранилище выключено: клиент повторяет запрос с полной историей и по заголовку
+        # понимает, что присылать только новый вопрос не нужно
+        raise HTTPException(status_code=404, detail="Session store is disabled, send the full history",
+                            headers={"X-Session-Store": "disabled"})
+    stored = session_store.get_history(chat.conversation_id)
+    if stored is None:
+        # Диалог истёк или вытеснен: клиент повторяет запрос с полной историей
+        raise HTTPException(status_code=404, detail="Conversation not found, send the full history")
+    turn = {"role": "user", "content": chat.message}
+    session_store.append_history(chat.conversation_id, [turn])
+    return ChatHistory(history=[Message(**msg) for msg in stored + [turn]], conversation_id=chat.conversation_id)
+
+
+def remember_answer(request: Dict[str, Any], answer: str):
+    if SESSION_STORE_ENABLED and request["conversation_id"] is not None:
+        session_store.append_history(request["conversation_id"], [{"role": "assistant", "content": answer}])
+
+
+async def prepare_llm_request(history: ChatHistory) -> Dict[str, Any]:
+    history = resolve_history(history)
+    with observe_stage("history_processing"):
+        qa_pairs, rag_results = await process_history(history.history, return_embeddings=SEMANTIC_CACHE_ENABLED,
+                                                      conversation_id=history.conversation_id)
+    log_payload("Processed QA pairs", qa_pairs)
 
     user_question = history.history[-1].content
-    prompt = create_condensed_qa_prompt(user_question, qa_pairs)
-    
-    llm_history = [{"role": "system", "content": prompt}]
-    for msg in history.history:
-        llm_history.append({"role": msg.role, "content": msg.content})
+    question_pairs = rank_qa_pairs({"results": [r for r in rag_results['results'] if r['query'] == user_question][:1]})
+    request = {
+        "model": LLM_MODEL,
+        "routing": choose_route(history.history, question_pairs),
+        "direct_answer": None,
+        "cached_answer": None,
+        "cache_key": None,
+        "conversation_id": history.conversation_id,
+        "started": time.perf_counter()
+    }
+
+    if request["routing"]["route"] == "direct":
+        request["model"] = "knowledge_base"
+        request["direct_answer"] = question_pairs[0]["answer"]
+        request["context"] = context_stats("direct", [], kb_pairs=1)
+        return request
+
+    with observe_stage("prompt_build"):
+        if request["routing"]["route"] == "small":
+            request["model"] = LLM_SMALL_MODEL
+            qa_pairs = question_pairs[:1]
+            request["llm_history"], request["context"] = build_rephrase_request(user_question, qa_pairs[0])
+        else:
+            qa_pairs, request["llm_history"], request["context"] = build_llm_context(history.history, qa_pairs)
+    PROMPT_TOKENS.observe(request["context"]["prompt_tokens"])
+
+    if SEMANTIC_CACHE_ENABLED and history.history[-1].role == "user":
+        question_embedding = next((r.get("embedding") for r in rag_results['results']
+                                   if r['query'] == user_question), None)
+        if question_embedding is not None:
+            request["cache_key"] = (question_embedding,
+                                    context_cache_key(qa_pairs, request["model"]),
+                                    rag_results.get("collection_version"))
+            with observe_stage("cache_lookup"):
+                request["cached_answer"] = semantic_cache.lookup(*request["cache_key"])
+            SEMANTIC_CACHE_LOOKUPS.labels("miss" if request["cached_answer"] is None else "hit").inc()
+            if request["cached_answer"] is not None:
+                logging.info("Semantic cache hit")
+                return request
+
+    return request
+
+
+def store_answer(request: Dict[str, Any], answer: str):
+    if request["cache_key"] is not None:
+        semantic_cache.store(*request["cache_key"], answer)
+
 
-    llm_response = llm_query(llm_history)
-    logging.info(f"LLM response: {llm_response}")
+def observe_route(request: Dict[str, Any]):
+    route = "cached" if request["cached_answer"] is not None else request["routing"]["route"]
+    ROUTE_SECONDS.labels(route).observe(time.perf_counter() - request["started"])
+
+
+@app.post("/api/v1/get_answer/")
+async def get_answer(history: ChatHistory):
+    log_payload("Received chat history", history)
+
+    request = await prepare_llm_request(history)
+    model = request["model"]
+    ready_answer = request["direct_answer"] or request["cached_answer"]
+    if ready_answer is not None:
+        observe_route(request)
+        remember_answer(request, ready_answer)
+        return {
+            "model": model,
+            "message": {
+                "role": "assistant",
+                "content": ready_answer
+            },
+            "cached": request["cached_answer"] is not None,
+            "routing": request["routing"],
+            "context": dict(request["context"], prompt_eval_count=None)
+        }
+
+    llm_response = await llm_query(request["llm_history"], model=model)
+    observe_route(request)
+    log_payload("LLM response", llm_response)
 
     if 'message' in llm_response and 'content' in llm_response['message']:
         response_content = llm_response['message']['content']
+        store_answer(request, response_content)
+        remember_answer(request, response_content)
     else:
-        response_content = "Извините, произошла ошибка при обработке вашего запроса."
+        response_content = ERROR_MESSAGE
 
     response = {
-        "model": "gemma2:9b",
+        "model": model,
         "message": {
             "role": "assistant",
             "content": response_content
-        }
+        },
+        "cached": False,
+        "routing": request["routing"],
+        "context": dict(request["context"], prompt_eval_count=llm_response.get("prompt_eval_count"))
     }
 
     return response
 
+
+def stream_chunk(model: str, content: str, done: bool, **extra) -> str:
+    chunk = {
+        "model": model,
+        "message": {
+            "role": "assistant",
+            "content": content
+        },
+        "done": done,
+        **extra
+    }
+    return json.dumps(chunk, ensure_ascii=False) + "\n"
+
+
+async def answer_stream(request: Dict[str, Any]) -> AsyncIterator[str]:
+    model = request["model"]
+    ready_answer = request["direct_answer"] or request["cached_answer"]
+    if ready_answer is not None:
+        observe_route(request)
+        remember_answer(request, ready_answer)
+        yield stream_chunk(model, ready_answer, True, cached=request["cached_answer"] is not None,
+                           routing=request["routing"], context=dict(request["context"], prompt_eval_count=None))
+        return
+
+    parts = []
+    context = dict(request["context"], prompt_eval_count=None)
+    try:
+        async for chunk in llm_query_stream(request["llm_history"], model=model):
+            content = chunk.get("message", {}).get("content", "")
+            if content:
+                parts.append(content)
+                yield stream_chunk(model, content, False)
+            if chunk.get("done"):
+                context["prompt_eval_count"] = chunk.get("prompt_eval_count")
+                break
+    except Exception as e:
+        logging.error(f"Error while streaming LLM response: {str(e)}", exc_info=True)
+        yield stream_chunk(model, ERROR_MESSAGE, True, cached=False, error=str(e), context=context)
+        return
+    observe_route(request)
+
+    answer = "".join(parts)
+    log_payload("LLM streamed response", answer)
+    if answer:
+        store_answer(request, answer)
+        remember_answer(request, answer)
+    yield stream_chunk(model, "", True, cached=False, routing=request["routing"], context=context)
+
+
+# Потоковая версия get_answer: токены LLM пересылаются клиенту по мере генерации
+# в формате NDJSON (одна JSON-строка на чанк, как в Ollama API)
+@app.post("/api/v1/get_answer_stream/")
+async def get_answer_stream(history: ChatHistory):
+    log_payload("Received chat history for streaming", history)
+    try:
+        request = await prepare_llm_request(history)
+    except HTTPException as e:
+        if e.status_code < 500:
+            raise
+        # Ошибка до начала генерации: клиент потокового API получает тот же формат, что и при
+        # ошибке LLM, - одну NDJSON-строку с done и error
+        return StreamingResponse(iter([stream_chunk(LLM_MODEL, ERROR_MESSAGE, True, cached=False, error=e.detail)]),
+                                 status_code=e.status_code, media_type="application/x-ndjson")
+    return StreamingResponse(answer_stream(request), media_type="application/x-ndjson")
+
+
+# Лёгкая проверка доступности для UI и балансировщика: не обращается к ml-service и Ollama
+@app.get("/health")
+async def health():
+    return {"status": "ok", "sessions": len(session_store.sessions)}
+
+
+@app.get("/api/v1/cache_stats/")
+async def cache_stats():
+    return semantic_cache.stats()
+
+
+@app.get("/api/v1/session_stats/")
+async def session_stats():
+    return session_store.stats()
+
+
+@app.get("/metrics")
+async def metrics():
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 if __name__ == "__main__":
     uvicorn.run(app, host="0.0.0.0", port=9003)
\ No newline at end of file
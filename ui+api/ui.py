@@ -2,6 +2,8 @@ import streamlit as st
 from streamlit_extras.colored_header import colored_header
 from streamlit_extras.add_vertical_space import add_vertical_space
 import requests
+import json
+import uuid
 
 # Настройка страницы
 st.set_page_config(page_title="X5 Group Chatbot", page_icon="🤖", layout="wide")
@@ -28,7 +30,24 @@ st.markdown("""
 """, unsafe_allow_html=True)
 
 # Конфигурация API
-API_URL = "http://localhost:9003/api/v1/get_answer/"
+API_BASE_URL = "http://localhost:9003"
+API_URL = f"{API_BASE_URL}/api/v1/get_answer/"
+STREAM_API_URL = f"{API_BASE_URL}/api/v1/get_answer_stream/"
+HEALTH_URL = f"{API_BASE_URL}/health"
+
+# Сколько сообщений показывать и хранить в сессии: старые догружаются кнопкой
+MESSAGES_PAGE = 20
+MAX_MESSAGES = 200
+
+
+# Одна HTTP-сессия с пулом соединений на весь процесс Streamlit, а не новое соединение на каждый запрос
+@st.cache_resource
+def get_http_session():
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=32)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 # Боковая панель
 with st.sidebar:
@@ -45,6 +64,7 @@ with st.sidebar:
     - [Streamlit](https://streamlit.io/)
     - [LangChain](https://www.langchain.com/)
     ''')
+    stream_mode = st.toggle('Потоковый вывод ответа', value=True)
     add_vertical_space(5)
     st.write('Made with ❤️ by X5 Tech Team')
 
@@ -58,27 +78,85 @@ if 'messages' not in st.session_state:
         {"role": "assistant", "content": "Здравствуйте! Я AI-ассистент X5 Group. Чем я могу вам помочь сегодня?"}
     ]
 
-# Отображение истории чата
-for message in st.session_state.messages:
+# Идентификатор диалога: API хранит историю диалога и результаты поиска прошлых ходов,
+# поэтому UI отправляет только новый вопрос
+if 'conversation_id' not in st.session_state:
+    st.session_state.conversation_id = uuid.uuid4().hex
+if 'history_synced' not in st.session_state:
+    st.session_state.history_synced = False
+# Если в API выключено хранилище диалогов, история всегда отправляется целиком
+if 'session_store' not in st.session_state:
+    st.session_state.session_store = True
+if 'visible_messages' not in st.session_state:
+    st.session_state.visible_messages = MESSAGES_PAGE
+
+# Отображение истории чата: только последние сообщения, более ранние - по кнопке
+hidden = len(st.session_state.messages) - st.session_state.visible_messages
+if hidden > 0 and st.button(f"Показать более ранние сообщения ({hidden})"):
+    st.session_state.visible_messages += MESSAGES_PAGE
+    st.rerun()
+for message in st.session_state.messages[-st.session_state.visible_messages:]:
     with st.chat_message(message["role"]):
         st.markdown(message["content"])
 
+# Тело запроса: новый вопрос, если API уже знает диалог, иначе история целиком
+def request_payload(messages, full_history=False):
+    if full_history or not st.session_state.history_synced or not st.session_state.session_store:
+        return {"history": messages, "conversation_id": st.session_state.conversation_id}
+    return {"message": messages[-1]["content"], "conversation_id": st.session_state.conversation_id}
+
+# Отправка запроса; если API не знает диалог (истёк или перезапуск), история отправляется целиком
+def post_api(url, messages, stream=False):
+    session = get_http_session()
+    response = session.post(url, json=request_payload(messages), stream=stream)
+    if response.status_code == 404:
+        if response.headers.get("X-Session-Store") == "disabled":
+            st.session_state.session_store = False
+        response.close()
+        response = session.post(url, json=request_payload(messages, full_history=True), stream=stream)
+    response.raise_for_status()
+    st.session_state.history_synced = True
+    return response
+
 # Функция для отправки запроса к API
 def query_api(messages):
     try:
-        response = requests.post(API_URL, json={"history": messages})
-        response.raise_for_status()
-        return response.json()
+        return post_api(API_URL, messages).json()
     except requests.exceptions.RequestException as e:
         st.error(f"Ошибка при обращении к API: {str(e)}")
         return None
 
+# Функция для потокового получения ответа: отдаёт токены по мере генерации
+def query_api_stream(messages):
+    with post_api(STREAM_API_URL, messages, stream=True) as response:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line)
+            content = chunk.get("message", {}).get("content", "")
+            if content:
+                yield content
+
 # Функция для обработки ввода пользователя
 def handle_user_input(user_input):
     st.session_state.messages.append({"role": "user", "content": user_input})
+    del st.session_state.messages[:-MAX_MESSAGES]
     with st.chat_message("user"):
         st.markdown(user_input)
 
+    if stream_mode:
+        with st.chat_message("assistant"):
+            try:
+                bot_response = st.write_stream(query_api_stream(st.session_state.messages))
+            except requests.exceptions.RequestException as e:
+                st.error(f"Ошибка при обращении к API: {str(e)}")
+                bot_response = None
+        if bot_response:
+            st.session_state.messages.append({"role": "assistant", "content": bot_response})
+        else:
+            st.error("Не удалось получить корректный ответ от API.")
+        return
+
     with st.spinner('AI думает...'):
         api_response = query_api(st.session_state.messages)
 
@@ -100,13 +178,16 @@ if st.button('Очистить историю чата'):
     st.session_state.messages = [
         {"role": "assistant", "content": "История чата очищена. Чем я могу вам помочь?"}
     ]
+    st.session_state.conversation_id = uuid.uuid4().hex
+    st.session_state.history_synced = False
+    st.session_state.visible_messages = MESSAGES_PAGE
     st.rerun()  # Заменено st.experimental_rerun() на st.rerun()
 
 # Отображение статуса подключения к API
 st.sidebar.markdown("---")
 if st.sidebar.button("Проверить подключение к API"):
     try:
-        response = requests.get(API_URL)
+        response = get_http_session().get(HEALTH_URL, timeout=5)
         if response.status_code == 200:
             st.sidebar.success("✅ API подключено и работает")
         else: